@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Compare how the thread-based and asyncio clients scale with concurrency.
+
+Starts a server as bench/load.py does, or targets a running one with
+--target, and for each --concurrency level uploads --uploads DOTs with that
+many uploads in progress at once, in two ways:
+
+- threads: one thread per concurrent upload, calling DotClient.upload
+  (TCP) or send_udp_reliable on its own socket (UDP), as a blocking
+  program would
+- asyncio: one task per concurrent upload on a single event loop, through
+  AsyncDotClient or AsyncUdpClient
+
+Both TCP clients share a pool of --connections connections with --window
+uploads in flight on each. Every run is a fresh process, so besides
+throughput and latency percentiles the report shows the client's own CPU
+time, peak RSS and thread count.
+
+Example:
+    python bench/client.py tcp -c 10 100 1000 -n 5000
+    python bench/client.py udp -c 10 100 1000 --json udp-clients.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+import threading
+import multiprocessing
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from utils import DOT, log, send_udp_reliable
+from utils.client import DotClient
+from utils.async_client import AsyncDotClient, AsyncUdpClient
+from utils.protocol import FRAGMENT_SIZE
+from load import make_dot, parse_size, start_server, wait_for_server
+
+MODES = ("threads", "asyncio")
+
+PERCENTILES = (50, 99)
+
+
+def _tcp_threads(args, address, dots, concurrency):
+    """Upload from `concurrency` threads sharing a DotClient.
+
+    Returns:
+        tuple: Upload latencies in seconds, errors, and threads running
+    """
+    client = DotClient([address], tempfile.mkdtemp(),
+                       connections=args.connections, window=args.window,
+                       timeout=args.timeout, health_interval=0)
+
+    def upload(dot):
+        return client.upload(dot)
+
+    try:
+        return _run_threads(dots, concurrency, upload)
+    finally:
+        client.close()
+
+
+def _udp_threads(args, address, dots, concurrency):
+    """Upload from `concurrency` threads, each with its own socket.
+
+    Returns:
+        tuple: Upload latencies in seconds, errors, and threads running
+    """
+    local = threading.local()
+
+    def upload(dot):
+        if not hasattr(local, "sock"):
+            local.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        digest = dot.digest()
+        reply = send_udp_reliable(local.sock, address, dot, "store",
+                                  args.udp_timeout, args.retries,
+                                  args.fragment_size)
+        return (reply is not None and reply.is_ack and
+                (reply.size, reply.hash) == (digest.size, digest.hexdigest))
+
+    return _run_threads(dots, concurrency, upload)
+
+
+def _run_threads(dots, concurrency, upload):
+    """Run uploads from a pool of threads pulling from a shared counter.
+
+    Returns:
+        tuple: Upload latencies in seconds, errors, and threads running
+    """
+    latencies = []
+    errors = [0]
+    counter = itertools.count()
+
+    def worker():
+        while True:
+            i = next(counter)
+            if i >= len(dots):
+                return
+            start = time.perf_counter()
+            if upload(dots[i]):
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    running = threading.active_count()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], running
+
+
+async def _run_tasks(client, dots, concurrency):
+    """Run uploads from `concurrency` tasks pulling from a shared counter.
+
+    Returns:
+        tuple: Upload latencies in seconds, errors, and threads running
+    """
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while True:
+            i = next(counter)
+            if i >= len(dots):
+                return
+            start = time.perf_counter()
+            if await client.upload(dots[i]):
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    running = threading.active_count()
+    await asyncio.gather(*workers)
+    return latencies, errors, running
+
+
+async def _asyncio(args, address, dots, concurrency):
+    """Upload from `concurrency` tasks through an async client.
+
+    Returns:
+        tuple: Upload latencies in seconds, errors, and threads running
+    """
+    if args.protocol == "tcp":
+        client = AsyncDotClient([address], tempfile.mkdtemp(),
+                                connections=args.connections,
+                                window=args.window, timeout=args.timeout)
+    else:
+        client = AsyncUdpClient(address, tempfile.mkdtemp(),
+                                timeout=args.udp_timeout,
+                                retries=args.retries,
+                                window=concurrency,
+                                fragment_size=args.fragment_size)
+    async with client:
+        return await _run_tasks(client, dots, concurrency)
+
+
+def client_process(args, address, mode, concurrency, results):
+    """Run one mode at one concurrency level and report it.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        address (tuple): Server (host, port)
+        mode (str): One of MODES
+        concurrency (int): Uploads in progress at once
+        results (multiprocessing.Queue): Receives the result dict
+    """
+    log.configure("error")
+    content = make_dot(parse_size(args.size), 0)
+    dots = [DOT(f"client{i % args.names}", content)
+            for i in range(args.uploads)]
+    cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        if mode == "asyncio":
+            latencies, errors, threads = asyncio.run(
+                _asyncio(args, address, dots, concurrency))
+        elif args.protocol == "tcp":
+            latencies, errors, threads = _tcp_threads(args, address, dots,
+                                                      concurrency)
+        else:
+            latencies, errors, threads = _udp_threads(args, address, dots,
+                                                      concurrency)
+    except (OSError, RuntimeError) as e:
+        results.put({"mode": mode, "concurrency": concurrency,
+                     "error": str(e)})
+        return
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        "mode": mode,
+        "concurrency": concurrency,
+        "completed": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "uploads_per_sec": len(latencies) / elapsed,
+        "latency_ms": {},
+        "cpu_seconds": time.process_time() - cpu,
+        # ru_maxrss is in KiB on Linux
+        "rss_peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "threads": threads,
+    }
+    for p in PERCENTILES:
+        if latencies:
+            index = min(int(len(latencies) * p / 100), len(latencies) - 1)
+            result["latency_ms"][f"p{p}"] = latencies[index] * 1000
+    results.put(result)
+
+
+def print_header():
+    """Print the heading of the results table."""
+    print(f"{'mode':<8} {'conc':>6} {'uploads/s':>10} {'p50 ms':>9} "
+          f"{'p99 ms':>9} {'errors':>7} {'cpu s':>7} {'rss MiB':>8} "
+          f"{'threads':>8}")
+
+
+def print_result(r):
+    """Print one run as a row of the results table."""
+    if "error" in r:
+        print(f"{r['mode']:<8} {r['concurrency']:>6}  failed: {r['error']}")
+        return
+    latency = r["latency_ms"]
+    print(f"{r['mode']:<8} {r['concurrency']:>6} "
+          f"{r['uploads_per_sec']:>10.1f} "
+          f"{latency.get('p50', 0):>9.2f} {latency.get('p99', 0):>9.2f} "
+          f"{r['errors']:>7} {r['cpu_seconds']:>7.2f} "
+          f"{r['rss_peak'] / 2**20:>8.1f} {r['threads']:>8}")
+
+
+def run(args):
+    """Run every mode at every concurrency level.
+
+    Returns:
+        list: Result dicts, or None if the server could not be reached
+    """
+    storage = tempfile.TemporaryDirectory()
+    server = None
+    try:
+        if args.target:
+            host, _, port = args.target.rpartition(":")
+            address = (host or "127.0.0.1", int(port))
+        else:
+            address = ("127.0.0.1", args.port)
+            server = start_server(args, storage.name)
+        if not wait_for_server(args, address, server):
+            print(f"Server at {address[0]}:{address[1]} did not come up")
+            return None
+
+        results = []
+        queue = multiprocessing.Queue()
+        print_header()
+        for concurrency in args.concurrency:
+            for mode in args.modes:
+                process = multiprocessing.Process(
+                    target=client_process,
+                    args=(args, address, mode, concurrency, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+                results.append(result)
+                print_result(result)
+        return results
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        storage.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Thread-based versus asyncio client benchmark")
+    parser.add_argument("protocol", choices=["tcp", "udp"])
+    parser.add_argument("-c", "--concurrency", type=int, nargs="+",
+                        default=[10, 100, 1000],
+                        help="Uploads in progress at once, one run per "
+                             "value (default: 10 100 1000)")
+    parser.add_argument("-n", "--uploads", type=int, default=5000,
+                        help="Uploads per run (default: 5000)")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--size", default="1k",
+                        help="Size of each DOT, e.g. 512, 16k (default: 1k)")
+    parser.add_argument("--names", type=int, default=64,
+                        help="Distinct DOT names, reused to bound disk use "
+                             "(default: 64)")
+    parser.add_argument("-p", "--port", type=int, default=9180,
+                        help="Port to start the server on (default: 9180)")
+    parser.add_argument("--target",
+                        help="host:port of a running server to drive instead "
+                             "of starting one")
+    parser.add_argument("--server-cmd",
+                        help="Command starting the server, with {port} and "
+                             "{dir} placeholders (default: the Python "
+                             "server)")
+    parser.add_argument("--server-args", default="",
+                        help="Extra server arguments, e.g. \"-e asyncio\"")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="TCP connections in each client's pool "
+                             "(default: 4)")
+    parser.add_argument("-w", "--window", type=int, default=64,
+                        help="TCP uploads in flight per connection "
+                             "(default: 64)")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Seconds a TCP upload may wait (default: 30)")
+    parser.add_argument("--udp-timeout", type=float, default=1.0,
+                        help="UDP retransmission timeout (default: 1.0)")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="UDP timeouts without progress before giving up "
+                             "(default: 5)")
+    parser.add_argument("--fragment-size", type=int, default=FRAGMENT_SIZE)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+    if results is None:
+        sys.exit(1)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compare encode and decode speed of the JSON and binary codecs.
+
+Builds upload messages of several sizes from DOT-like content (quotes,
+newlines and attribute lists, which JSON has to escape), then times
+Message.encode and Message.decode for each codec and prints the payload
+size and microseconds per operation.
+
+Example:
+    python bench/codec.py --sizes 1000 100000 --repeat 5
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from utils import DOT, Message
+from utils.codec import CODECS
+
+
+def make_content(size):
+    """Build DOT content of roughly `size` bytes.
+
+    Args:
+        size (int): Approximate content size in bytes
+
+    Returns:
+        str: The DOT source
+    """
+    lines = ["digraph G {\n"]
+    total = len(lines[0])
+    i = 0
+    while total < size:
+        line = f'  "n{i}" -> "n{i + 1}" [label="edge {i}", color="#333"];\n'
+        lines.append(line)
+        total += len(line)
+        i += 1
+    lines.append("}\n")
+    return "".join(lines)
+
+
+def measure(msg, codec, repeat, number):
+    """Time encoding and decoding of one message.
+
+    Args:
+        msg (Message): The message to encode
+        codec (str): Codec name
+        repeat (int): Timing repetitions; the best one is kept
+        number (int): Operations per repetition
+
+    Returns:
+        tuple: (payload size, encode µs, decode µs)
+    """
+    msg.codec = codec
+    payload = msg.encode()
+    encode = min(timeit.repeat(msg.encode, repeat=repeat, number=number))
+    decode = min(timeit.repeat(lambda: Message.decode(payload),
+                               repeat=repeat, number=number))
+    return (len(payload), encode / number * 1e6, decode / number * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Codec benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[200, 10000, 1000000],
+                        help="DOT content sizes in bytes")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>9} {'codec':<7} {'payload':>9} {'encode µs':>11} "
+          f"{'decode µs':>11}")
+    for size in args.sizes:
+        dot = DOT("bench", make_content(size))
+        msg = Message(command="store", dot=dot, id_=1)
+        # Aim for roughly 0.1 s per repetition
+        number = max(1, 2000000 // max(size, 1))
+        for codec in CODECS:
+            payload, encode, decode = measure(msg, codec, args.repeat, number)
+            print(f"{size:>9} {codec:<7} {payload:>9} {encode:>11.1f} "
+                  f"{decode:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare compression ratio and speed for DOT upload messages.
+
+Encodes upload messages of several sizes with every algorithm at a few
+levels, plus zlib with a preset dictionary trained from the sample graphs,
+and prints the payload size relative to the uncompressed one and the
+microseconds spent encoding and decoding.
+
+Example:
+    python bench/compression.py --sizes 200 5000 --codec binary
+"""
+
+import os
+import sys
+import glob
+import timeit
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from utils import DOT, Message
+from utils.codec import CODECS, CODEC_JSON
+from utils.compression import ALGORITHMS, Compression, train_dictionary
+from codec import make_content
+
+LEVELS = {"zlib": (1, 6, 9), "lzma": (0, 6), "bz2": (1, 9)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[200, 2000, 100000],
+                        help="DOT content sizes in bytes")
+    parser.add_argument("--codec", choices=CODECS, default=CODEC_JSON)
+    parser.add_argument("--samples", default=os.path.join(ROOT, "..", "samples"),
+                        help="Directory of .dot files to train a dictionary on")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    samples = []
+    for path in sorted(glob.glob(os.path.join(args.samples, "*.dot"))):
+        with open(path, "r", encoding="utf-8") as f:
+            samples.append(f.read())
+    # Add generated graphs so the dictionary also sees typical edge lines
+    samples.append(make_content(4096))
+    zdict = train_dictionary(samples)
+
+    settings = [("none", None)]
+    for algorithm in ALGORITHMS:
+        for level in LEVELS[algorithm]:
+            settings.append((f"{algorithm}-{level}",
+                             Compression(algorithm, level, threshold=0)))
+    settings.append(("zlib-6+dict",
+                     Compression("zlib", 6, threshold=0, zdict=zdict)))
+
+    print(f"{'size':>8} {'setting':<12} {'payload':>9} {'ratio':>6} "
+          f"{'encode µs':>11} {'decode µs':>11}")
+    for size in args.sizes:
+        dot = DOT("bench", make_content(size))
+        number = max(1, 200000 // max(size, 1))
+        plain = None
+        for label, compression in settings:
+            msg = Message(command="store", dot=dot, id_=1, codec=args.codec,
+                          compression=compression)
+            payload = msg.encode()
+            plain = plain or len(payload)
+            encode = min(timeit.repeat(msg.encode, repeat=args.repeat,
+                                       number=number)) / number
+            decode = min(timeit.repeat(lambda: Message.decode(payload),
+                                       repeat=args.repeat,
+                                       number=number)) / number
+            print(f"{size:>8} {label:<12} {len(payload):>9} "
+                  f"{len(payload) / plain:>6.2f} {encode * 1e6:>11.1f} "
+                  f"{decode * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Measure DOT parser throughput on multi-megabyte graphs.
+
+Builds graphs of several sizes, with quoted node names, attribute lists and
+subgraphs, and parses each one whole and fed in pieces of several sizes, as
+a streamed upload arrives. Prints MB/s and the size of the resulting model.
+
+Example:
+    python bench/graph.py --sizes 1000000 10000000 --chunks 4096 262144
+"""
+
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from utils.graph import DotParser
+
+
+def make_graph(size):
+    """Build DOT content of roughly `size` bytes.
+
+    Args:
+        size (int): Approximate content size in bytes
+
+    Returns:
+        str: The DOT source
+    """
+    lines = ["digraph G {\n", "  node [shape=box];\n"]
+    total = sum(len(line) for line in lines)
+    i = 0
+    while total < size:
+        if i % 1000 == 0:
+            line = f"  subgraph cluster_{i} {{ n{i}; n{i + 1} }}\n"
+        elif i % 3 == 0:
+            line = f'  "n{i}" -> "n{i // 2}" [label="edge {i}", color="#333"];\n'
+        else:
+            line = f"  n{i} -> n{i + 1} -> n{i // 7};\n"
+        lines.append(line)
+        total += len(line)
+        i += 1
+    lines.append("}\n")
+    return "".join(lines)
+
+
+def measure(content, chunk_size, repeat):
+    """Time parsing of content fed in pieces.
+
+    Args:
+        content (str): The DOT source
+        chunk_size (int): Piece size, or 0 to feed it whole
+        repeat (int): Timing repetitions; the best one is kept
+
+    Returns:
+        tuple: (best seconds, parsed Graph)
+    """
+    step = chunk_size or len(content)
+    pieces = [content[i:i + step] for i in range(0, len(content), step)]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser = DotParser()
+        for piece in pieces:
+            parser.feed(piece)
+        graph = parser.close()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DOT parser benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000000, 10000000],
+                        help="DOT content sizes in bytes")
+    parser.add_argument("--chunks", type=int, nargs="+",
+                        default=[0, 4096, 262144],
+                        help="Piece sizes to feed, 0 for the whole content")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>9} {'chunk':>7} {'MB/s':>7} {'nodes':>8} {'edges':>8}")
+    for size in args.sizes:
+        content = make_graph(size)
+        for chunk_size in args.chunks:
+            seconds, graph = measure(content, chunk_size, args.repeat)
+            rate = len(content) / seconds / 1e6
+            print(f"{len(content):>9} {chunk_size or 'whole':>7} {rate:>7.1f} "
+                  f"{graph.node_count:>8} {graph.edge_count:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+"""Drive a TCP or UDP server with many concurrent clients and report latency.
+
+Starts a server (tcp/server.py or udp/server.py by default, or any command
+given with --server-cmd, such as a Go server) on a temporary directory, or
+targets one that is already running with --target. Client processes then
+upload DOTs drawn from a size distribution for a fixed time:
+
+- TCP: each connection keeps up to --window uploads in flight, matching
+  acknowledgements by message ID, or in order for servers that do not echo
+  IDs
+- UDP: each connection is a socket uploading one DOT at a time with
+  retransmissions; --loss starts a local proxy that drops datagrams in
+  both directions
+
+Reports throughput, latency percentiles and a histogram, and the server's
+CPU use and RSS (from /proc, so only for local servers on Linux). --json
+writes the results for later runs to --compare against.
+
+Example:
+    python bench/load.py tcp -c 32 -w 8 --sizes 1k:70 64k:25 1m:5
+    python bench/load.py udp --loss 0.02 --json udp.json
+    python bench/load.py tcp --server-cmd "../go-implementation/bin/tcp-server -port {port} -dir {dir}" --echo
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import selectors
+import threading
+import subprocess
+import multiprocessing
+from array import array
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from utils import (DOT, FrameReader, Message, receive_message, request_udp,
+                   send_message)
+from utils.codec import CODEC_JSON, CODECS
+from utils.protocol import FRAGMENT_SIZE, MAX_BUFFER_SIZE
+
+RESULT_VERSION = 1
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = [b * 10.0 ** e for e in range(-2, 5) for b in (1, 2, 5)]
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+_SUFFIXES = {"k": 1024, "m": 1024 * 1024}
+
+
+def parse_size(text):
+    """Parse a size such as 512, 16k or 1m.
+
+    Args:
+        text (str): The size
+
+    Returns:
+        int: Bytes
+    """
+    text = text.strip().lower()
+    if text[-1:] in _SUFFIXES:
+        return int(float(text[:-1]) * _SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_mix(specs):
+    """Parse a payload size distribution.
+
+    Args:
+        specs (list): "SIZE[:WEIGHT]" strings
+
+    Returns:
+        list: (size, weight) tuples
+    """
+    mix = []
+    for spec in specs:
+        size, _, weight = spec.partition(":")
+        mix.append((parse_size(size), float(weight or 1)))
+    return mix
+
+
+def make_dot(size, seed):
+    """Build a valid DOT of roughly `size` bytes.
+
+    Args:
+        size (int): Approximate content size in bytes
+        seed (int): Varies the node names
+
+    Returns:
+        str: The DOT source
+    """
+    lines = ["digraph G {\n"]
+    total = len(lines[0]) + 2
+    i = 0
+    while total < size:
+        line = f"  n{seed}_{i} -> n{seed}_{i + 1};\n"
+        lines.append(line)
+        total += len(line)
+        i += 1
+    lines.append("}\n")
+    return "".join(lines)
+
+
+class _Recorder:
+    """Latencies and counts of the requests one client process made."""
+
+    def __init__(self, measure_from, deadline):
+        self.measure_from = measure_from
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.latencies = array("d")
+        self.completed = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, sent_at, size, ok):
+        """Record a finished request sent at `sent_at`."""
+        if sent_at < self.measure_from:
+            return
+        with self.lock:
+            if not ok:
+                self.errors += 1
+                return
+            self.latencies.append(time.perf_counter() - sent_at)
+            self.completed += 1
+            self.bytes += size
+
+    def result(self, unanswered):
+        """Summarize for the parent process."""
+        return {"completed": self.completed, "errors": self.errors,
+                "unanswered": unanswered, "bytes": self.bytes,
+                "latencies": self.latencies.tobytes()}
+
+
+def _tcp_connection(args, address, payloads, weights, conn, recorder):
+    """Upload over one TCP connection until the deadline.
+
+    Returns:
+        int: Requests still unanswered at the end
+    """
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = FrameReader(sock)
+    slots = threading.Semaphore(args.window)
+    lock = threading.Lock()
+    # Message ID -> (send time, size), in send order
+    in_flight = {}
+
+    def receive():
+        while True:
+            msg = receive_message(sock, reader)
+            if msg is None:
+                return
+            with lock:
+                entry = in_flight.pop(msg.id, None)
+                if entry is None and in_flight:
+                    # Servers that do not echo IDs answer in order
+                    entry = in_flight.pop(next(iter(in_flight)))
+            if entry is None:
+                continue
+            ok = msg.is_ack or (msg.dot is not None and msg.command != "invalid")
+            recorder.record(entry[0], entry[1], ok)
+            slots.release()
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    rng = random.Random(conn)
+    command = "" if args.echo else "store"
+    msg_id = 0
+    while time.perf_counter() < recorder.deadline:
+        if not slots.acquire(timeout=0.1):
+            continue
+        msg_id += 1
+        size, content = rng.choices(payloads, weights)[0]
+        dot = DOT(f"load{conn}_{msg_id % args.names}", content)
+        with lock:
+            in_flight[msg_id] = (time.perf_counter(), size)
+        if not send_message(sock, Message(command=command, dot=dot,
+                                          id_=msg_id, codec=args.codec)):
+            break
+    # Wait for the last acknowledgements
+    end = time.perf_counter() + args.drain
+    while in_flight and time.perf_counter() < end and receiver.is_alive():
+        time.sleep(0.01)
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+    receiver.join(1.0)
+    return len(in_flight)
+
+
+def _udp_connection(args, address, payloads, weights, conn, recorder):
+    """Upload over one UDP socket until the deadline.
+
+    Returns:
+        int: Requests left unanswered after all retries
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rng = random.Random(conn)
+    command = "" if args.echo else "store"
+    lost = 0
+    i = 0
+    try:
+        while time.perf_counter() < recorder.deadline:
+            i += 1
+            size, content = rng.choices(payloads, weights)[0]
+            dot = DOT(f"load{conn}_{i % args.names}", content)
+            sent_at = time.perf_counter()
+            reply = request_udp(sock, address,
+                                Message(command=command, dot=dot,
+                                        codec=args.codec),
+                                args.timeout, args.retries, args.fragment_size)
+            if reply is None:
+                lost += 1
+                continue
+            ok = reply.is_ack or (reply.dot is not None
+                                  and reply.command != "invalid")
+            recorder.record(sent_at, size, ok)
+    finally:
+        sock.close()
+    return lost
+
+
+def client_process(args, address, first, count, ready, start, results):
+    """Run `count` connections in this process and report their results.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        address (tuple): Server (host, port)
+        first (int): Number of the first connection, for names and seeds
+        count (int): Connections to run
+        ready (multiprocessing.Queue): Signalled once payloads are built
+        start (multiprocessing.Event): Set when all processes are ready
+        results (multiprocessing.Queue): Receives the result dict
+    """
+    # The protocol helpers print for every message
+    sys.stdout = open(os.devnull, "w")
+    mix = parse_mix(args.sizes)
+    payloads = [(len(content.encode("utf-8")), content)
+                for content in (make_dot(size, first + i)
+                                for i, (size, _) in enumerate(mix))]
+    weights = [weight for _, weight in mix]
+    run = _tcp_connection if args.protocol == "tcp" else _udp_connection
+    ready.put(first)
+    start.wait()
+    now = time.perf_counter()
+    recorder = _Recorder(now + args.warmup, now + args.warmup + args.duration)
+    unanswered = [0] * count
+
+    def connection(i):
+        try:
+            unanswered[i] = run(args, address, payloads, weights, first + i,
+                                recorder)
+        except OSError as e:
+            print(f"Connection {first + i} failed: {e}")
+
+    threads = [threading.Thread(target=connection, args=(i,))
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(recorder.result(sum(unanswered)))
+
+
+def loss_proxy(listen_port, server, loss, ready):
+    """Relay UDP datagrams to a server, dropping a fraction of them.
+
+    Each client address gets its own upstream socket so replies find their
+    way back. Runs until terminated.
+
+    Args:
+        listen_port (int): Local port clients send to
+        server (tuple): Server (host, port)
+        loss (float): Probability of dropping each datagram, each way
+        ready (multiprocessing.Event): Set once the port is bound
+    """
+    rng = random.Random(0)
+    front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    front.bind(("127.0.0.1", listen_port))
+    selector = selectors.DefaultSelector()
+    selector.register(front, selectors.EVENT_READ, None)
+    upstreams = {}
+    ready.set()
+    while True:
+        for key, _ in selector.select():
+            sock = key.fileobj
+            data, sender = sock.recvfrom(MAX_BUFFER_SIZE)
+            if rng.random() < loss:
+                continue
+            if key.data is None:
+                upstream = upstreams.get(sender)
+                if upstream is None:
+                    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    upstream.connect(server)
+                    selector.register(upstream, selectors.EVENT_READ, sender)
+                    upstreams[sender] = upstream
+                try:
+                    upstream.send(data)
+                except OSError:
+                    pass
+            else:
+                front.sendto(data, key.data)
+
+
+class ServerSampler:
+    """Samples CPU time and RSS of a process and its children from /proc."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._ticks = os.sysconf("SC_CLK_TCK")
+        self._page = os.sysconf("SC_PAGE_SIZE")
+
+    def start(self):
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling.
+
+        Returns:
+            dict: Mean CPU use in percent of one core, and mean and peak RSS
+            in bytes, or None if nothing could be read
+        """
+        self._stop.set()
+        self._thread.join()
+        if len(self.samples) < 2:
+            return None
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        rss = [sample[2] for sample in self.samples]
+        return {"cpu_percent": (cpu1 - cpu0) / (t1 - t0) * 100,
+                "rss_mean": sum(rss) // len(rss), "rss_peak": max(rss)}
+
+    def _loop(self):
+        while True:
+            sample = self._sample()
+            if sample is not None:
+                self.samples.append(sample)
+            if self._stop.wait(self.interval):
+                break
+
+    def _sample(self):
+        """Read (time, CPU seconds, RSS bytes) summed over the process tree."""
+        cpu = rss = 0
+        try:
+            for pid in self._tree(self.pid):
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self._ticks
+                with open(f"/proc/{pid}/statm") as f:
+                    rss += int(f.read().split()[1]) * self._page
+        except (OSError, ValueError, IndexError):
+            return None
+        return time.monotonic(), cpu, rss
+
+    def _tree(self, pid):
+        """List a process and its descendants."""
+        pids = [pid]
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            try:
+                with open(f"/proc/{pid}/task/{tid}/children") as f:
+                    for child in f.read().split():
+                        pids.extend(self._tree(int(child)))
+            except OSError:
+                pass
+        return pids
+
+
+def start_server(args, storage):
+    """Start the server under test.
+
+    Returns:
+        subprocess.Popen: The server process
+    """
+    if args.server_cmd:
+        command = shlex.split(args.server_cmd.format(port=args.port,
+                                                     dir=storage))
+    else:
+        command = [sys.executable,
+                   os.path.join(ROOT, args.protocol, "server.py"),
+                   "-p", str(args.port), "-d", storage]
+    command += shlex.split(args.server_args)
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, cwd=ROOT)
+
+
+def wait_for_server(args, address, process, timeout=15.0):
+    """Wait until a started server answers.
+
+    Returns:
+        bool: True once it is up
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        if args.protocol == "tcp":
+            try:
+                socket.create_connection(address, timeout=0.5).close()
+                return True
+            except OSError:
+                time.sleep(0.1)
+        else:
+            # No reply is expected from every server; give it a moment
+            time.sleep(1.0)
+            return True
+    return False
+
+
+def summarize(results, duration):
+    """Merge client process results.
+
+    Args:
+        results (list): Result dicts from client_process
+        duration (float): Measured seconds
+
+    Returns:
+        dict: Throughput, latency percentiles in milliseconds and histogram
+    """
+    latencies = array("d")
+    for result in results:
+        latencies.frombytes(result["latencies"])
+    ordered = sorted(latencies)
+    completed = sum(r["completed"] for r in results)
+    summary = {
+        "completed": completed,
+        "errors": sum(r["errors"] for r in results),
+        "unanswered": sum(r["unanswered"] for r in results),
+        "requests_per_sec": completed / duration,
+        "mb_per_sec": sum(r["bytes"] for r in results) / duration / 1e6,
+        "latency_ms": {},
+        "histogram": [],
+    }
+    if not ordered:
+        return summary
+    for p in PERCENTILES:
+        index = min(int(len(ordered) * p / 100), len(ordered) - 1)
+        summary["latency_ms"][f"p{p:g}"] = ordered[index] * 1000
+    summary["latency_ms"]["mean"] = sum(ordered) / len(ordered) * 1000
+    summary["latency_ms"]["max"] = ordered[-1] * 1000
+    counts = [0] * (len(BUCKETS) + 1)
+    b = 0
+    for value in ordered:
+        ms = value * 1000
+        while b < len(BUCKETS) and ms > BUCKETS[b]:
+            b += 1
+        counts[b] += 1
+    summary["histogram"] = [[BUCKETS[i] if i < len(BUCKETS) else None, n]
+                            for i, n in enumerate(counts) if n]
+    return summary
+
+
+def print_report(report):
+    """Print a run's results."""
+    r = report["results"]
+    print(f"{report['label'] or report['config']['protocol']}: "
+          f"{r['completed']} uploads in {report['config']['duration']:.1f}s, "
+          f"{r['errors']} errors, {r['unanswered']} unanswered")
+    print(f"  throughput  {r['requests_per_sec']:10.1f} req/s "
+          f"{r['mb_per_sec']:8.2f} MB/s")
+    latency = r["latency_ms"]
+    if latency:
+        print("  latency ms  " + "  ".join(
+            f"{key}={value:.2f}" for key, value in latency.items()))
+    total = r["completed"] or 1
+    for bound, count in r["histogram"]:
+        label = f"<= {bound:g} ms" if bound is not None else "slower"
+        bar = "#" * max(1, round(count / total * 50))
+        print(f"  {label:>12} {count:8} {bar}")
+    server = report.get("server")
+    if server:
+        print(f"  server      cpu={server['cpu_percent']:.0f}% "
+              f"rss mean={server['rss_mean'] / 2**20:.1f} MiB "
+              f"peak={server['rss_peak'] / 2**20:.1f} MiB")
+
+
+def compare(report, baseline):
+    """Print the change of key metrics against an earlier run."""
+    metrics = [("req/s", ("results", "requests_per_sec")),
+               ("MB/s", ("results", "mb_per_sec"))]
+    metrics += [(f"{p} ms", ("results", "latency_ms", p))
+                for p in ("p50", "p99", "p99.9")]
+    metrics += [("server cpu %", ("server", "cpu_percent")),
+                ("server rss peak MiB", ("server", "rss_peak"))]
+    print(f"compared with {baseline.get('label') or 'baseline'} "
+          f"({baseline.get('git') or 'unknown version'}):")
+    for name, path in metrics:
+        old, new = baseline, report
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if old is None or new is None:
+            continue
+        if "MiB" in name:
+            old, new = old / 2**20, new / 2**20
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {name:<20} {old:12.2f} -> {new:12.2f}  {change}")
+
+
+def git_version():
+    """Get the checked out commit, None outside a git repository."""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=ROOT, capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    """Run the benchmark.
+
+    Returns:
+        dict: The report, or None if the server could not be reached
+    """
+    storage = tempfile.TemporaryDirectory()
+    server = proxy = None
+    try:
+        if args.target:
+            host, _, port = args.target.rpartition(":")
+            address = (host or "127.0.0.1", int(port))
+        else:
+            address = ("127.0.0.1", args.port)
+            server = start_server(args, storage.name)
+        if not wait_for_server(args, address, server):
+            print(f"Server at {address[0]}:{address[1]} did not come up")
+            return None
+
+        if args.protocol == "udp" and args.loss > 0:
+            ready = multiprocessing.Event()
+            proxy = multiprocessing.Process(
+                target=loss_proxy,
+                args=(args.proxy_port, address, args.loss, ready), daemon=True)
+            proxy.start()
+            ready.wait(5.0)
+            address = ("127.0.0.1", args.proxy_port)
+
+        pid = server.pid if server is not None else args.server_pid
+        sampler = None
+        if pid and os.path.isdir(f"/proc/{pid}"):
+            sampler = ServerSampler(pid)
+
+        ready = multiprocessing.Queue()
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = []
+        per_process, extra = divmod(args.connections, args.processes)
+        first = 0
+        for i in range(args.processes):
+            count = per_process + (i < extra)
+            if not count:
+                continue
+            process = multiprocessing.Process(
+                target=client_process,
+                args=(args, address, first, count, ready, start, results))
+            process.start()
+            processes.append(process)
+            first += count
+        for _ in processes:
+            ready.get()
+        if sampler is not None:
+            sampler.start()
+        start.set()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        server_stats = sampler.stop() if sampler is not None else None
+    finally:
+        if proxy is not None:
+            proxy.terminate()
+            proxy.join()
+        if server is not None:
+            server.terminate()
+            server.wait()
+        storage.cleanup()
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("json", "compare", "label")}
+    return {
+        "version": RESULT_VERSION,
+        "label": args.label,
+        "git": git_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "config": config,
+        "results": summarize(collected, args.duration),
+        "server": server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server load benchmark")
+    parser.add_argument("protocol", choices=["tcp", "udp"])
+    parser.add_argument("-p", "--port", type=int, default=9180,
+                        help="Port to start the server on (default: 9180)")
+    parser.add_argument("--target",
+                        help="host:port of a running server to drive instead "
+                             "of starting one")
+    parser.add_argument("--server-pid", type=int,
+                        help="PID of the --target server, to sample its CPU "
+                             "and RSS")
+    parser.add_argument("--server-cmd",
+                        help="Command starting the server, with {port} and "
+                             "{dir} placeholders (default: the Python "
+                             "server)")
+    parser.add_argument("--server-args", default="",
+                        help="Extra server arguments, e.g. \"-e asyncio\"")
+    parser.add_argument("-c", "--connections", type=int, default=16)
+    parser.add_argument("-w", "--window", type=int, default=4,
+                        help="Uploads in flight per TCP connection "
+                             "(default: 4)")
+    parser.add_argument("-P", "--processes", type=int,
+                        default=min(os.cpu_count() or 1, 4),
+                        help="Client processes the connections are spread "
+                             "over")
+    parser.add_argument("-t", "--duration", type=float, default=10.0,
+                        help="Measured seconds (default: 10)")
+    parser.add_argument("--warmup", type=float, default=1.0,
+                        help="Seconds of load before measuring (default: 1)")
+    parser.add_argument("--drain", type=float, default=10.0,
+                        help="Seconds to wait for acknowledgements after the "
+                             "run (default: 10)")
+    parser.add_argument("--sizes", nargs="+", default=["1k:70", "16k:25",
+                                                       "256k:5"],
+                        help="Payload sizes with relative weights, as "
+                             "SIZE[:WEIGHT] (default: 1k:70 16k:25 256k:5)")
+    parser.add_argument("--names", type=int, default=16,
+                        help="Distinct DOT names per connection, reused to "
+                             "bound disk use (default: 16)")
+    parser.add_argument("--codec", choices=CODECS, default=CODEC_JSON)
+    parser.add_argument("--echo", action="store_true",
+                        help="Send legacy uploads acknowledged with an echo, "
+                             "as the Go servers expect")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="UDP only: fraction of datagrams a local proxy "
+                             "drops each way")
+    parser.add_argument("--proxy-port", type=int, default=9190)
+    parser.add_argument("--timeout", type=float, default=0.2,
+                        help="UDP retransmission timeout (default: 0.2)")
+    parser.add_argument("--retries", type=int, default=10)
+    parser.add_argument("--fragment-size", type=int, default=FRAGMENT_SIZE)
+    parser.add_argument("--label", help="Name of this run in reports")
+    parser.add_argument("--json", help="Write the results to this file, - "
+                                       "for stdout")
+    parser.add_argument("--compare", help="Results file of an earlier run to "
+                                          "compare with")
+    args = parser.parse_args()
+
+    report = run(args)
+    if report is None:
+        sys.exit(1)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Measure UDP server throughput in acknowledged packets per second.
+
+Starts udp/server.py once per --batch value and drives it with a closed loop
+of small uploads from several client sockets, each keeping a fixed number of
+requests in flight, then prints the acknowledgement rate for each run.
+
+Example:
+    python bench/udp_pps.py --batches 1 64 --duration 5
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import selectors
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+from utils import DOT, Message
+
+
+def run_load(port, clients, window, duration, timeout=0.5):
+    """Drive a running server and count acknowledgements.
+
+    Args:
+        port (int): Server port on localhost
+        clients (int): Number of client sockets
+        window (int): Requests kept in flight per socket
+        duration (float): Seconds to run
+        timeout (float): Seconds after which an unanswered request is
+            considered lost and replaced
+
+    Returns:
+        dict: sent, acked and lost counts and the elapsed time
+    """
+    address = ("127.0.0.1", port)
+    selector = selectors.DefaultSelector()
+    in_flight = {}
+    sent = acked = lost = 0
+
+    for i in range(clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(address)
+        selector.register(sock, selectors.EVENT_READ)
+        payload = json.dumps(Message(
+            command="store", dot=DOT(f"bench{i}", "digraph { a -> b; }")
+        ).to_dict()).encode("utf-8")
+        in_flight[sock] = [payload, 0, time.monotonic()]
+
+    start = time.monotonic()
+    deadline = start + duration
+
+    def top_up(sock, state):
+        nonlocal sent
+        while state[1] < window:
+            try:
+                sock.send(state[0])
+            except BlockingIOError:
+                break
+            state[1] += 1
+            sent += 1
+        state[2] = time.monotonic()
+
+    for sock, state in in_flight.items():
+        top_up(sock, state)
+
+    while time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=0.05):
+            sock = key.fileobj
+            state = in_flight[sock]
+            while True:
+                try:
+                    sock.recv(65535)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                acked += 1
+                state[1] = max(state[1] - 1, 0)
+            top_up(sock, state)
+
+        now = time.monotonic()
+        for sock, state in in_flight.items():
+            if state[1] and now - state[2] > timeout:
+                lost += state[1]
+                state[1] = 0
+                top_up(sock, state)
+
+    elapsed = time.monotonic() - start
+    for sock in in_flight:
+        selector.unregister(sock)
+        sock.close()
+    return {"sent": sent, "acked": acked, "lost": lost, "elapsed": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP server pps benchmark")
+    parser.add_argument("-p", "--port", type=int, default=9081)
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 64],
+                        help="Server --batch values to compare")
+    parser.add_argument("-c", "--clients", type=int, default=8)
+    parser.add_argument("-w", "--window", type=int, default=16)
+    parser.add_argument("-t", "--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as storage:
+        for batch in args.batches:
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, "udp", "server.py"),
+                 "-p", str(args.port), "-d", storage, "--batch", str(batch)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                time.sleep(1.0)
+                result = run_load(args.port, args.clients, args.window,
+                                  args.duration)
+            finally:
+                server.terminate()
+                server.wait()
+
+            pps = result["acked"] / result["elapsed"]
+            results.append(pps)
+            print(f"batch={batch:<4} acked={result['acked']:<8} "
+                  f"lost={result['lost']:<6} {pps:10.0f} pkt/s")
+
+    if len(results) > 1 and results[0]:
+        print(f"speedup: {results[-1] / results[0]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
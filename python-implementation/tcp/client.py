@@ -1,75 +1,214 @@
 #!/usr/bin/env python3
-"""TCP client for DOT files."""
+"""TCP client for DOT files, a command line over utils.client.DotClient."""
 
 import os
 import sys
-import socket
+import glob
+import json
 import argparse
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import DOT, receive_tcp, send_tcp
+from utils import log
+from utils.client import (ACKED, CONNECTIONS, FAILED, LOST, PATCHED, SKIPPED,
+                          STREAM_THRESHOLD, TIMEOUT, DotClient)
+from utils.codec import CODECS, CODEC_JSON
+from utils.compression import (
+    ALGORITHMS,
+    DEFAULT_THRESHOLD,
+    Compression,
+    load_dictionary,
+)
+
+
+def print_listing(entries):
+    """Print a listing.
+
+    Args:
+        entries (list): Entries from DotClient.list()
+    """
+    for entry in entries:
+        print(f"{entry['name']}\t{entry['size']}\t{entry['hash'][:12]}")
+
+
+def print_profile(result):
+    """Print the answer to a "profile" request.
+
+    Args:
+        result (dict): The reply's data, or None
+    """
+    if result is None:
+        return
+    if not result.get("started"):
+        print(f"Server is not profiling: {result.get('error')}")
+        return
+    print("Server is profiling into:")
+    for path in result["files"]:
+        print(f"  {path}")
+
+
+def send_dir(client, directory):
+    """Upload every DOT file in a directory over the client's connections.
+
+    Args:
+        client (DotClient): The client
+        directory (str): Directory containing .dot files
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "*.dot")))
+    before = client.results.copy()
+    client.upload_many(paths)
+    counts = client.results - before
+    uploaded = counts[ACKED] + counts[SKIPPED] + counts[PATCHED]
+    deltas = ""
+    if client.delta:
+        deltas = f", {counts[PATCHED]} sent as deltas"
+    print(f"Uploaded {uploaded}/{len(paths)} files "
+          f"({counts[FAILED] + counts[LOST]} failed, "
+          f"{counts[SKIPPED]} already stored{deltas})")
+
+
+def run_command(client, command):
+    """Execute one client command.
+
+    Args:
+        client (DotClient): The client
+        command (str): The command line
+    """
+    parts = command.split(" ", 1)
+    if parts[0] == "list":
+        entries = client.list(parts[1] if len(parts) > 1 else "")
+        if entries is not None:
+            print_listing(entries)
+            print(f"{len(entries)} DOTs")
+        return
+    if parts[0] == "stats":
+        stats = client.stats()
+        if stats is not None:
+            print(json.dumps(stats, indent=2))
+        return
+    if parts[0] == "profile":
+        options = parts[1].split() if len(parts) > 1 else []
+        seconds = next((int(o) for o in options if o.isdigit()), 0)
+        print_profile(client.profile(seconds, "memory" in options))
+        return
+    if len(parts) < 2:
+        print("Invalid command")
+        return
+
+    action, path = parts
+
+    if action == "get":
+        client.get(path)
+    elif action == "send":
+        client.upload(path)
+    elif action == "send-dir":
+        send_dir(client, path)
+    else:
+        print("Unknown command")
 
 
 def main():
     parser = argparse.ArgumentParser(description="TCP client")
-    parser.add_argument("-s", "--server", default="localhost:8080")
+    parser.add_argument("-s", "--server", default="localhost:8080",
+                        help="Server host:port; separate several with commas "
+                             "to spread uploads across them")
     parser.add_argument("-d", "--dir", default="client_storage")
+    parser.add_argument("-n", "--nodelay", action="store_true")
+    parser.add_argument("--stream-threshold", type=int,
+                        default=STREAM_THRESHOLD)
+    parser.add_argument("-w", "--window", type=int, default=8,
+                        help="Maximum uploads awaiting acknowledgment per "
+                             "connection")
+    parser.add_argument("-c", "--connections", type=int, default=CONNECTIONS,
+                        help=f"Maximum connections per server "
+                             f"(default: {CONNECTIONS})")
+    parser.add_argument("-t", "--timeout", type=float, default=TIMEOUT,
+                        help=f"Seconds to wait for a reply "
+                             f"(default: {TIMEOUT:g})")
+    parser.add_argument("--echo", action="store_true",
+                        help="Ask the server to echo each DOT back instead of "
+                             "a compact acknowledgment")
+    parser.add_argument("--codec", choices=CODECS, default=CODEC_JSON,
+                        help="Wire codec; binary needs a Python server "
+                             "(default: json)")
+    parser.add_argument("--compress", choices=ALGORITHMS,
+                        help="Compress uploads with this algorithm; needs a "
+                             "Python server")
+    parser.add_argument("--compress-level", type=int,
+                        help="Compression level (default: algorithm default)")
+    parser.add_argument("--compress-threshold", type=int,
+                        default=DEFAULT_THRESHOLD,
+                        help=f"Smallest message compressed, in bytes "
+                             f"(default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--dictionary",
+                        help="zlib preset dictionary, also loaded by the "
+                             "server (see utils/compression.py)")
+    parser.add_argument("--have-check", action="store_true",
+                        help="Skip uploading files whose content the server "
+                             "already has (needs a Python server)")
+    parser.add_argument("--delta", action="store_true",
+                        help="Send only the lines that changed since the "
+                             "last upload of each file, keeping copies in "
+                             "<dir>/.base (needs a Python server)")
+    parser.add_argument("command", nargs="*",
+                        help="Run a single command (e.g. send-dir <path>) "
+                             "and exit")
     args = parser.parse_args()
-    
-    os.makedirs(args.dir, exist_ok=True)
-    
-    host, port = args.server.split(":")
-    port = int(port)
-    
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
+    # Print every upload, however many there are
+    log.configure(rate=0)
+
+    compression = None
+    if args.compress:
+        zdict = None
+        if args.dictionary:
+            zdict = load_dictionary(args.dictionary)
+            if zdict is None:
+                return
+        try:
+            compression = Compression(args.compress, args.compress_level,
+                                      args.compress_threshold, zdict)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+
+    client = None
     try:
-        print(f"Connecting to {host}:{port}...")
-        client_socket.connect((host, port))
+        client = DotClient(args.server, args.dir, args.connections,
+                           args.window, args.timeout, retries=1,
+                           stream_threshold=args.stream_threshold,
+                           echo=args.echo, codec=args.codec,
+                           compression=compression,
+                           have_check=args.have_check, delta=args.delta,
+                           nodelay=args.nodelay)
+        print(f"Connecting to {args.server}...")
+        if not client.check():
+            return
         print(f"Connected! Files: {args.dir}")
-        print("\nCommands: send <file>, exit\n")
-        
+
+        if args.command:
+            run_command(client, " ".join(args.command))
+            return
+
+        print("\nCommands: send <file>, send-dir <dir>, get <name>, "
+              "list [prefix], stats, profile [seconds] [memory], exit\n")
+
         while True:
             command = input("> ")
             if not command:
                 continue
-                
+
             if command == "exit":
                 break
-                
-            parts = command.split(" ", 1)
-            if len(parts) < 2:
-                print("Invalid command")
-                continue
-                
-            action, file_path = parts
-            
-            if action == "send":
-                dot = DOT.load(file_path)
-                if not dot:
-                    print(f"Error loading: {file_path}")
-                    continue
-                    
-                send_tcp(client_socket, dot)
-                print(f"Sent '{dot.name}'")
-                
-                ack_dot = receive_tcp(client_socket)
-                if not ack_dot:
-                    print("No acknowledgment")
-                    continue
-                    
-                ack_dot.save(args.dir)
-                print(f"Saved '{ack_dot.name}' locally")
-            else:
-                print("Unknown command")
+
+            run_command(client, command)
     except KeyboardInterrupt:
         print("\nExiting...")
     except Exception as e:
         print(f"Error: {e}")
     finally:
-        client_socket.close()
+        if client is not None:
+            client.close()
 
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
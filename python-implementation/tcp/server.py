@@ -3,69 +3,975 @@
 
 import os
 import sys
+import time
+import signal
 import socket
+import asyncio
 import threading
 import argparse
 import glob
 import traceback
+import multiprocessing
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import DOT, list_dots, receive_tcp, send_tcp
+from utils import (
+    DOT,
+    ContentDigest,
+    FrameReader,
+    Message,
+    receive_message,
+    send_message,
+    send_tcp,
+    send_tcp_stream,
+    send_tcp_file,
+    receive_message_async,
+    send_message_async,
+    send_tcp_async,
+    send_tcp_stream_async,
+    send_tcp_file_async,
+    set_nodelay,
+)
+from utils import log
+from utils.compression import load_dictionary
+from utils.cache import (DEFAULT_CACHE_SIZE, SENDFILE_THRESHOLD, DotCache,
+                         answer_get, answer_list, open_raw)
+from utils.catalog import Catalog
+from utils.delta import resolve_delta
+from utils.graph import DotParser, answer_invalid, check_dot
+from utils.metrics import Metrics, answer_stats, timed
+from utils.profiling import (PROFILE_SECONDS, Profiler, answer_profile,
+                             install_signals)
+from utils.storage import ContentStore
+from utils.writer import (DURABILITY_MODES, DURABILITY_NONE, GROUP_INTERVAL,
+                          WRITE_QUEUE, WRITE_WORKERS, FileWriter, WritePool)
+from utils.protocol import MAX_FRAME_SIZE
 
 
-def handle_client(client_socket, client_address, storage_dir, verbose=False):
+def wants_compact_ack(msg, echo_acks=False):
+    """Decide whether a request is acknowledged compactly.
+
+    Clients opt in with the "store" command; streamed uploads and deltas are
+    always acknowledged compactly. Legacy requests get the full DOT echoed
+    back.
+
+    Args:
+        msg (Message): The upload request
+        echo_acks (bool): Force full echo acknowledgements
+
+    Returns:
+        bool: True for a compact acknowledgement
+    """
+    if echo_acks:
+        return False
+    return msg.command in ("store", "delta") or msg.dot.is_streamed
+
+
+def answer_save_failed(msg, dot):
+    """Build the reply to an upload that could not be saved.
+
+    It is an "invalid" ack, so clients retire the request as failed instead
+    of waiting for an acknowledgment that never comes.
+
+    Args:
+        msg (Message): The upload request
+        dot (DOT): The DOT that was not saved
+
+    Returns:
+        Message: The failure acknowledgment
+    """
+    return Message("ack", "invalid", dot.name, data="save failed",
+                   id_=msg.id, codec=msg.codec, compression=msg.compression)
+
+
+def answer_have(msg, store=None, catalog=None):
+    """Answer a client asking whether its content is already stored.
+
+    If the store has content with the given hash and size, the name is
+    pointed at it and the reply is the acknowledgement the upload would have
+    produced, so the client can skip sending it. Otherwise the reply is a
+    "missing" message and the client uploads as usual.
+
+    Args:
+        msg (Message): The "have" request, carrying name, size and hash
+        store (ContentStore): The deduplicating store, if enabled
+        catalog (Catalog): Index to record an adopted name in
+
+    Returns:
+        Message: The reply
+    """
+    if store is not None and msg.name and store.adopt(msg.name, msg.hash,
+                                                      msg.size):
+        if catalog is not None:
+            catalog.update(msg.name, msg.hash)
+        return Message("ack", "acknowledge", msg.name, id_=msg.id,
+                       size=msg.size, hash_=msg.hash, codec=msg.codec,
+                       compression=msg.compression)
+    return Message("ack", "missing", msg.name, id_=msg.id, codec=msg.codec,
+                   compression=msg.compression)
+
+
+def answer_request(msg, storage_dir, store=None, catalog=None, cache=None,
+                   metrics=None, profiler=None):
+    """Answer a request that does not upload a DOT.
+
+    Args:
+        msg (Message): A "have", "get", "list", "stats" or "profile" request
+        storage_dir (str): Directory DOT files are stored in
+        store (ContentStore): The deduplicating store, if enabled
+        catalog (Catalog): Index of the stored DOTs
+        cache (DotCache): Cache for get requests, or None
+        metrics (Metrics): The server's metrics, for stats requests
+        profiler (Profiler): The server's profiler, None if disabled
+
+    Returns:
+        Message: The reply
+    """
+    if msg.command == "stats":
+        return answer_stats(msg, metrics or Metrics())
+    if msg.command == "profile":
+        return answer_profile(msg, profiler)
+    if msg.command == "have":
+        return answer_have(msg, store, catalog)
+    if msg.command == "get":
+        return answer_get(msg, storage_dir, catalog, cache)
+    return answer_list(msg, catalog)
+
+
+class ConnectionTracker:
+    """Tracks a worker's open connections so it can drain them on shutdown.
+
+    Once draining starts, connections idle between requests are shut down;
+    a connection in the middle of an upload finishes that request and then
+    closes itself.
+    """
+
+    def __init__(self):
+        """Initialize a ConnectionTracker."""
+        self.cond = threading.Condition()
+        self.readers = set()
+        self.draining = False
+
+    def add(self, reader):
+        """Register a connection's FrameReader."""
+        with self.cond:
+            self.readers.add(reader)
+
+    def remove(self, reader):
+        """Forget a closed connection."""
+        with self.cond:
+            self.readers.discard(reader)
+            self.cond.notify_all()
+
+    def drain(self, timeout):
+        """Close idle connections and wait for busy ones to finish.
+
+        Args:
+            timeout (float): Seconds to wait for in-flight uploads
+
+        Returns:
+            int: Number of connections still open at the deadline
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.draining = True
+            while self.readers:
+                for reader in self.readers:
+                    if reader.waiting:
+                        try:
+                            reader.sock.shutdown(socket.SHUT_RD)
+                        except OSError:
+                            pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Wake up periodically to catch connections that went idle
+                self.cond.wait(min(remaining, 0.1))
+            return len(self.readers)
+
+
+def save_dot(dot, storage_dir, store=None, file_writer=None, catalog=None):
+    """Save a received DOT and hash its content for the acknowledgment.
+
+    Args:
+        dot (DOT): The DOT; streamed content is consumed
+        storage_dir (str): Directory to store DOT files
+        store (ContentStore): Deduplicating store to save it in instead
+        file_writer (FileWriter): Writer deciding durability
+        catalog (Catalog): Index to record the saved DOT in
+
+    Returns:
+        ContentDigest: Size and hash of the content, or None on error
+    """
+    if store is not None:
+        digest = store.save(dot)
+    else:
+        if dot.is_streamed:
+            digest = ContentDigest()
+            dot.content = digest.wrap(dot.content)
+        else:
+            digest = dot.digest()
+        if not dot.save(storage_dir, file_writer):
+            digest = None
+    if digest is not None and catalog is not None:
+        catalog.update(dot.name, digest.hexdigest)
+    return digest
+
+
+def handle_client(client_socket, client_address, storage_dir, verbose=False,
+                  slots=None, max_frame_size=MAX_FRAME_SIZE, echo_acks=False,
+                  tracker=None, store=None, file_writer=None, pool=None,
+                  catalog=None, cache=None,
+                  sendfile_threshold=SENDFILE_THRESHOLD, validate=False,
+                  metrics=None, profiler=None):
     """Handle a client connection.
 
+    With a writer pool, each upload is saved on a writer thread while this
+    thread reads the next request, and its acknowledgment is sent once the
+    save has finished. Streamed uploads are always saved here, as they are
+    read.
+
     Args:
         client_socket (socket): The client socket
         client_address (tuple): The client address (host, port)
         storage_dir (str): Directory to store DOT files
         verbose (bool): Whether to enable verbose logging
+        slots (threading.BoundedSemaphore): Connection slot to release on exit
+        max_frame_size (int): Largest frame accepted from the client
+        echo_acks (bool): Always echo the full DOT as acknowledgement
+        tracker (ConnectionTracker): Drain state of the worker process
+        store (ContentStore): Deduplicating store to save DOTs in instead
+            of writing storage_dir/<name>.dot directly
+        file_writer (FileWriter): Writer deciding durability of saved DOTs
+        pool (WritePool): Writer threads to save on, or None to save inline
+        catalog (Catalog): Index kept current with saved DOTs, and used to
+            answer get and list requests
+        cache (DotCache): Cache for get requests, or None
+        sendfile_threshold (int): Smallest DOT sent as raw bytes to clients
+            that accept it, 0 to always answer get from the cache
+        validate (bool): Parse uploads and reject those that are not valid
+            graphs
+        metrics (Metrics): Counters and stage timings to record, or None
+        profiler (Profiler): Started by profile requests, None if disabled
     """
-    print(f"New connection from {client_address}")
-    
+    log.info("New connection from %s", client_address)
+    if metrics is not None:
+        metrics.connected()
+    reader = FrameReader(client_socket)
+    if tracker is not None:
+        tracker.add(reader)
+    # Acknowledgments may be sent from writer threads
+    send_lock = threading.Lock()
+    failed = threading.Event()
+    pending = []
+
+    def acknowledge(msg, dot, digest):
+        """Send the acknowledgment for a saved DOT."""
+        path = os.path.join(storage_dir, dot.name + '.dot')
+        if digest is None:
+            log.error("Error saving DOT %s", dot.name)
+            if metrics is not None:
+                metrics.error()
+            with send_lock:
+                sent = send_message(client_socket,
+                                    answer_save_failed(msg, dot), metrics)
+            if not sent:
+                log.error("Error sending acknowledgment to %s",
+                          client_address)
+            return sent
+        log.info("Successfully saved DOT to %s", path)
+        log.debug("Sending acknowledgment to %s", client_address)
+
+        # Send acknowledgment back in the request's codec and
+        # compression, streaming an echo if it arrived streamed
+        start = time.perf_counter()
+        with send_lock:
+            if wants_compact_ack(msg, echo_acks):
+                sent = send_message(client_socket, Message.ack(
+                    dot.name, digest, msg.id, msg.codec, msg.compression),
+                    metrics)
+            elif dot.is_streamed:
+                sent = send_tcp_stream(client_socket, DOT.stream(path),
+                                       msg_id=msg.id, codec=msg.codec)
+            else:
+                sent = send_tcp(client_socket, dot, msg.id, codec=msg.codec,
+                                compression=msg.compression)
+        if metrics is not None:
+            metrics.observe("ack", time.perf_counter() - start)
+        if not sent:
+            log.error("Error sending acknowledgment to %s", client_address)
+            return False
+        log.info("Sent acknowledgment for DOT '%s' to %s", dot.name,
+                 client_address)
+        return True
+
+    def on_saved(future, msg, dot, done):
+        """Writer pool callback: acknowledge a DOT saved in the background."""
+        try:
+            digest = future.result()
+        except Exception as e:
+            log.error("Error saving DOT %s: %s", dot.name, e)
+            digest = None
+        try:
+            if not acknowledge(msg, dot, digest):
+                failed.set()
+                # Wake the reading thread so the connection closes
+                try:
+                    client_socket.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        finally:
+            done.set()
+
     try:
-        while True:
-            if verbose:
-                print(f"Waiting for data from {client_address}...")
-            
+        while not failed.is_set():
+            if tracker is not None and tracker.draining:
+                log.info("Draining, closing connection to %s", client_address)
+                break
+
+            log.debug("Waiting for data from %s...", client_address)
+
             # Receive DOT from client
-            dot = receive_tcp(client_socket)
-            if not dot:
-                print(f"Client {client_address} disconnected")
+            msg = receive_message(client_socket, reader, max_frame_size,
+                                  metrics)
+            if not msg:
+                log.info("Client %s disconnected", client_address)
                 break
-            
-            print(f"Received DOT '{dot.name}' from {client_address}")
-            
+            if metrics is not None:
+                metrics.request(msg.command)
+
+            if msg.command in ("have", "get", "list", "stats", "profile"):
+                if msg.command in ("get", "list"):
+                    # Reads see this connection's earlier uploads
+                    for done in pending:
+                        done.wait()
+                opened = None
+                if msg.command == "get" and sendfile_threshold:
+                    opened = open_raw(msg, storage_dir, catalog,
+                                      sendfile_threshold)
+                if opened is not None:
+                    f, header = opened
+                    with f, send_lock:
+                        sent = send_tcp_file(client_socket, header, f,
+                                             header.size)
+                    if sent and metrics is not None:
+                        metrics.sent(header.size)
+                else:
+                    reply = answer_request(msg, storage_dir, store, catalog,
+                                           cache, metrics, profiler)
+                    with send_lock:
+                        sent = send_message(client_socket, reply, metrics)
+                if not sent:
+                    break
+                continue
+
+            if msg.command == "delta":
+                # The base may be one of this connection's earlier uploads
+                for done in pending:
+                    done.wait()
+                msg.dot = resolve_delta(msg, storage_dir, catalog, cache)
+                if not msg.dot:
+                    if msg.dot is False and metrics is not None:
+                        metrics.error()
+                    # Ask for the full DOT instead
+                    with send_lock:
+                        sent = send_message(client_socket, Message(
+                            "ack", "missing", msg.name, id_=msg.id,
+                            codec=msg.codec, compression=msg.compression),
+                            metrics)
+                    if not sent:
+                        break
+                    continue
+
+            dot = msg.dot
+            if not dot:
+                log.warning("Message from %s does not contain a DOT",
+                            client_address)
+                continue
+
+            log.info("Received DOT '%s' from %s", dot.name, client_address)
+
+            parser = None
+            if validate and dot.is_streamed:
+                # Parsed while it is saved, and rejected once it has ended
+                parser = DotParser()
+                dot.content = parser.wrap(dot.content)
+            elif validate:
+                error = timed(metrics, "validate", check_dot, dot)
+                if error is not None:
+                    if metrics is not None:
+                        metrics.error()
+                    with send_lock:
+                        sent = send_message(client_socket,
+                                            answer_invalid(msg, error), metrics)
+                    if not sent:
+                        break
+                    continue
+
+            if pool is not None and not dot.is_streamed:
+                # Blocks while the pool's queue is full, which stops reading
+                # from this client until the disk catches up
+                done = threading.Event()
+                pending[:] = [event for event in pending if not event.is_set()]
+                pending.append(done)
+                future = pool.submit(timed, metrics, "save", save_dot, dot,
+                                     storage_dir, store, file_writer, catalog)
+                future.add_done_callback(
+                    lambda f, msg=msg, dot=dot, done=done:
+                    on_saved(f, msg, dot, done))
+                continue
+
             # Save the DOT to storage
-            if not dot.save(storage_dir):
-                print(f"Error saving DOT {dot.name}")
+            digest = timed(metrics, "save", save_dot, dot, storage_dir, store,
+                           file_writer, catalog)
+            if parser is not None and parser.error is not None:
+                # The stream was read to its end, so the connection goes on
+                if metrics is not None:
+                    metrics.error()
+                with send_lock:
+                    sent = send_message(client_socket,
+                                        answer_invalid(msg, parser.error),
+                                        metrics)
+                if not sent:
+                    break
                 continue
-            else:
-                print(f"Successfully saved DOT to {os.path.join(storage_dir, dot.name + '.dot')}")
-            
-            if verbose:
-                print(f"Sending acknowledgment to {client_address}")
-                
-            # Send acknowledgment back
-            if not send_tcp(client_socket, dot):
-                print(f"Error sending acknowledgment to {client_address}")
+            if digest is None and dot.is_streamed:
+                # The rest of the stream is still unread, so the connection
+                # closes once the client knows the upload failed
+                acknowledge(msg, dot, digest)
+                break
+            if not acknowledge(msg, dot, digest):
                 break
-                
-            print(f"Sent acknowledgment for DOT '{dot.name}' to {client_address}")
     except ConnectionResetError:
-        print(f"Connection reset by client {client_address}")
+        log.info("Connection reset by client %s", client_address)
     except Exception as e:
-        print(f"Error handling client {client_address}: {e}")
+        log.error("Error handling client %s: %s", client_address, e)
         if verbose:
             traceback.print_exc()
     finally:
+        # Let saves still in the pool send their acknowledgments
+        for done in pending:
+            done.wait()
         try:
             client_socket.close()
-            print(f"Closed connection to {client_address}")
+            log.info("Closed connection to %s", client_address)
         except:
             pass
+        if metrics is not None:
+            metrics.disconnected()
+        if tracker is not None:
+            tracker.remove(reader)
+        if slots is not None:
+            slots.release()
+
+
+async def handle_client_async(reader, writer, storage_dir, verbose=False,
+                              slots=None, max_frame_size=MAX_FRAME_SIZE,
+                              echo_acks=False, store=None, file_writer=None,
+                              pool=None, catalog=None, cache=None,
+                              sendfile_threshold=SENDFILE_THRESHOLD,
+                              validate=False, metrics=None, profiler=None):
+    """Handle a client connection on the asyncio engine.
+
+    With a writer pool, whole uploads are saved on a writer thread so the
+    event loop keeps serving other connections while the disk is busy.
+
+    Args:
+        reader (asyncio.StreamReader): The client stream reader
+        writer (asyncio.StreamWriter): The client stream writer
+        storage_dir (str): Directory to store DOT files
+        verbose (bool): Whether to enable verbose logging
+        slots (asyncio.Semaphore): Connection slot to release on exit
+        max_frame_size (int): Largest frame accepted from the client
+        echo_acks (bool): Always echo the full DOT as acknowledgement
+        store (ContentStore): Deduplicating store to save DOTs in
+        file_writer (FileWriter): Writer deciding durability of saved DOTs
+        pool (WritePool): Writer threads to save on, or None to save on the
+            event loop
+        catalog (Catalog): Index kept current with saved DOTs, and used to
+            answer get and list requests
+        cache (DotCache): Cache for get requests, or None
+        sendfile_threshold (int): Smallest DOT sent as raw bytes to clients
+            that accept it, 0 to always answer get from the cache
+        validate (bool): Parse uploads and reject those that are not valid
+            graphs
+        metrics (Metrics): Counters and stage timings to record, or None
+        profiler (Profiler): Started by profile requests, None if disabled
+    """
+    client_address = writer.get_extra_info("peername")
+
+    log.info("New connection from %s", client_address)
+    if metrics is not None:
+        metrics.connected()
+
+    try:
+        while True:
+            msg = await receive_message_async(reader, max_frame_size, metrics)
+            if not msg:
+                log.info("Client %s disconnected", client_address)
+                break
+            if metrics is not None:
+                metrics.request(msg.command)
+
+            if msg.command == "get" and sendfile_threshold:
+                opened = open_raw(msg, storage_dir, catalog,
+                                  sendfile_threshold)
+                if opened is not None:
+                    f, header = opened
+                    with f:
+                        if not await send_tcp_file_async(writer, header, f,
+                                                         header.size):
+                            break
+                    if metrics is not None:
+                        metrics.sent(header.size)
+                    continue
+
+            if msg.command in ("have", "get", "list", "stats", "profile"):
+                if pool is not None and msg.command in ("have", "get"):
+                    # Both may touch the disk
+                    reply = await pool.run(answer_request, msg, storage_dir,
+                                           store, catalog, cache)
+                else:
+                    reply = answer_request(msg, storage_dir, store, catalog,
+                                           cache, metrics, profiler)
+                if not await send_message_async(writer, reply, metrics):
+                    break
+                continue
+
+            if msg.command == "delta":
+                if pool is not None:
+                    # Reading the base may touch the disk
+                    msg.dot = await pool.run(resolve_delta, msg, storage_dir,
+                                             catalog, cache)
+                else:
+                    msg.dot = resolve_delta(msg, storage_dir, catalog, cache)
+                if not msg.dot:
+                    if msg.dot is False and metrics is not None:
+                        metrics.error()
+                    # Ask for the full DOT instead
+                    if not await send_message_async(writer, Message(
+                            "ack", "missing", msg.name, id_=msg.id,
+                            codec=msg.codec, compression=msg.compression),
+                            metrics):
+                        break
+                    continue
+
+            dot = msg.dot
+            if not dot:
+                log.warning("Message from %s does not contain a DOT",
+                            client_address)
+                continue
+
+            log.info("Received DOT '%s' from %s", dot.name, client_address)
+
+            parser = None
+            if validate and dot.is_streamed:
+                # Parsed while it is saved, and rejected once it has ended
+                parser = DotParser()
+                dot.content = parser.wrap_async(dot.content)
+            elif validate:
+                if pool is not None:
+                    # Keeps large DOTs from stalling other connections
+                    error = await pool.run(timed, metrics, "validate",
+                                           check_dot, dot)
+                else:
+                    error = timed(metrics, "validate", check_dot, dot)
+                if error is not None:
+                    if metrics is not None:
+                        metrics.error()
+                    if not await send_message_async(
+                            writer, answer_invalid(msg, error), metrics):
+                        break
+                    continue
+
+            compact = wants_compact_ack(msg, echo_acks)
+            start = time.perf_counter()
+            if pool is not None and not dot.is_streamed:
+                digest = await pool.run(save_dot, dot, storage_dir, store,
+                                        file_writer, catalog)
+            else:
+                if store is not None:
+                    digest = await store.save_async(dot)
+                else:
+                    if dot.is_streamed:
+                        digest = ContentDigest()
+                        dot.content = digest.wrap_async(dot.content)
+                    else:
+                        digest = dot.digest()
+                    if not await dot.save_async(storage_dir, file_writer):
+                        digest = None
+                if digest is not None and catalog is not None:
+                    catalog.update(dot.name, digest.hexdigest)
+            if metrics is not None:
+                metrics.observe("save", time.perf_counter() - start)
+            if parser is not None and parser.error is not None:
+                # The stream was read to its end, so the connection goes on
+                if metrics is not None:
+                    metrics.error()
+                if not await send_message_async(
+                        writer, answer_invalid(msg, parser.error), metrics):
+                    break
+                continue
+            if digest is None:
+                log.error("Error saving DOT %s", dot.name)
+                if metrics is not None:
+                    metrics.error()
+                if not await send_message_async(
+                        writer, answer_save_failed(msg, dot), metrics):
+                    break
+                if dot.is_streamed:
+                    # The rest of the stream is still unread
+                    break
+                continue
+
+            start = time.perf_counter()
+            if compact:
+                sent = await send_message_async(writer, Message.ack(
+                    dot.name, digest, msg.id, msg.codec, msg.compression),
+                    metrics)
+            elif dot.is_streamed:
+                path = os.path.join(storage_dir, dot.name + ".dot")
+                sent = await send_tcp_stream_async(writer, DOT.stream(path),
+                                                   msg_id=msg.id,
+                                                   codec=msg.codec)
+            else:
+                sent = await send_tcp_async(writer, dot, msg.id,
+                                            codec=msg.codec,
+                                            compression=msg.compression)
+            if metrics is not None:
+                metrics.observe("ack", time.perf_counter() - start)
+            if not sent:
+                log.error("Error sending acknowledgment to %s", client_address)
+                break
+
+            log.info("Sent acknowledgment for DOT '%s' to %s", dot.name,
+                     client_address)
+    except Exception as e:
+        log.error("Error handling client %s: %s", client_address, e)
+        if verbose:
+            traceback.print_exc()
+    finally:
+        writer.close()
+        log.info("Closed connection to %s", client_address)
+        if metrics is not None:
+            metrics.disconnected()
+        if slots is not None:
+            slots.release()
+
+
+def listen(args):
+    """Create the listening socket.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+
+    Returns:
+        socket: A bound, listening socket
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server_socket.bind(("0.0.0.0", args.port))
+        server_socket.listen(args.backlog)
+    except Exception:
+        server_socket.close()
+        raise
+    return server_socket
+
+
+def start_pool(args):
+    """Create the writer pool asked for on the command line.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+
+    Returns:
+        WritePool: The pool, or None if saves run inline
+    """
+    if args.writers <= 0:
+        return None
+    pool = WritePool(args.writers, args.write_queue)
+    if args.stats_interval > 0:
+        pool.report(args.stats_interval, f"Writer pool {os.getpid()}")
+    return pool
+
+
+def start_cache(args, catalog):
+    """Create the cache for get requests asked for on the command line.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        catalog (Catalog): Index whose updates invalidate cached DOTs
+
+    Returns:
+        DotCache: The cache, or None if disabled
+    """
+    if args.cache_size <= 0:
+        return None
+    cache = DotCache(args.cache_size)
+    if catalog is not None:
+        catalog.add_listener(cache.invalidate)
+    if args.stats_interval > 0:
+        cache.report(args.stats_interval, f"Cache {os.getpid()}")
+    return cache
+
+
+def start_metrics(args, pool=None, cache=None, worker=None):
+    """Create the metrics, serving them if asked on the command line.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        pool (WritePool): Writer pool whose stats are exported, if any
+        cache (DotCache): Cache whose stats are exported, if any
+        worker (int): Worker number, which offsets the metrics port
+
+    Returns:
+        Metrics: The metrics
+    """
+    metrics = Metrics()
+    if pool is not None:
+        metrics.add_source("writer", pool.stats)
+    if cache is not None:
+        metrics.add_source("cache", cache.stats)
+    if args.metrics_port:
+        port = args.metrics_port + (worker or 0)
+        if metrics.serve(port) is not None:
+            print(f"Metrics at http://0.0.0.0:{port}/metrics")
+    if args.stats_interval > 0:
+        metrics.report(args.stats_interval, f"Metrics {os.getpid()}")
+    return metrics
+
+
+def start_profiler(args):
+    """Create the profiler if asked on the command line.
+
+    Installs the SIGUSR1 and SIGUSR2 handlers, so it must be called from
+    the main thread.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+
+    Returns:
+        Profiler: The profiler, or None if profiling is disabled
+    """
+    if not args.profile_dir:
+        return None
+    profiler = Profiler(args.profile_dir, args.profile_seconds)
+    install_signals(profiler)
+    return profiler
+
+
+def accept_loop(server_socket, args, tracker=None, catalog=None, worker=None):
+    """Accept connections forever, handling each in a new thread.
+
+    Args:
+        server_socket (socket): The listening socket
+        args (argparse.Namespace): Parsed command line arguments
+        tracker (ConnectionTracker): Drain state of the worker process
+        catalog (Catalog): Index kept current with saved DOTs
+        worker (int): Number of the worker process, None without workers
+    """
+    slots = None
+    if args.max_connections:
+        slots = threading.BoundedSemaphore(args.max_connections)
+    file_writer = FileWriter(args.durability, args.group_commit_ms / 1000)
+    store = ContentStore(args.dir, file_writer) if args.dedup else None
+    pool = start_pool(args)
+    cache = start_cache(args, catalog)
+    metrics = start_metrics(args, pool, cache, worker)
+    profiler = start_profiler(args)
+
+    while True:
+        # Leave extra connections in the kernel backlog when at the limit
+        if slots is not None:
+            slots.acquire()
+        client_socket, client_address = server_socket.accept()
+        if args.nodelay:
+            set_nodelay(client_socket)
+        # Handle client in a new thread
+        client_thread = threading.Thread(
+            target=handle_client,
+            args=(client_socket, client_address, args.dir, args.verbose,
+                  slots, args.max_frame_size, args.echo_acks, tracker, store,
+                  file_writer, pool, catalog, cache, args.sendfile_threshold,
+                  args.validate, metrics, profiler)
+        )
+        client_thread.daemon = True
+        client_thread.start()
+
+
+def serve_threads(args, catalog=None):
+    """Run the server with one thread per connection.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        catalog (Catalog): Index kept current with saved DOTs
+    """
+    server_socket = listen(args)
+    try:
+        print(f"TCP Server listening on port {args.port}")
+        print(f"DOTs stored in {args.dir}")
+        accept_loop(server_socket, args, catalog=catalog)
+    finally:
+        server_socket.close()
+
+
+class _Drain(Exception):
+    """Raised in a worker's main thread when it is asked to stop."""
+
+
+def _run_worker(server_socket, args, worker, catalog=None):
+    """Entry point of a worker process.
+
+    Accepts on the inherited listening socket until SIGTERM, then stops
+    accepting and lets in-flight uploads finish before exiting.
+    """
+    def drain(signum, frame):
+        raise _Drain
+
+    # Let the supervisor decide when to stop on Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, drain)
+    tracker = ConnectionTracker()
+
+    try:
+        accept_loop(server_socket, args, tracker, catalog, worker)
+    except _Drain:
+        pass
+    finally:
+        # A second SIGTERM skips the drain
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server_socket.close()
+
+    print(f"Worker {worker} draining connections")
+    left = tracker.drain(args.drain_timeout)
+    if left:
+        print(f"Worker {worker} exiting with {left} connections still open")
+    else:
+        print(f"Worker {worker} drained")
+
+
+def supervise(args, catalog=None):
+    """Run args.workers worker processes sharing one listening socket.
+
+    The socket is created here and inherited by forked workers, so the
+    kernel spreads connections across them. Workers that die are restarted.
+    On shutdown every worker is sent SIGTERM and given args.drain_timeout
+    seconds to finish in-flight uploads.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        catalog (Catalog): Index inherited by the workers
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        print("Error: --workers needs fork, which this platform lacks")
+        return
+
+    context = multiprocessing.get_context("fork")
+    server_socket = listen(args)
+    workers = [None] * args.workers
+
+    def start(i):
+        process = context.Process(target=_run_worker,
+                                  args=(server_socket, args, i, catalog),
+                                  daemon=True)
+        process.start()
+        workers[i] = process
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    def forward(signum, frame):
+        # Each worker profiles itself
+        for process in workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    if args.profile_dir and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+    print(f"TCP Server listening on port {args.port} with {args.workers} workers")
+    print(f"DOTs stored in {args.dir}")
+
+    try:
+        for i in range(args.workers):
+            start(i)
+        while True:
+            time.sleep(0.5)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    print(f"Worker {i} exited with code {process.exitcode}, "
+                          f"restarting")
+                    start(i)
+    except KeyboardInterrupt:
+        print("\nShutting down server...")
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + args.drain_timeout + 1.0
+        for process in workers:
+            if process is not None:
+                process.join(max(deadline - time.monotonic(), 0))
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+        server_socket.close()
+
+
+async def serve_asyncio(args, catalog=None):
+    """Run the server on a single asyncio event loop.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        catalog (Catalog): Index kept current with saved DOTs
+    """
+    slots = None
+    if args.max_connections:
+        slots = asyncio.Semaphore(args.max_connections)
+    file_writer = FileWriter(args.durability, args.group_commit_ms / 1000)
+    store = ContentStore(args.dir, file_writer) if args.dedup else None
+    pool = start_pool(args)
+    cache = start_cache(args, catalog)
+    metrics = start_metrics(args, pool, cache)
+    profiler = start_profiler(args)
+
+    async def on_connect(client_socket):
+        if args.nodelay:
+            set_nodelay(client_socket)
+        try:
+            reader, writer = await asyncio.open_connection(sock=client_socket)
+        except OSError as e:
+            log.error("Error opening connection: %s", e)
+            client_socket.close()
+            if slots is not None:
+                slots.release()
+            return
+        await handle_client_async(reader, writer, args.dir, args.verbose, slots,
+                                  args.max_frame_size, args.echo_acks, store,
+                                  file_writer, pool, catalog, cache,
+                                  args.sendfile_threshold, args.validate,
+                                  metrics, profiler)
+
+    server_socket = listen(args)
+    server_socket.setblocking(False)
+    loop = asyncio.get_running_loop()
+    print(f"TCP Server (asyncio) listening on port {args.port}")
+    print(f"DOTs stored in {args.dir}")
+
+    # Keeps the connection tasks referenced until they finish
+    tasks = set()
+    with server_socket:
+        while True:
+            # Leave extra connections in the kernel backlog when at the limit
+            if slots is not None:
+                await slots.acquire()
+            client_socket, _ = await loop.sock_accept(server_socket)
+            task = loop.create_task(on_connect(client_socket))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
 
 def main():
@@ -78,42 +984,126 @@ def main():
                         help="Directory to store DOT files (default: server_storage)")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable verbose output")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Only log warnings and errors, not every "
+                             "connection and message")
+    parser.add_argument("--log-level", choices=list(log.LEVELS),
+                        help="Least severe messages logged (default: info, "
+                             "debug with -v, warning with -q)")
+    parser.add_argument("--log-rate", type=int, default=log.RATE_LIMIT,
+                        help=f"Messages of one kind logged per second, 0 "
+                             f"for no limit (default: {log.RATE_LIMIT})")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve Prometheus metrics over HTTP on this "
+                             "port, plus the worker number with --workers "
+                             "(default: 0, off)")
+    parser.add_argument("-e", "--engine", choices=["thread", "asyncio"],
+                        default="thread",
+                        help="Connection handling engine (default: thread)")
+    parser.add_argument("-b", "--backlog", type=int, default=128,
+                        help="Listen backlog (default: 128)")
+    parser.add_argument("-m", "--max-connections", type=int, default=0,
+                        help="Maximum concurrent connections, 0 for no limit "
+                             "(default: 0)")
+    parser.add_argument("-n", "--nodelay", action="store_true",
+                        help="Set TCP_NODELAY on client connections")
+    parser.add_argument("-f", "--max-frame-size", type=int,
+                        default=MAX_FRAME_SIZE,
+                        help=f"Largest frame accepted in bytes "
+                             f"(default: {MAX_FRAME_SIZE})")
+    parser.add_argument("--echo-acks", action="store_true",
+                        help="Always acknowledge by echoing the full DOT")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Worker processes sharing the listening socket, "
+                             "thread engine only (default: 1)")
+    parser.add_argument("--drain-timeout", type=float, default=30.0,
+                        help="Seconds a worker waits for in-flight uploads "
+                             "on SIGTERM (default: 30)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Store each distinct content once and skip "
+                             "writing unchanged re-uploads")
+    parser.add_argument("--dictionary", action="append", default=[],
+                        help="Preset compression dictionary clients may use; "
+                             "repeat for several")
+    parser.add_argument("--durability", choices=DURABILITY_MODES,
+                        default=DURABILITY_NONE,
+                        help="none: atomic rename only; fsync: sync every "
+                             "DOT before acknowledging; group: sync "
+                             "concurrent uploads together (default: none)")
+    parser.add_argument("--group-commit-ms", type=float,
+                        default=GROUP_INTERVAL * 1000,
+                        help="Time the group committer collects uploads, in "
+                             "milliseconds (default: 5)")
+    parser.add_argument("--writers", type=int, default=WRITE_WORKERS,
+                        help=f"Threads saving uploads off the connection "
+                             f"handlers, 0 to save inline "
+                             f"(default: {WRITE_WORKERS})")
+    parser.add_argument("--write-queue", type=int, default=WRITE_QUEUE,
+                        help=f"Uploads that may wait for a writer before "
+                             f"clients are slowed down "
+                             f"(default: {WRITE_QUEUE})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Bytes of DOTs kept in memory for get requests, "
+                             "0 to disable (default: 64 MiB)")
+    parser.add_argument("--sendfile-threshold", type=int,
+                        default=SENDFILE_THRESHOLD,
+                        help="Smallest DOT sent with sendfile to clients "
+                             "that accept raw downloads, 0 to disable "
+                             "(default: 64 KiB)")
+    parser.add_argument("--validate", action="store_true",
+                        help="Parse uploads and reject those that are not "
+                             "valid DOT graphs")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="Print writer pool, cache and request "
+                             "statistics every this many seconds, 0 for "
+                             "never (default: 0)")
+    parser.add_argument("--profile-dir",
+                        help="Enable profiling on SIGUSR1 (stacks), SIGUSR2 "
+                             "(stacks and allocations) or a profile request, "
+                             "writing profiles to this directory")
+    parser.add_argument("--profile-seconds", type=float,
+                        default=PROFILE_SECONDS,
+                        help=f"Default length of a profile in seconds "
+                             f"(default: {PROFILE_SECONDS})")
     args = parser.parse_args()
+    log.configure(args.log_level or ("debug" if args.verbose else
+                                     "warning" if args.quiet else "info"),
+                  args.log_rate)
+
+    if args.workers > 1 and args.engine != "thread":
+        parser.error("--workers is only supported with the thread engine")
     
-    # Create storage directory if it doesn't exist
-    os.makedirs(args.dir, exist_ok=True)
+    for path in args.dictionary:
+        if load_dictionary(path) is None:
+            return
+
+    # Index the storage directory, creating it if it doesn't exist
+    catalog = Catalog(args.dir, shared=args.workers > 1)
+    if catalog.load():
+        print(f"Loaded catalog of {len(catalog)} DOTs from snapshot")
+    else:
+        print(f"Indexed {len(catalog)} DOTs in {args.dir}")
     
     # Load sample DOTs if storage is empty
-    dots = list_dots(args.dir)
-    if not dots:
+    if not len(catalog):
         # Check for sample DOTs in the samples directory
         samples_dir = "../samples"
         for sample_path in glob.glob(os.path.join(samples_dir, "*.dot")):
             dot = DOT.load(sample_path)
             if dot and dot.save(args.dir):
+                catalog.update(dot.name)
                 print(f"Loaded sample DOT: {dot.name}")
     
-    # Create server socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
     try:
-        # Bind to port and start listening
-        server_socket.bind(("0.0.0.0", args.port))
-        server_socket.listen(5)
-        print(f"TCP Server listening on port {args.port}")
-        print(f"DOTs stored in {args.dir}")
-        
-        # Accept connections
-        while True:
-            client_socket, client_address = server_socket.accept()
-            # Handle client in a new thread
-            client_thread = threading.Thread(
-                target=handle_client,
-                args=(client_socket, client_address, args.dir, args.verbose)
-            )
-            client_thread.daemon = True
-            client_thread.start()
+        if args.workers > 1:
+            supervise(args, catalog)
+        else:
+            # Stop through the KeyboardInterrupt path so the catalog is saved
+            signal.signal(signal.SIGTERM, _interrupt)
+            if args.engine == "asyncio":
+                asyncio.run(serve_asyncio(args, catalog))
+            else:
+                serve_threads(args, catalog)
     except KeyboardInterrupt:
         print("\nShutting down server...")
     except Exception as e:
@@ -121,7 +1111,15 @@ def main():
         if args.verbose:
             traceback.print_exc()
     finally:
-        server_socket.close()
+        # Workers index their own saves, so pick those up first
+        if catalog.shared:
+            catalog.refresh()
+        catalog.save_snapshot()
+
+
+def _interrupt(signum, frame):
+    """Turn a signal into KeyboardInterrupt."""
+    raise KeyboardInterrupt
 
 
 if __name__ == "__main__":
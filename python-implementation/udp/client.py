@@ -3,21 +3,64 @@
 
 import os
 import sys
+import json
 import socket
 import argparse
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import DOT, receive_udp, send_udp
+from utils import DOT, Message, request_udp, send_udp_reliable
+from utils.codec import CODECS, CODEC_JSON
+from utils.compression import (
+    ALGORITHMS,
+    DEFAULT_THRESHOLD,
+    Compression,
+    load_dictionary,
+)
+from utils.protocol import FRAGMENT_SIZE
 
 
 def main():
     parser = argparse.ArgumentParser(description="UDP client")
     parser.add_argument("-s", "--server", default="localhost:8081")
     parser.add_argument("-d", "--dir", default="client_storage")
-    parser.add_argument("-t", "--timeout", type=float, default=5.0)
+    parser.add_argument("-t", "--timeout", type=float, default=1.0,
+                        help="Seconds to wait for a response before "
+                             "retransmitting")
+    parser.add_argument("-r", "--retries", type=int, default=5)
+    parser.add_argument("--fragment-size", type=int, default=FRAGMENT_SIZE)
+    parser.add_argument("--echo", action="store_true")
+    parser.add_argument("--codec", choices=CODECS, default=CODEC_JSON,
+                        help="Wire codec; binary needs a Python server "
+                             "(default: json)")
+    parser.add_argument("--compress", choices=ALGORITHMS,
+                        help="Compress uploads with this algorithm; needs a "
+                             "Python server")
+    parser.add_argument("--compress-level", type=int,
+                        help="Compression level (default: algorithm default)")
+    parser.add_argument("--compress-threshold", type=int,
+                        default=DEFAULT_THRESHOLD,
+                        help=f"Smallest message compressed, in bytes "
+                             f"(default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--dictionary",
+                        help="zlib preset dictionary, also loaded by the "
+                             "server (see utils/compression.py)")
     args = parser.parse_args()
     
+    compression = None
+    if args.compress:
+        zdict = None
+        if args.dictionary:
+            zdict = load_dictionary(args.dictionary)
+            if zdict is None:
+                return
+        try:
+            compression = Compression(args.compress, args.compress_level,
+                                      args.compress_threshold, zdict)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+
     os.makedirs(args.dir, exist_ok=True)
     
     host, port = args.server.split(":")
@@ -28,7 +71,8 @@ def main():
     
     try:
         print(f"UDP client ready, server: {args.server}, files: {args.dir}")
-        print("\nCommands: send <file>, exit\n")
+        print("\nCommands: send <file>, get <name>, list [prefix], stats, "
+              "profile [seconds] [memory], exit\n")
         
         while True:
             command = input("> ")
@@ -39,36 +83,90 @@ def main():
                 break
                 
             parts = command.split(" ", 1)
+            if parts[0] == "list":
+                list_dots(client_socket, server_address, args,
+                          parts[1] if len(parts) > 1 else "")
+                continue
+            if parts[0] == "stats":
+                reply = request_udp(client_socket, server_address,
+                                    Message(command="stats", codec=args.codec),
+                                    args.timeout, args.retries,
+                                    args.fragment_size, fragment=True)
+                if not reply or reply.command != "stats":
+                    print("No stats")
+                else:
+                    print(json.dumps(json.loads(reply.data or "{}"), indent=2))
+                continue
+            if parts[0] == "profile":
+                options = parts[1].split() if len(parts) > 1 else []
+                seconds = next((int(o) for o in options if o.isdigit()), 0)
+                reply = request_udp(client_socket, server_address,
+                                    Message(command="profile", size=seconds,
+                                            data=("memory" if "memory" in
+                                                  options else None),
+                                            codec=args.codec),
+                                    args.timeout, args.retries,
+                                    args.fragment_size, fragment=True)
+                if not reply or reply.command != "profile":
+                    print("No profile reply")
+                else:
+                    print_profile(json.loads(reply.data or "{}"))
+                continue
             if len(parts) < 2:
                 print("Invalid command. Use 'send <file>'")
                 continue
                 
             action, file_path = parts
             
+            if action == "get":
+                # Fragmented so the server may fragment a large reply
+                reply = request_udp(client_socket, server_address,
+                                    Message(command="get", name=file_path,
+                                            codec=args.codec),
+                                    args.timeout, args.retries,
+                                    args.fragment_size, fragment=True)
+                if not reply:
+                    print("No reply")
+                elif reply.command == "missing" or not reply.dot:
+                    print(f"Server has no DOT '{file_path}'")
+                elif reply.dot.digest().hexdigest != reply.hash:
+                    print(f"Hash mismatch for '{file_path}'")
+                else:
+                    reply.dot.save(args.dir)
+                    print(f"Downloaded '{file_path}' ({reply.size} bytes)")
+                continue
+
             if action == "send":
                 dot = DOT.load(file_path)
                 if not dot:
                     print(f"Error loading: {file_path}")
                     continue
                 
-                send_udp(client_socket, server_address, dot)
+                digest = dot.digest()
+                ack = send_udp_reliable(client_socket, server_address, dot,
+                                        "" if args.echo else "store",
+                                        args.timeout, args.retries,
+                                        args.fragment_size, args.codec,
+                                        compression)
                 print(f"Sent '{dot.name}' to server")
-                
-                client_socket.settimeout(args.timeout)
-                try:
-                    ack_dot, server_addr = receive_udp(client_socket)
-                    client_socket.settimeout(None)
-                    
-                    if not ack_dot:
-                        print("No acknowledgment")
-                        continue
-                    
-                    ack_dot.save(args.dir)
-                    print(f"Saved '{ack_dot.name}' locally")
-                    
-                except socket.timeout:
-                    print(f"No response in {args.timeout} seconds")
-                    client_socket.settimeout(None)
+
+                if ack and ack.command == "invalid":
+                    print(f"Server rejected '{dot.name}': {ack.data}")
+                    continue
+
+                if ack and ack.is_ack:
+                    if (ack.size, ack.hash) == (digest.size, digest.hexdigest):
+                        print(f"Acknowledged '{ack.name}' ({ack.size} bytes)")
+                    else:
+                        print(f"Acknowledgment mismatch for '{dot.name}'")
+                    continue
+
+                if not ack or not ack.dot:
+                    print("No acknowledgment")
+                    continue
+
+                ack.dot.save(args.dir)
+                print(f"Saved '{ack.dot.name}' locally")
                 
             else:
                 print("Unknown command")
@@ -80,5 +178,53 @@ def main():
         client_socket.close()
 
 
+def print_profile(result):
+    """Print the answer to a "profile" request.
+
+    Args:
+        result (dict): The reply's data
+    """
+    if not result.get("started"):
+        print(f"Server is not profiling: {result.get('error')}")
+        return
+    print("Server is profiling into:")
+    for path in result["files"]:
+        print(f"  {path}")
+
+
+def list_dots(sock, address, args, prefix="", page_size=100):
+    """Print every stored DOT whose name starts with a prefix.
+
+    Args:
+        sock (socket): The client socket
+        address (tuple): The server's (host, port)
+        args (argparse.Namespace): Parsed command line arguments
+        prefix (str): Name prefix
+        page_size (int): Entries requested at a time
+    """
+    count = 0
+    after = None
+    while True:
+        reply = request_udp(sock, address,
+                            Message(command="list", name=prefix, data=after,
+                                    size=page_size, codec=args.codec),
+                            args.timeout, args.retries, args.fragment_size,
+                            fragment=True)
+        try:
+            page = json.loads(reply.data or "[]") if reply else None
+        except ValueError:
+            page = None
+        if page is None:
+            print("No listing")
+            return
+        for entry in page:
+            print(f"{entry['name']}\t{entry['size']}\t{entry['hash'][:12]}")
+        count += len(page)
+        if len(page) < page_size:
+            print(f"{count} DOTs")
+            return
+        after = page[-1]["name"]
+
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
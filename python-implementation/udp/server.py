@@ -3,15 +3,510 @@
 
 import os
 import sys
+import time
+import signal
 import socket
 import argparse
 import glob
-import json
+import threading
+import multiprocessing
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import DOT, list_dots
-from utils.protocol import Message, MAX_BUFFER_SIZE
+from utils import DOT, log
+from utils.cache import DEFAULT_CACHE_SIZE, DotCache, answer_get, answer_list
+from utils.catalog import Catalog
+from utils.compression import load_dictionary
+from utils.graph import answer_invalid, check_dot
+from utils.metrics import Metrics, answer_stats, timed
+from utils.profiling import (PROFILE_SECONDS, Profiler, answer_profile,
+                             install_signals)
+from utils.storage import ContentStore
+from utils.writer import (DURABILITY_MODES, DURABILITY_NONE, GROUP_INTERVAL,
+                          WRITE_QUEUE, WRITE_WORKERS, FileWriter, WritePool)
+from utils.protocol import (
+    Message,
+    Reassembler,
+    MAX_BUFFER_SIZE,
+    FRAGMENT_HEADER,
+    FRAGMENT_SIZE,
+    encode_udp_reply,
+    grow_receive_buffer,
+    is_fragment,
+    receive_udp_batch,
+)
+
+
+def handle_datagram(data, client_address, args, reassembler, store=None,
+                    file_writer=None, pool=None, reply=None, catalog=None,
+                    cache=None, metrics=None, profiler=None):
+    """Process one received datagram.
+
+    With a writer pool the DOT is saved on a writer thread, and `reply` is
+    called with the save's future once it has finished. If the pool's
+    queue is full the message is dropped unacknowledged and the client
+    retransmits it. Get requests take the same path, as a cache miss reads
+    the file.
+
+    Args:
+        data (memoryview): The datagram; only valid until the next batch
+        client_address (tuple): The sender's address
+        args (argparse.Namespace): Parsed command line arguments
+        reassembler (Reassembler): Reassembly state for fragmented messages
+        store (ContentStore): Deduplicating store, if enabled
+        file_writer (FileWriter): Writer deciding durability of saved DOTs
+        pool (WritePool): Writer threads to save on, or None to save inline
+        reply (callable): Called with (future, address) from the writer
+            thread, the future resolving to the reply datagrams (see
+            save_and_reply); needed with a pool
+        catalog (Catalog): Index kept current with saved DOTs, and used to
+            answer get and list requests
+        cache (DotCache): Cache for get requests, or None
+        metrics (Metrics): Counters and stage timings to record, or None
+        profiler (Profiler): Started by profile requests, None if disabled
+
+    Returns:
+        list: Datagrams to send back to the sender now, or None if the
+        message was dropped
+    """
+    log.debug("Received %d bytes from %s", len(data), client_address)
+
+    # Reassemble fragmented messages
+    request_id = None
+    if is_fragment(data):
+        data = bytes(data)
+        payload, replies = reassembler.feed(data, client_address)
+        if payload is None:
+            return replies
+        request_id = FRAGMENT_HEADER.unpack_from(data)[2]
+        data = payload
+
+    # Parse message, in whichever codec the client used
+    if log.enabled(log.DEBUG):
+        log.debug("Raw data: %s...", bytes(data[:100]))
+
+    start = time.perf_counter()
+    msg = Message.decode(data)
+    if metrics is not None:
+        metrics.observe("decode", time.perf_counter() - start)
+        metrics.request(msg.command)
+    log.debug("Parsed %s message: type=%s command=%s", msg.codec, msg.type,
+              msg.command)
+
+    if msg.command == "stats":
+        return _reply_datagrams(answer_stats(msg, metrics or Metrics()),
+                                client_address, request_id, args, reassembler)
+    if msg.command == "profile":
+        return _reply_datagrams(answer_profile(msg, profiler), client_address,
+                                request_id, args, reassembler)
+    if msg.command == "list" or (msg.command == "get" and pool is None):
+        return answer_and_reply(msg, client_address, request_id, args,
+                                reassembler, catalog, cache)
+    if msg.command == "get":
+        return _submit(pool, reply, msg, client_address, request_id,
+                       reassembler, answer_and_reply, msg, client_address,
+                       request_id, args, reassembler, catalog, cache)
+
+    # Extract DOT from message
+    dot = msg.dot
+    if not dot:
+        log.error("Error: No DOT data in message")
+        return []
+
+    if not dot.name:
+        log.warning("Warning: No name in DOT data, using 'unnamed'")
+        dot.name = "unnamed"
+
+    if not dot.content:
+        log.error("Error: No content in DOT data")
+        return []
+
+    if pool is None:
+        return save_and_reply(msg, client_address, request_id, args,
+                              reassembler, store, file_writer, catalog,
+                              metrics) or []
+
+    return _submit(pool, reply, msg, client_address, request_id, reassembler,
+                   save_and_reply, msg, client_address, request_id, args,
+                   reassembler, store, file_writer, catalog, metrics)
+
+
+def _submit(pool, reply, msg, client_address, request_id, reassembler, fn,
+            *fn_args):
+    """Run a request's handler on the pool, replying when it finishes.
+
+    Returns:
+        list: No datagrams, or None if the pool was full and the request
+        was dropped
+    """
+    future = pool.submit(fn, *fn_args, block=False)
+    if future is None:
+        log.warning("Writer queue full, dropping %s request from %s",
+                    msg.command or "upload", client_address)
+        if request_id is not None:
+            # Let the retransmission be reassembled again
+            reassembler.forget(client_address, request_id)
+        return None
+    future.add_done_callback(lambda f: reply(f, client_address))
+    return []
+
+
+def answer_and_reply(msg, client_address, request_id, args, reassembler,
+                     catalog, cache=None):
+    """Answer a get or list request.
+
+    Args:
+        msg (Message): The decoded request
+        client_address (tuple): The sender's address
+        request_id (int): Fragmented message ID, or None
+        args (argparse.Namespace): Parsed command line arguments
+        reassembler (Reassembler): Remembers the reply for retransmissions
+        catalog (Catalog): Index of the stored DOTs
+        cache (DotCache): Cache for get requests, or None
+
+    Returns:
+        list: Reply datagrams
+    """
+    if msg.command == "get":
+        response = answer_get(msg, args.dir, catalog, cache)
+    else:
+        response = answer_list(msg, catalog)
+    return _reply_datagrams(response, client_address, request_id, args,
+                            reassembler)
+
+
+def save_and_reply(msg, client_address, request_id, args, reassembler,
+                   store=None, file_writer=None, catalog=None, metrics=None):
+    """Save a received DOT and build the acknowledgment.
+
+    With --validate, a DOT that is not a valid graph is not saved and the
+    reply is an "invalid" ack instead, as it is when saving fails.
+
+    Args:
+        msg (Message): The decoded request
+        client_address (tuple): The sender's address
+        request_id (int): Fragmented message ID, or None
+        args (argparse.Namespace): Parsed command line arguments
+        reassembler (Reassembler): Remembers the reply for retransmissions
+        store (ContentStore): Deduplicating store, if enabled
+        file_writer (FileWriter): Writer deciding durability of saved DOTs
+        catalog (Catalog): Index to record the saved DOT in
+        metrics (Metrics): Records the validate and save stages, or None
+
+    Returns:
+        list: Reply datagrams
+    """
+    dot = msg.dot
+
+    if args.validate:
+        error = timed(metrics, "validate", check_dot, dot)
+        if error is not None:
+            if metrics is not None:
+                metrics.error()
+            return _reply_datagrams(answer_invalid(msg, error),
+                                    client_address, request_id, args,
+                                    reassembler)
+
+    # Save the DOT to storage
+    start = time.perf_counter()
+    if store is not None:
+        digest = store.save(dot)
+        saved = digest is not None
+    else:
+        digest = dot.digest()
+        saved = dot.save(args.dir, file_writer)
+    if metrics is not None:
+        metrics.observe("save", time.perf_counter() - start)
+    if not saved:
+        log.error("Error saving DOT %s", dot.name)
+        if metrics is not None:
+            metrics.error()
+        # Tell the client instead of leaving it to retransmit
+        return _reply_datagrams(
+            Message("ack", "invalid", dot.name, data="save failed",
+                    id_=msg.id, codec=msg.codec, compression=msg.compression),
+            client_address, request_id, args, reassembler)
+    if catalog is not None:
+        catalog.update(dot.name, digest.hexdigest)
+
+    log.info("Saved DOT '%s' from %s", dot.name, client_address)
+
+    # Create response message: compact if the client asked for it,
+    # otherwise echo the DOT back for older clients
+    if msg.command == "store" and not args.echo_acks:
+        response = Message.ack(dot.name, digest, msg.id,
+                               msg.codec, msg.compression)
+    else:
+        response = Message(command="acknowledge", name=dot.name, dot=dot,
+                           id_=msg.id, codec=msg.codec,
+                           compression=msg.compression)
+
+    return _reply_datagrams(response, client_address, request_id, args,
+                            reassembler)
+
+
+def _reply_datagrams(response, client_address, request_id, args, reassembler):
+    """Encode a reply, remembering it if the request was fragmented.
+
+    Returns:
+        list: Reply datagrams
+    """
+    response_data = response.encode()
+
+    if log.enabled(log.DEBUG):
+        log.debug("Sending response of %d bytes to %s", len(response_data),
+                  client_address)
+        log.debug("Response data: %s", response.to_dict())
+
+    datagrams = encode_udp_reply(response_data, request_id, args.fragment_size)
+    if request_id is not None:
+        reassembler.set_reply(client_address, request_id, datagrams)
+    return datagrams
+
+
+# Per-worker counters, shared with the supervisor, and their indices
+COUNTERS = ("datagrams", "bytes", "replies", "errors", "dropped")
+DATAGRAMS, BYTES, REPLIES, ERRORS, DROPPED = range(len(COUNTERS))
+
+
+def serve(args, counters=None, worker=None, catalog=None):
+    """Receive and answer datagrams until interrupted.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+        counters (multiprocessing.Array): Slots for the COUNTERS values
+        worker (int): Worker number when running under the supervisor
+        catalog (Catalog): Index kept current with saved DOTs
+    """
+    if counters is None:
+        counters = [0] * len(COUNTERS)
+
+    # Create server socket
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker is not None:
+        # Every worker binds the port; the kernel spreads datagrams by flow
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    grow_receive_buffer(server_socket)
+    reassembler = Reassembler(args.reassembly_limit)
+    file_writer = FileWriter(args.durability, args.group_commit_ms / 1000)
+    store = ContentStore(args.dir, file_writer) if args.dedup else None
+    pool = None
+    if args.writers > 0:
+        pool = WritePool(args.writers, args.write_queue)
+        if args.stats_interval > 0:
+            pool.report(args.stats_interval, "Writer pool" if worker is None
+                        else f"Worker {worker} writer pool")
+    cache = None
+    if args.cache_size > 0:
+        cache = DotCache(args.cache_size)
+        catalog.add_listener(cache.invalidate)
+        if args.stats_interval > 0:
+            cache.report(args.stats_interval, "Cache" if worker is None
+                         else f"Worker {worker} cache")
+    metrics = Metrics()
+    metrics.add_source("udp", lambda: dict(zip(COUNTERS, counters)))
+    if pool is not None:
+        metrics.add_source("writer", pool.stats)
+    if cache is not None:
+        metrics.add_source("cache", cache.stats)
+    if args.metrics_port:
+        port = args.metrics_port + (worker or 0)
+        if metrics.serve(port) is not None:
+            print(f"Metrics at http://0.0.0.0:{port}/metrics")
+    if args.stats_interval > 0:
+        metrics.report(args.stats_interval, "Metrics" if worker is None
+                       else f"Worker {worker} metrics")
+    profiler = None
+    if args.profile_dir:
+        profiler = Profiler(args.profile_dir, args.profile_seconds)
+        install_signals(profiler)
+    # Writer threads update the reply and error counters too
+    counters_lock = threading.Lock()
+
+    def count(index, n=1):
+        with counters_lock:
+            counters[index] += n
+        if index == ERRORS:
+            metrics.error()
+
+    def send(datagrams, client_address):
+        """Send reply datagrams, counting them."""
+        if not datagrams:
+            return
+        start = time.perf_counter()
+        for datagram in datagrams:
+            try:
+                server_socket.sendto(datagram, client_address)
+                count(REPLIES)
+                metrics.sent(len(datagram))
+            except OSError as e:
+                count(ERRORS)
+                log.error("Error sending acknowledgment to %s: %s",
+                          client_address, e)
+        metrics.observe("ack", time.perf_counter() - start)
+
+    def reply(future, client_address):
+        """Writer pool callback: acknowledge a DOT once it is saved."""
+        try:
+            datagrams = future.result()
+        except Exception as e:
+            count(ERRORS)
+            log.error("Error processing message: %s", e)
+            return
+        if datagrams is None:
+            count(ERRORS)
+            return
+        send(datagrams, client_address)
+
+    # Receive buffers are allocated once and reused for every batch
+    views = [memoryview(bytearray(MAX_BUFFER_SIZE))
+             for _ in range(max(args.batch, 1))]
+    
+    try:
+        # Bind to port
+        server_socket.bind(("0.0.0.0", args.port))
+        if worker is None:
+            print(f"UDP Server listening on port {args.port}")
+            print(f"DOTs stored in {args.dir}")
+        
+        # Main loop
+        while True:
+            log.debug("Waiting for data...")
+            batch = receive_udp_batch(server_socket, views)
+            counters[DATAGRAMS] += len(batch)
+
+            replies = []
+            try:
+                # In group mode the batch's DOTs are synced together here,
+                # before any of them is acknowledged
+                with file_writer.batch():
+                    for data, client_address in batch:
+                        counters[BYTES] += len(data)
+                        metrics.received(len(data))
+                        try:
+                            datagrams = handle_datagram(
+                                data, client_address, args, reassembler,
+                                store, file_writer, pool, reply, catalog,
+                                cache, metrics, profiler)
+                            if datagrams is None:
+                                count(DROPPED)
+                            else:
+                                replies.append((datagrams, client_address))
+                        except ValueError as e:
+                            count(ERRORS)
+                            log.error("Error decoding message: %s", e)
+                        except Exception as e:
+                            count(ERRORS)
+                            log.error("Error processing message: %s", e)
+                            if args.verbose:
+                                import traceback
+                                traceback.print_exc()
+            except OSError as e:
+                # Clients retry what is not acknowledged
+                count(ERRORS)
+                log.error("Error committing batch: %s", e)
+                replies = []
+
+            # Send the whole batch's acknowledgments back to back
+            for datagrams, client_address in replies:
+                send(datagrams, client_address)
+    except KeyboardInterrupt:
+        if worker is None:
+            print("\nShutting down server...")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            if worker is None:
+                print(f"Writer pool: {pool.format_stats()}")
+        server_socket.close()
+
+
+def _run_worker(args, counters, worker):
+    """Entry point of a worker process."""
+    # Let the supervisor decide when to stop on Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Workers may not be forked, so register dictionaries again
+    for path in args.dictionary:
+        load_dictionary(path)
+    # Each worker indexes its own saves and picks up the others' by rescanning
+    catalog = Catalog(args.dir, shared=True)
+    catalog.load()
+    serve(args, counters, worker, catalog)
+
+
+def supervise(args):
+    """Run args.workers worker processes sharing the port.
+
+    Workers that die are restarted. On shutdown each worker's counters and
+    the totals are printed.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("Error: --workers needs SO_REUSEPORT, which this platform lacks")
+        return
+
+    # Counters live in shared memory so they survive worker restarts
+    counters = [multiprocessing.Array("Q", len(COUNTERS), lock=False)
+                for _ in range(args.workers)]
+    workers = [None] * args.workers
+    restarts = 0
+
+    def start(i):
+        process = multiprocessing.Process(target=_run_worker,
+                                          args=(args, counters[i], i),
+                                          daemon=True)
+        process.start()
+        workers[i] = process
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    def forward(signum, frame):
+        # Each worker profiles itself
+        for process in workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    if args.profile_dir and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+    print(f"UDP Server listening on port {args.port} with {args.workers} workers")
+    print(f"DOTs stored in {args.dir}")
+
+    try:
+        for i in range(args.workers):
+            start(i)
+        while True:
+            time.sleep(0.5)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    print(f"Worker {i} exited with code {process.exitcode}, "
+                          f"restarting")
+                    restarts += 1
+                    start(i)
+    except KeyboardInterrupt:
+        print("\nShutting down server...")
+    finally:
+        for process in workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in workers:
+            if process is not None:
+                process.join()
+
+        totals = [0] * len(COUNTERS)
+        for i, values in enumerate(counters):
+            print(f"Worker {i}: " + ", ".join(
+                f"{name}={value}" for name, value in zip(COUNTERS, values)))
+            totals = [total + value for total, value in zip(totals, values)]
+        print("Total: " + ", ".join(
+            f"{name}={value}" for name, value in zip(COUNTERS, totals)) +
+            f", restarts={restarts}")
 
 
 def main():
@@ -24,124 +519,119 @@ def main():
                         help="Directory to store DOT files (default: server_storage)")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable verbose output")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Only log warnings and errors, not every "
+                             "message")
+    parser.add_argument("--log-level", choices=list(log.LEVELS),
+                        help="Least severe messages logged (default: info, "
+                             "debug with -v, warning with -q)")
+    parser.add_argument("--log-rate", type=int, default=log.RATE_LIMIT,
+                        help=f"Messages of one kind logged per second, 0 "
+                             f"for no limit (default: {log.RATE_LIMIT})")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve Prometheus metrics over HTTP on this "
+                             "port, plus the worker number with --workers "
+                             "(default: 0, off)")
+    parser.add_argument("--echo-acks", action="store_true",
+                        help="Always acknowledge by echoing the full DOT")
+    parser.add_argument("--fragment-size", type=int, default=FRAGMENT_SIZE,
+                        help=f"Payload bytes per reply fragment "
+                             f"(default: {FRAGMENT_SIZE})")
+    parser.add_argument("--reassembly-limit", type=int,
+                        default=64 * 1024 * 1024,
+                        help="Bytes of partially received messages to buffer "
+                             "(default: 64 MiB)")
+    parser.add_argument("--batch", type=int, default=64,
+                        help="Datagrams drained per wakeup (default: 64)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Worker processes sharing the port via "
+                             "SO_REUSEPORT (default: 1)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Store each distinct content once and skip "
+                             "writing unchanged re-uploads")
+    parser.add_argument("--dictionary", action="append", default=[],
+                        help="Preset compression dictionary clients may use; "
+                             "repeat for several")
+    parser.add_argument("--durability", choices=DURABILITY_MODES,
+                        default=DURABILITY_NONE,
+                        help="none: atomic rename only; fsync: sync every "
+                             "DOT before acknowledging; group: sync each "
+                             "receive batch together (default: none)")
+    parser.add_argument("--group-commit-ms", type=float,
+                        default=GROUP_INTERVAL * 1000,
+                        help="Time the group committer collects uploads, in "
+                             "milliseconds (default: 5)")
+    parser.add_argument("--writers", type=int, default=WRITE_WORKERS,
+                        help=f"Threads saving uploads off the receive loop, "
+                             f"0 to save inline (default: {WRITE_WORKERS})")
+    parser.add_argument("--write-queue", type=int, default=WRITE_QUEUE,
+                        help=f"Uploads that may wait for a writer; more are "
+                             f"dropped for the client to retransmit "
+                             f"(default: {WRITE_QUEUE})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Bytes of DOTs kept in memory for get requests, "
+                             "0 to disable (default: 64 MiB)")
+    parser.add_argument("--validate", action="store_true",
+                        help="Parse uploads and reject those that are not "
+                             "valid DOT graphs")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="Print writer pool, cache and request "
+                             "statistics every this many seconds, 0 for "
+                             "never (default: 0)")
+    parser.add_argument("--profile-dir",
+                        help="Enable profiling on SIGUSR1 (stacks), SIGUSR2 "
+                             "(stacks and allocations) or a profile request, "
+                             "writing profiles to this directory")
+    parser.add_argument("--profile-seconds", type=float,
+                        default=PROFILE_SECONDS,
+                        help=f"Default length of a profile in seconds "
+                             f"(default: {PROFILE_SECONDS})")
     args = parser.parse_args()
+    log.configure(args.log_level or ("debug" if args.verbose else
+                                     "warning" if args.quiet else "info"),
+                  args.log_rate)
     
-    # Create storage directory if it doesn't exist
-    os.makedirs(args.dir, exist_ok=True)
+    for path in args.dictionary:
+        if load_dictionary(path) is None:
+            return
+
+    # Index the storage directory, creating it if it doesn't exist
+    catalog = Catalog(args.dir, shared=args.workers > 1)
+    if catalog.load():
+        print(f"Loaded catalog of {len(catalog)} DOTs from snapshot")
+    else:
+        print(f"Indexed {len(catalog)} DOTs in {args.dir}")
     
     # Load sample DOTs if storage is empty
-    dots = list_dots(args.dir)
-    if not dots:
+    if not len(catalog):
         # Check for sample DOTs in the samples directory
         samples_dir = "../samples"
         for sample_path in glob.glob(os.path.join(samples_dir, "*.dot")):
             dot = DOT.load(sample_path)
             if dot and dot.save(args.dir):
+                catalog.update(dot.name)
                 print(f"Loaded sample DOT: {dot.name}")
     
-    # Create server socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
     try:
-        # Bind to port
-        server_socket.bind(("0.0.0.0", args.port))
-        print(f"UDP Server listening on port {args.port}")
-        print(f"DOTs stored in {args.dir}")
-        
-        # Main loop
-        while True:
-            try:
-                # Receive data directly
-                print("Waiting for data...")
-                buffer = bytearray(MAX_BUFFER_SIZE)
-                n, client_address = server_socket.recvfrom_into(buffer)
-                
-                if args.verbose:
-                    print(f"Received {n} bytes from {client_address}")
-                
-                # Parse message
-                data = buffer[:n].decode('utf-8')
-                if args.verbose:
-                    print(f"Raw data: {data[:100]}...")
-                    
-                msg_dict = json.loads(data)
-                if args.verbose:
-                    print(f"Parsed message: {msg_dict.keys()}")
-                    if 'dot' in msg_dict and msg_dict['dot']:
-                        print(f"DOT data: {msg_dict['dot'].keys()}")
-                
-                # Extract DOT from message
-                dot_data = msg_dict.get("dot")
-                if not dot_data:
-                    print("Error: No DOT data in message")
-                    continue
-                
-                name = dot_data.get("name")
-                if not name:
-                    print("Warning: No name in DOT data, using 'unnamed'")
-                    name = "unnamed"
-                    
-                content = dot_data.get("content")
-                if not content:
-                    print("Error: No content in DOT data")
-                    continue
-                
-                dot = DOT(
-                    name=name,
-                    content=content
-                )
-                
-                print(f"Received DOT '{dot.name}' from {client_address}")
-                
-                # Save the DOT to storage
-                if not dot.save(args.dir):
-                    print(f"Error saving DOT {dot.name}")
-                    continue
-                else:
-                    print(f"Successfully saved DOT to {os.path.join(args.dir, dot.name + '.dot')}")
-                
-                # Create response message
-                response = {
-                    "type": "data",
-                    "command": "acknowledge",
-                    "name": dot.name,
-                    "dot": {
-                        "name": dot.name,
-                        "content": dot.content
-                    }
-                }
-                
-                # Send acknowledgment back
-                response_data = json.dumps(response).encode('utf-8')
-                
-                if args.verbose:
-                    print(f"Sending response of {len(response_data)} bytes to {client_address}")
-                    print(f"Response data: {response}")
-                
-                bytes_sent = server_socket.sendto(response_data, client_address)
-                
-                if args.verbose:
-                    print(f"Sent {bytes_sent} bytes to {client_address}")
-                
-                print(f"Sent acknowledgment for DOT '{dot.name}' to {client_address}")
-                
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON: {e}")
-                continue
-            except Exception as e:
-                print(f"Error processing message: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
-                
-    except KeyboardInterrupt:
-        print("\nShutting down server...")
+        if args.workers > 1:
+            supervise(args)
+        else:
+            # Stop through the KeyboardInterrupt path so the catalog is saved
+            signal.signal(signal.SIGTERM, _interrupt)
+            serve(args, catalog=catalog)
     except Exception as e:
         print(f"Error: {e}")
     finally:
-        server_socket.close()
+        # Workers index their own saves, so pick those up first
+        if catalog.shared:
+            catalog.refresh()
+        catalog.save_snapshot()
+
+
+def _interrupt(signum, frame):
+    """Turn a signal into KeyboardInterrupt."""
+    raise KeyboardInterrupt
 
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
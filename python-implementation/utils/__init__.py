@@ -1,14 +1,55 @@
 """Utilities for the Python implementation."""
 
-from .dot import DOT, list_dots
-from .protocol import send_tcp, receive_tcp, send_udp, receive_udp, Message
+from .dot import DOT, ContentDigest, list_dots
+from .protocol import (
+    send_message,
+    receive_message,
+    send_tcp,
+    send_tcp_batch,
+    send_tcp_stream,
+    send_tcp_file,
+    receive_tcp,
+    send_message_async,
+    send_tcp_async,
+    send_tcp_stream_async,
+    send_tcp_file_async,
+    receive_message_async,
+    receive_tcp_async,
+    send_udp,
+    receive_udp,
+    receive_udp_message,
+    send_udp_reliable,
+    request_udp,
+    Reassembler,
+    Message,
+    FrameReader,
+    set_nodelay,
+)
 
 __all__ = [
     "DOT",
+    "ContentDigest",
     "list_dots",
+    "send_message",
+    "receive_message",
     "send_tcp",
+    "send_tcp_batch",
+    "send_tcp_stream",
+    "send_tcp_file",
     "receive_tcp",
+    "send_message_async",
+    "send_tcp_async",
+    "send_tcp_stream_async",
+    "send_tcp_file_async",
+    "receive_message_async",
+    "receive_tcp_async",
     "send_udp",
     "receive_udp",
+    "receive_udp_message",
+    "send_udp_reliable",
+    "request_udp",
+    "Reassembler",
     "Message",
+    "FrameReader",
+    "set_nodelay",
 ] 
\ No newline at end of file
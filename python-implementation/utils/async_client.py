@@ -0,0 +1,967 @@
+#!/usr/bin/env python3
+"""Asyncio client library for the DOT servers.
+
+The event loop counterpart of utils.client, for programs built on asyncio
+that would otherwise tie up an executor thread per blocking upload. A
+single event loop can keep thousands of uploads in flight:
+
+    async with AsyncDotClient("host1:8080,host2:8080") as client:
+        stored = await client.upload_many(glob.glob("graphs/*.dot"))
+
+    async with AsyncUdpClient("localhost:8081") as client:
+        stored = await client.upload(DOT("g", "digraph { a -> b }"))
+
+AsyncDotClient pools TCP stream connections like DotClient: each keeps up
+to `window` uploads in flight, matched to their acknowledgments by message
+ID, and uploads go to the least loaded connection of the next server in
+turn. A server whose connection fails is retried after an exponentially
+growing, jittered delay, and uploads lost with a connection are sent again
+to another server.
+
+AsyncUdpClient sends every request over one datagram endpoint, at most
+`window` at a time. Replies are matched by message ID, or by fragment
+message ID for fragmented requests, and timeouts resend what the server
+reports missing as request_udp does, waiting longer after each one.
+
+Files are read, and replies saved, on the event loop thread. Files larger
+than the stream threshold are read a chunk at a time while they are sent.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import itertools
+from collections import Counter, deque
+from . import log
+from .dot import DOT, ContentDigest
+from .codec import CODEC_JSON
+from .client import (ACKED, BACKOFF_MAX, BACKOFF_MIN, CONNECT_TIMEOUT,
+                     CONNECTIONS, FAILED, LOST, STREAM_THRESHOLD, TIMEOUT,
+                     UPLOADED, WINDOW, parse_listing, parse_servers,
+                     save_download)
+from .protocol import (FRAGMENT_HEADER, FRAGMENT_SIZE, FRAGMENT_STATUS,
+                       Message, Reassembler, _missing, fragment_message,
+                       grow_receive_buffer, is_fragment,
+                       receive_message_async, send_message_async,
+                       send_tcp_stream_async, set_nodelay)
+
+# Default requests in flight on a UDP endpoint
+UDP_WINDOW = 64
+
+# Default seconds to wait for a UDP response before retransmitting, and
+# timeouts without progress before giving up. The wait doubles with each
+# timeout, up to UDP_MAX_TIMEOUT, plus up to half as jitter, so that a
+# server falling behind thousands of requests is not swamped by their
+# retransmissions arriving all at once.
+UDP_TIMEOUT = 1.0
+UDP_MAX_TIMEOUT = 8.0
+UDP_RETRIES = 5
+
+
+class _Connection:
+    """One TCP connection with up to `window` uploads in flight.
+
+    A reader task matches replies to the waiting uploads and requests by
+    message ID, or in order for servers that do not echo IDs. Replies to
+    uploads that already timed out are dropped.
+    """
+
+    def __init__(self, reader, writer, storage_dir, window, timeout, echo,
+                 codec, compression):
+        """Initialize a _Connection; must be called on the event loop.
+
+        Args:
+            reader (asyncio.StreamReader): The connection's reader
+            writer (asyncio.StreamWriter): The connection's writer
+            storage_dir (str): Directory to save echoed DOTs in
+            window (int): Most uploads awaiting acknowledgment
+            timeout (float): Seconds an upload waits for room in the
+                window, and then for its acknowledgment
+            echo (bool): Ask for echoed DOTs instead of compact
+                acknowledgments
+            codec (str): Wire codec (see utils.codec)
+            compression (Compression): How to compress uploads, or None
+        """
+        self.reader = reader
+        self.writer = writer
+        self.storage_dir = storage_dir
+        self.timeout = timeout
+        self.command = "" if echo else "store"
+        self.codec = codec
+        self.compression = compression
+        self.slots = asyncio.Semaphore(window)
+        self.send_lock = asyncio.Lock()
+        # Message ID -> (name, digest, future), in the order sent
+        self.pending = {}
+        # Uploads that timed out whose acknowledgment may still arrive
+        self.expired = set()
+        self.replies = {}
+        self.ids = itertools.count(1)
+        self.waiting = 0
+        self.closed = False
+        self.closing = False
+        self.drainer = asyncio.get_running_loop().create_task(self._drain())
+
+    @property
+    def load(self):
+        """int: Uploads in flight or waiting for room."""
+        return len(self.pending) + self.waiting
+
+    async def send(self, dot, digest):
+        """Upload a DOT and wait for its acknowledgment.
+
+        Args:
+            dot (DOT): The DOT; streamed content is sent in chunks
+            digest (ContentDigest): Size and hash the acknowledgment must
+                match, complete once streamed content has been sent
+
+        Returns:
+            str: ACKED, FAILED, or LOST if the connection closed or timed
+            out before the server answered
+        """
+        if self.slots.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                log.error("Timed out waiting to upload '%s'", dot.name)
+                return LOST
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+        msg_id = next(self.ids)
+        sent = False
+        try:
+            if self.closed:
+                return LOST
+            future = asyncio.get_running_loop().create_future()
+            self.pending[msg_id] = (dot.name, digest, future)
+            async with self.send_lock:
+                if self.writer.is_closing():
+                    return LOST
+                if dot.is_streamed:
+                    sent = await send_tcp_stream_async(
+                        self.writer, dot, msg_id=msg_id, codec=self.codec,
+                        compression=self.compression)
+                else:
+                    sent = await send_message_async(self.writer, Message(
+                        command=self.command, dot=dot, id_=msg_id,
+                        codec=self.codec, compression=self.compression))
+            if not sent:
+                return LOST
+            log.debug("Sent '%s'", dot.name)
+            result = await _wait(future, self.timeout)
+            if result is None:
+                log.error("Timed out waiting for acknowledgment of '%s'",
+                          dot.name)
+                return LOST
+            return result
+        finally:
+            if self.pending.pop(msg_id, None) is not None and sent:
+                # Still unanswered, so a reply may yet arrive for it
+                self.expired.add(msg_id)
+            self.slots.release()
+
+    async def request(self, msg):
+        """Send a request and wait for its reply.
+
+        Args:
+            msg (Message): The request; its ID is assigned here
+
+        Returns:
+            Message: The reply, or None if none arrived
+        """
+        if self.closed:
+            log.error("Connection closed")
+            return None
+        msg.id = next(self.ids)
+        msg.codec = self.codec
+        future = asyncio.get_running_loop().create_future()
+        self.replies[msg.id] = future
+        try:
+            async with self.send_lock:
+                sent = (not self.writer.is_closing() and
+                        await send_message_async(self.writer, msg))
+            reply = await _wait(future, self.timeout) if sent else None
+        finally:
+            self.replies.pop(msg.id, None)
+        if reply is None:
+            log.error("No reply to '%s'", msg.command)
+        return reply
+
+    async def close(self):
+        """Close the connection; uploads in flight are LOST."""
+        self.closing = True
+        self.writer.close()
+        await self.drainer
+
+    async def _drain(self):
+        """Receive replies until the connection closes."""
+        while True:
+            try:
+                msg = await receive_message_async(self.reader)
+            except OSError as e:
+                # Raised by the reader when a write found the peer gone
+                log.debug("Connection lost: %s", e)
+                msg = None
+            if msg is None:
+                break
+
+            future = self.replies.get(msg.id)
+            if future is not None:
+                if not future.done():
+                    future.set_result(msg)
+                continue
+
+            msg_id = msg.id
+            if msg_id in self.expired:
+                # Too late, the upload already timed out
+                self.expired.discard(msg_id)
+                continue
+            # Servers that do not echo IDs still answer in order
+            if msg_id is None and self.pending:
+                msg_id = next(iter(self.pending))
+            name, digest, future = self.pending.pop(msg_id,
+                                                    (msg.name, None, None))
+            result = await _upload_result(msg, name, digest,
+                                          self.storage_dir)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+        if not self.closing:
+            log.info("Server closed the connection")
+        self.closed = True
+        self.expired.clear()
+        for _, _, future in self.pending.values():
+            if not future.done():
+                future.set_result(LOST)
+        self.pending.clear()
+        for future in self.replies.values():
+            if not future.done():
+                future.set_result(None)
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class _AsyncServer:
+    """The pooled connections to one server and its reconnect state."""
+
+    def __init__(self, address, size):
+        """Initialize an _AsyncServer.
+
+        Args:
+            address (tuple): The server's (host, port)
+            size (int): Most connections to keep open
+        """
+        self.address = address
+        self.size = size
+        self.connections = []
+        self.failures = 0
+        self.retry_at = 0.0
+        # Created on first use, on the event loop
+        self.lock = None
+
+    def __str__(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    async def pick(self, client):
+        """Get the least loaded connection, opening another while all are
+        busy and the pool is not full.
+
+        Args:
+            client (AsyncDotClient): The pool's owner, which opens
+                connections
+
+        Returns:
+            _Connection: The connection, or None if the server is
+            unreachable
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        best = self._best()
+        if best is not None and self.lock.locked():
+            # Another upload is already opening a connection
+            return best
+        if self._enough(best):
+            return best
+        async with self.lock:
+            best = self._best()
+            if self._enough(best):
+                return best
+            connection = await client.connect(self.address)
+            if connection is None:
+                self.failures += 1
+                delay = min(BACKOFF_MIN * 2 ** (self.failures - 1),
+                            BACKOFF_MAX)
+                self.retry_at = (time.monotonic() +
+                                 delay * random.uniform(0.5, 1))
+                return best
+            if self.failures:
+                log.info("Reconnected to %s", self)
+            self.failures = 0
+            self.connections.append(connection)
+            return connection
+
+    async def close(self):
+        """Close every connection."""
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            await connection.close()
+
+    def _best(self):
+        """Forget closed connections and get the least loaded open one."""
+        self.connections = [c for c in self.connections if not c.closed]
+        return min(self.connections, key=lambda c: c.load, default=None)
+
+    def _enough(self, best):
+        """Check whether the best connection must do, without connecting."""
+        if best is not None and (not best.load or
+                                 len(self.connections) >= self.size):
+            return True
+        return time.monotonic() < self.retry_at
+
+
+class _AsyncClient:
+    """Uploads, downloads and listings common to both async clients.
+
+    Subclasses implement send() and request(). Results of uploads are
+    counted in `results` by kind (ACKED, FAILED, LOST).
+    """
+
+    def __init__(self, storage_dir, stream_threshold):
+        """Initialize an _AsyncClient.
+
+        Args:
+            storage_dir (str): Directory downloads and echoed DOTs are
+                saved in
+            stream_threshold (int): Files larger than this are streamed,
+                None to always read them whole
+        """
+        self.storage_dir = storage_dir
+        self.stream_threshold = stream_threshold
+        self.results = Counter()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Release the client's connections."""
+
+    async def send(self, item):
+        """Upload a DOT and wait for its acknowledgment.
+
+        Args:
+            item: Path of a DOT file, or a DOT
+
+        Returns:
+            str: The upload's result
+        """
+        raise NotImplementedError
+
+    async def request(self, msg):
+        """Send a request other than an upload and wait for its reply.
+
+        Args:
+            msg (Message): The request
+
+        Returns:
+            Message: The reply, or None if none arrived
+        """
+        raise NotImplementedError
+
+    async def upload(self, item):
+        """Upload a DOT and wait for its acknowledgment.
+
+        Args:
+            item: Path of a DOT file, or a DOT
+
+        Returns:
+            bool: True if the server stored it
+        """
+        result = await self.send(item)
+        self.results[result] += 1
+        return result in UPLOADED
+
+    async def upload_many(self, items):
+        """Upload DOTs concurrently and wait for all of them.
+
+        Args:
+            items (iterable): Paths of DOT files, or DOTs
+
+        Returns:
+            list: True for each item the server stored, in order
+        """
+        return list(await asyncio.gather(*(self.upload(item)
+                                           for item in items)))
+
+    async def get(self, name):
+        """Download a stored DOT into the storage directory.
+
+        Args:
+            name (str): Name of the DOT
+
+        Returns:
+            bool: True if it was downloaded and its hash matched
+        """
+        reply = await self.request(Message(command="get", name=name))
+        return save_download(reply, name, self.storage_dir)
+
+    async def list(self, prefix="", page_size=100):
+        """List the stored DOTs whose name starts with a prefix.
+
+        Args:
+            prefix (str): Name prefix
+            page_size (int): Entries requested at a time
+
+        Returns:
+            list: Dicts with name, size, mtime and hash, or None on error
+        """
+        entries = []
+        after = None
+        while True:
+            reply = await self.request(Message(command="list", name=prefix,
+                                               data=after, size=page_size))
+            page = parse_listing(reply)
+            if page is None:
+                return None
+            entries += page
+            if len(page) < page_size:
+                return entries
+            after = page[-1]["name"]
+
+    async def stats(self):
+        """Fetch a server's metrics.
+
+        Returns:
+            dict: Counters and stage timings, or None on error
+        """
+        reply = await self.request(Message(command="stats"))
+        return _json_reply(reply, "stats")
+
+    async def profile(self, seconds=0, memory=False):
+        """Ask a server to profile itself.
+
+        Args:
+            seconds (int): How long, 0 for the server's default
+            memory (bool): Trace allocations too
+
+        Returns:
+            dict: Whether it started and the files it will write, or None
+            on error
+        """
+        reply = await self.request(Message(
+            command="profile", size=seconds,
+            data="memory" if memory else None))
+        return _json_reply(reply, "profile")
+
+    def _load(self, item):
+        """Get the DOT to upload and the digest its acknowledgment must match.
+
+        Returns:
+            tuple: (DOT, ContentDigest), or (None, None) if it could not be
+            loaded
+        """
+        if isinstance(item, DOT):
+            return item, item.digest()
+        try:
+            streamed = (self.stream_threshold is not None and
+                        os.path.getsize(item) > self.stream_threshold)
+        except OSError:
+            streamed = False
+        dot = DOT.stream(item) if streamed else DOT.load(item)
+        if not dot:
+            log.error("Error loading: %s", item)
+            return None, None
+        if not streamed:
+            return dot, dot.digest()
+        digest = ContentDigest()
+        dot.content = digest.wrap(dot.content)
+        return dot, digest
+
+
+class AsyncDotClient(_AsyncClient):
+    """Uploads and downloads DOTs over pooled asyncio TCP connections.
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, servers, storage_dir="client_storage",
+                 connections=CONNECTIONS, window=WINDOW, timeout=TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, retries=1,
+                 stream_threshold=STREAM_THRESHOLD, echo=False,
+                 codec=CODEC_JSON, compression=None, nodelay=False):
+        """Initialize an AsyncDotClient. Connections are opened when needed.
+
+        Args:
+            servers: "host:port", several separated by commas, or a list of
+                "host:port" strings or (host, port) tuples
+            storage_dir (str): Directory downloads and echoed DOTs are
+                saved in
+            connections (int): Most connections per server
+            window (int): Most unacknowledged uploads per connection
+            timeout (float): Seconds to wait for a reply, and for room to
+                send an upload
+            connect_timeout (float): Seconds to wait for a connection
+            retries (int): Times an upload lost with its connection is sent
+                again
+            stream_threshold (int): Files larger than this are streamed
+            echo (bool): Ask servers to echo DOTs instead of sending compact
+                acknowledgments
+            codec (str): Wire codec (see utils.codec)
+            compression (Compression): How to compress uploads, or None
+            nodelay (bool): Set TCP_NODELAY on connections
+        """
+        super().__init__(storage_dir, stream_threshold)
+        self.window = max(window, 1)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.echo = echo
+        self.codec = codec
+        self.compression = compression
+        self.nodelay = nodelay
+        self.servers = [_AsyncServer(address, max(connections, 1))
+                        for address in parse_servers(servers)]
+        if not self.servers:
+            raise ValueError("No servers given")
+        self._next = itertools.count()
+
+    async def connect(self, address):
+        """Open a connection to a server.
+
+        Args:
+            address (tuple): The server's (host, port)
+
+        Returns:
+            _Connection: The connection, or None if it could not be opened
+        """
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*address), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.error("Error connecting to %s:%s: %s", address[0],
+                      address[1], e or "timed out")
+            return None
+        if self.nodelay:
+            set_nodelay(writer.get_extra_info("socket"))
+        return _Connection(reader, writer, self.storage_dir, self.window,
+                           self.timeout, self.echo, self.codec,
+                           self.compression)
+
+    async def check(self):
+        """Connect to every server that has no open connection.
+
+        Returns:
+            int: Number of servers with an open connection
+        """
+        picked = await asyncio.gather(*(server.pick(self)
+                                        for server in self.servers))
+        return sum(connection is not None for connection in picked)
+
+    async def send(self, item):
+        """Upload a DOT, sending it again if it is lost (see
+        _AsyncClient.send).
+
+        A lost upload is sent to another server if there is one, since the
+        other connections to its server are likely failing too.
+        """
+        avoid = None
+        for _ in range(self.retries + 1):
+            server, connection = await self._pick(avoid)
+            if connection is None:
+                return FAILED
+            dot, digest = self._load(item)
+            if dot is None:
+                return FAILED
+            result = await connection.send(dot, digest)
+            if result != LOST:
+                return result
+            avoid = server
+        return LOST
+
+    async def request(self, msg):
+        """Send a request to the next reachable server (see
+        _AsyncClient.request)."""
+        _, connection = await self._pick()
+        if connection is None:
+            return None
+        return await connection.request(msg)
+
+    async def close(self):
+        """Close every connection; uploads still in flight are lost."""
+        for server in self.servers:
+            await server.close()
+
+    async def _pick(self, avoid=None):
+        """Get a connection, trying the server to avoid last.
+
+        Returns:
+            tuple: The server and the connection, or (None, None) if no
+            server is reachable
+        """
+        start = next(self._next)
+        servers = [self.servers[(start + i) % len(self.servers)]
+                   for i in range(len(self.servers))]
+        if avoid is not None:
+            servers.sort(key=lambda server: server is avoid)
+        for server in servers:
+            connection = await server.pick(self)
+            if connection is not None:
+                return server, connection
+        log.error("No server reachable")
+        return None, None
+
+
+class _Inbox:
+    """What arrived for one UDP request, awaited with a timeout.
+
+    Lighter than reading an asyncio.Queue under asyncio.wait_for, which
+    starts a task for every wait.
+    """
+
+    __slots__ = ("items", "waiter")
+
+    def __init__(self):
+        """Initialize an empty _Inbox."""
+        self.items = deque()
+        self.waiter = None
+
+    def put(self, item):
+        """Add an item, waking the request."""
+        self.items.append(item)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(True)
+
+    async def get(self, timeout):
+        """Get the next item, waiting up to `timeout` seconds for one.
+
+        Raises:
+            asyncio.TimeoutError: If none arrived in time
+        """
+        if not self.items:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await _wait(self.waiter, timeout)
+            finally:
+                self.waiter = None
+            if not self.items:
+                raise asyncio.TimeoutError
+        return self.items.popleft()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    """Hands datagrams received by an endpoint to its AsyncUdpClient."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client._received(data)
+
+    def error_received(self, exc):
+        # E.g. ICMP port unreachable; the request times out and retries
+        log.debug("UDP error: %s", exc)
+
+    def connection_lost(self, exc):
+        self.client._lost()
+
+
+class AsyncUdpClient(_AsyncClient):
+    """Uploads and downloads DOTs over one asyncio UDP endpoint.
+
+    Must be used from a single event loop, and opened with open() or
+    `async with` first.
+    """
+
+    def __init__(self, server, storage_dir="client_storage",
+                 timeout=UDP_TIMEOUT, retries=UDP_RETRIES, window=UDP_WINDOW,
+                 fragment_size=FRAGMENT_SIZE, echo=False, codec=CODEC_JSON,
+                 compression=None):
+        """Initialize an AsyncUdpClient.
+
+        Args:
+            server: The server's "host:port" or (host, port)
+            storage_dir (str): Directory downloads and echoed DOTs are
+                saved in
+            timeout (float): Seconds to wait for a response before the
+                first retransmission, doubling with each one
+            retries (int): Timeouts without progress before giving up
+            window (int): Most requests in flight
+            fragment_size (int): Payload bytes per fragment
+            echo (bool): Ask the server to echo DOTs instead of sending
+                compact acknowledgments
+            codec (str): Wire codec (see utils.codec)
+            compression (Compression): How to compress uploads, or None
+        """
+        super().__init__(storage_dir, None)
+        self.address = parse_servers([server])[0]
+        self.timeout = timeout
+        self.retries = retries
+        self.window = max(window, 1)
+        self.fragment_size = fragment_size
+        self.command = "" if echo else "store"
+        self.codec = codec
+        self.compression = compression
+        self.transport = None
+        self.reassembler = Reassembler()
+        self.ids = itertools.count(1)
+        # Message ID -> (name, inbox) of plain requests, fragment message
+        # ID -> inbox of fragmented ones
+        self.plain = {}
+        self.fragmented = {}
+        self._slots = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def open(self):
+        """Create the endpoint; must be called on the event loop."""
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), remote_addr=self.address)
+        grow_receive_buffer(self.transport.get_extra_info("socket"))
+        self._slots = asyncio.Semaphore(self.window)
+
+    async def close(self):
+        """Close the endpoint; requests in flight get no reply."""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self._lost()
+
+    async def send(self, item):
+        """Upload a DOT (see _AsyncClient.send)."""
+        dot, digest = self._load(item)
+        if dot is None:
+            return FAILED
+        reply = await self._request(Message(
+            command=self.command, dot=dot, codec=self.codec,
+            compression=self.compression), False)
+        if reply is None:
+            return LOST
+        return await _upload_result(reply, dot.name, digest,
+                                    self.storage_dir)
+
+    async def request(self, msg):
+        """Send a request (see _AsyncClient.request).
+
+        Requests are fragmented so that the server may fragment a large
+        reply, as to "get".
+        """
+        msg.codec = self.codec
+        return await self._request(msg, True)
+
+    async def _request(self, msg, fragment):
+        """Send a Message and wait for the reply, retransmitting as needed.
+
+        Args:
+            msg (Message): The request; its ID is assigned here
+            fragment (bool): Fragment it even if it fits in one datagram
+
+        Returns:
+            Message: The reply, or None if none arrived
+        """
+        if self.transport is None:
+            log.error("Client is not open")
+            return None
+        async with self._slots:
+            msg.id = next(self.ids)
+            try:
+                data = msg.encode()
+            except Exception as e:
+                log.error("Error preparing message: %s", e)
+                return None
+            inbox = _Inbox()
+            if len(data) <= self.fragment_size and not fragment:
+                frag_id = None
+                datagrams = [data]
+                self.plain[msg.id] = (msg.name, inbox)
+            else:
+                frag_id = random.getrandbits(32)
+                while frag_id in self.fragmented:
+                    frag_id = random.getrandbits(32)
+                try:
+                    datagrams = fragment_message(data, frag_id,
+                                                 self.fragment_size)
+                except ValueError as e:
+                    log.error("Error preparing message: %s", e)
+                    return None
+                self.fragmented[frag_id] = inbox
+            try:
+                return await self._exchange(datagrams, frag_id, inbox)
+            finally:
+                if frag_id is None:
+                    self.plain.pop(msg.id, None)
+                else:
+                    self.fragmented.pop(frag_id, None)
+
+    async def _exchange(self, datagrams, frag_id, inbox):
+        """Send a request's datagrams and handle what comes back.
+
+        Returns:
+            Message: The reply, or None if none arrived
+        """
+        for datagram in datagrams:
+            self.transport.sendto(datagram)
+        attempts = 0
+        missing_count = len(datagrams)
+        while True:
+            try:
+                item = await inbox.get(min(
+                    self.timeout * 2 ** attempts, UDP_MAX_TIMEOUT) *
+                    random.uniform(1, 1.5))
+            except asyncio.TimeoutError:
+                attempts += 1
+                if attempts > self.retries:
+                    log.error("No response after %d retries", self.retries)
+                    return None
+                if self.transport is None:
+                    return None
+                # Report gaps in a partial reply, otherwise resend the last
+                # fragment, which makes the receiver report its gaps
+                status = frag_id is not None and \
+                    self.reassembler.status(self.address, frag_id)
+                self.transport.sendto(status or datagrams[-1])
+                continue
+
+            if item is None:
+                return None
+            if isinstance(item, Message):
+                return item
+
+            if item[2] == FRAGMENT_STATUS:
+                missing = _missing(item)
+                if len(missing) < missing_count:
+                    attempts = 0
+                    missing_count = len(missing)
+                for index in missing:
+                    self.transport.sendto(datagrams[index])
+                # Finish with the last fragment so the receiver reports again
+                if not missing or missing[-1] != len(datagrams) - 1:
+                    self.transport.sendto(datagrams[-1])
+                continue
+
+            buffered = self.reassembler.size
+            payload, statuses = self.reassembler.feed(item, self.address)
+            if self.reassembler.size > buffered:
+                attempts = 0
+            for status in statuses:
+                self.transport.sendto(status)
+            if payload is not None:
+                try:
+                    return Message.decode(payload)
+                except ValueError as e:
+                    log.error("Error decoding reply: %s", e)
+                    return None
+
+    def _received(self, data):
+        """Route a received datagram to the request waiting for it."""
+        if is_fragment(data):
+            inbox = self.fragmented.get(FRAGMENT_HEADER.unpack_from(data)[2])
+            if inbox is not None:
+                inbox.put(data)
+            return
+        try:
+            msg = Message.decode(data)
+        except ValueError as e:
+            log.debug("Dropped undecodable datagram: %s", e)
+            return
+        waiter = self.plain.get(msg.id)
+        if waiter is None and msg.id is None:
+            # Servers that do not echo IDs: the oldest request for the name
+            name = msg.dot.name if msg.dot else msg.name
+            waiter = next((w for w in self.plain.values() if w[0] == name),
+                          None)
+        if waiter is not None:
+            waiter[1].put(msg)
+
+    def _lost(self):
+        """Wake every waiting request once the endpoint has closed."""
+        for _, inbox in self.plain.values():
+            inbox.put(None)
+        for inbox in self.fragmented.values():
+            inbox.put(None)
+
+
+async def _wait(future, timeout):
+    """Await a future, resolving it to None if it is not done in time.
+
+    Cheaper than asyncio.wait_for, which starts a task for every wait.
+
+    Args:
+        future (asyncio.Future): The future
+        timeout (float): Seconds to wait
+
+    Returns:
+        Its result, or None on timeout
+    """
+    handle = asyncio.get_running_loop().call_later(timeout, _expire, future)
+    try:
+        return await future
+    finally:
+        handle.cancel()
+
+
+def _expire(future):
+    """Resolve a future to None unless it is already done."""
+    if not future.done():
+        future.set_result(None)
+
+
+async def _upload_result(msg, name, digest, storage_dir):
+    """Check a server's reply to an upload.
+
+    Compact acknowledgments must match the size and hash of what was sent;
+    echoed DOTs are saved to the storage directory.
+
+    Args:
+        msg (Message): The reply
+        name (str): Name of the uploaded DOT
+        digest (ContentDigest): What was sent, or None if unknown
+        storage_dir (str): Directory to save an echoed DOT in
+
+    Returns:
+        str: ACKED or FAILED
+    """
+    if msg.command == "invalid":
+        log.error("Server rejected '%s': %s", name, msg.data)
+        return FAILED
+    if msg.is_ack:
+        if digest is not None and (msg.size, msg.hash) == (
+                digest.size, digest.hexdigest):
+            log.info("Acknowledged '%s' (%d bytes)", msg.name, msg.size)
+            return ACKED
+        log.error("Acknowledgment mismatch for '%s'", name)
+        return FAILED
+    if not msg.dot:
+        log.error("No acknowledgment")
+        return FAILED
+    if not await msg.dot.save_async(storage_dir):
+        return FAILED
+    log.info("Saved '%s' locally", msg.dot.name)
+    return ACKED
+
+
+def _json_reply(reply, command):
+    """Get the JSON data of a "stats" or "profile" reply.
+
+    Returns:
+        dict: The data, or None on error
+    """
+    if reply is None or reply.command != command:
+        log.error("No %s reply", command)
+        return None
+    try:
+        return json.loads(reply.data or "{}")
+    except ValueError:
+        log.error("Invalid %s reply", command)
+        return None
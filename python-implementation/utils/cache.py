@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Serving stored DOTs back to clients, from memory where possible.
+
+Clients fetch a DOT with a "get" request naming it, and page through the
+stored names with "list" requests:
+
+- get: name is the DOT. The reply carries the DOT with its size and hash,
+  or is a "missing" ack if no such DOT is stored. Over TCP, a request whose
+  data is "raw" accepts a "raw" stream message instead for large DOTs: it
+  carries the size and hash and is followed by the file's bytes, sent with
+  sendfile (see open_raw).
+- list: name is a prefix, data the last name of the previous page (if any)
+  and size the page size. The reply's data is a JSON array of objects with
+  name, size, mtime (seconds) and hash, in name order.
+"""
+
+import os
+import json
+import mmap
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from . import log
+from .dot import DOT
+from .protocol import Message
+
+# Default memory budget for cached DOT content
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Smallest DOT sent as raw file content to clients that accept it
+SENDFILE_THRESHOLD = 64 * 1024
+
+# Entries per list page, by default and at most
+LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+
+
+class DotCache:
+    """Least recently used DOTs, up to a budget of content bytes.
+
+    Each entry remembers the hash of its content, so a lookup that passes
+    the hash currently on record (from the catalog) never returns a stale
+    DOT, even if another process rewrote it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        """Initialize a DotCache.
+
+        Args:
+            max_bytes (int): Content bytes kept in memory
+        """
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, name, hexdigest=None):
+        """Look up a DOT, marking it recently used.
+
+        Args:
+            name (str): Name of the DOT
+            hexdigest (str): Hash the content must have, if known
+
+        Returns:
+            tuple: (DOT, size, hexdigest), or None on a miss
+        """
+        with self.lock:
+            item = self.items.get(name)
+            if item is not None and hexdigest is not None and item[2] != hexdigest:
+                self._drop(name)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(name)
+            self.hits += 1
+            return item
+
+    def put(self, name, dot, size, hexdigest):
+        """Cache a DOT, evicting the least recently used ones to make room.
+
+        Args:
+            name (str): Name of the DOT
+            dot (DOT): The DOT, with str content
+            size (int): Content size in bytes
+            hexdigest (str): SHA-256 of the content in hex
+        """
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if name in self.items:
+                self._drop(name)
+            self.items[name] = (dot, size, hexdigest)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self.items))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, name):
+        """Forget a DOT that was saved again.
+
+        Args:
+            name (str): Name of the DOT
+        """
+        with self.lock:
+            if name in self.items:
+                self._drop(name)
+                self.invalidations += 1
+
+    def stats(self):
+        """Get the cache's metrics.
+
+        Returns:
+            dict: Entries and bytes cached, hits, misses, evictions and
+            invalidations
+        """
+        with self.lock:
+            return {
+                "entries": len(self.items),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def format_stats(self):
+        """Summarize stats() on one line.
+
+        Returns:
+            str: The summary
+        """
+        s = self.stats()
+        lookups = s["hits"] + s["misses"]
+        ratio = s["hits"] / lookups * 100 if lookups else 0.0
+        return (f"hits={s['hits']} misses={s['misses']} ({ratio:.1f}% hit) "
+                f"entries={s['entries']} bytes={s['bytes']}/{self.max_bytes} "
+                f"evictions={s['evictions']} "
+                f"invalidations={s['invalidations']}")
+
+    def report(self, interval, label="Cache"):
+        """Log stats every `interval` seconds from a daemon thread.
+
+        Args:
+            interval (float): Seconds between reports
+            label (str): Prefix of each report
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                log.info("%s: %s", label, self.format_stats())
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def _drop(self, name):
+        """Remove an entry with the lock held."""
+        _, size, _ = self.items.pop(name)
+        self.bytes -= size
+
+
+def answer_get(msg, directory, catalog, cache=None):
+    """Answer a request for a stored DOT.
+
+    Only names in the catalog are served, so a request cannot reach files
+    outside the storage directory.
+
+    Args:
+        msg (Message): The "get" request
+        directory (str): The storage directory
+        catalog (Catalog): Index of the stored DOTs
+        cache (DotCache): Cache to serve from and fill, or None
+
+    Returns:
+        Message: The DOT, or a "missing" ack
+    """
+    entry = catalog.get(msg.name) if msg.name else None
+    item = None
+    if entry is not None:
+        if cache is not None:
+            item = cache.get(msg.name, entry.hexdigest)
+        if item is None:
+            item = _load(os.path.join(directory, f"{msg.name}.dot"),
+                         msg.name)
+            if item is not None and cache is not None:
+                cache.put(msg.name, *item)
+    if item is None:
+        return Message("ack", "missing", msg.name, id_=msg.id, codec=msg.codec,
+                       compression=msg.compression)
+    dot, size, hexdigest = item
+    return Message("data", "get", msg.name, dot=dot, id_=msg.id, size=size,
+                   hash_=hexdigest, codec=msg.codec,
+                   compression=msg.compression)
+
+
+def _load(path, name):
+    """Load a stored DOT with the size and hash of its bytes on disk.
+
+    The file is read as bytes so that line endings are kept and the hash
+    matches the catalog's.
+
+    Args:
+        path (str): The DOT file
+        name (str): Name of the DOT
+
+    Returns:
+        tuple: (DOT, size, hexdigest), or None on error
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        dot = DOT(name, data.decode("utf-8"))
+    except (OSError, UnicodeDecodeError) as e:
+        log.error("Error loading DOT %s: %s", name, e)
+        return None
+    return dot, len(data), hashlib.sha256(data).hexdigest()
+
+
+def open_raw(msg, directory, catalog, threshold=SENDFILE_THRESHOLD):
+    """Open a stored DOT to send as raw bytes in reply to a "get" request.
+
+    The file is sent as is with send_tcp_file, skipping the decode, cache
+    and re-encode of answer_get. Its hash comes from the catalog, or from
+    hashing the mapped file if it changed since it was indexed.
+
+    Args:
+        msg (Message): The "get" request
+        directory (str): The storage directory
+        catalog (Catalog): Index of the stored DOTs
+        threshold (int): Smallest DOT sent raw
+
+    Returns:
+        tuple: (file, Message) with the open file and the "raw" header to
+        send before it, or None to answer with answer_get instead
+    """
+    if msg.data != "raw" or not msg.name:
+        return None
+    entry = catalog.get(msg.name)
+    if entry is None or entry.size < threshold:
+        return None
+    try:
+        f = open(os.path.join(directory, f"{msg.name}.dot"), "rb")
+    except OSError:
+        return None
+    try:
+        st = os.fstat(f.fileno())
+        hexdigest = entry.hexdigest
+        if (st.st_size, st.st_mtime_ns) != (entry.size, entry.mtime_ns):
+            hexdigest = _hash_open(f, st.st_size)
+    except (OSError, ValueError) as e:
+        log.error("Error opening DOT %s: %s", msg.name, e)
+        f.close()
+        return None
+    return f, Message("stream", "raw", msg.name, id_=msg.id,
+                      size=st.st_size, hash_=hexdigest, codec=msg.codec)
+
+
+def _hash_open(f, size):
+    """Compute the SHA-256 of an open file in hex without reading it."""
+    if not size:
+        return hashlib.sha256().hexdigest()
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+        return hashlib.sha256(m).hexdigest()
+
+
+def answer_list(msg, catalog):
+    """Answer a request for a page of stored DOT names.
+
+    Args:
+        msg (Message): The "list" request
+        catalog (Catalog): Index of the stored DOTs
+
+    Returns:
+        Message: The page
+    """
+    limit = msg.size if isinstance(msg.size, int) and msg.size > 0 else LIST_LIMIT
+    entries = catalog.list(msg.name or "", msg.data or None,
+                           min(limit, MAX_LIST_LIMIT))
+    page = [{"name": e.name, "size": e.size, "mtime": e.mtime_ns / 1e9,
+             "hash": e.hexdigest} for e in entries]
+    return Message("ack", "list", msg.name, data=json.dumps(page), id_=msg.id,
+                   size=len(page), codec=msg.codec,
+                   compression=msg.compression)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""In-memory index of the DOTs in a storage directory."""
+
+import os
+import json
+import time
+import bisect
+import hashlib
+import threading
+from collections import namedtuple
+from . import log
+from .writer import FileWriter
+
+# One indexed DOT; mtime_ns is the file's modification time in nanoseconds
+CatalogEntry = namedtuple("CatalogEntry", "name size mtime_ns hexdigest")
+
+SNAPSHOT_VERSION = 1
+
+# Directory modification times are only trusted once they are this old,
+# since coarse timestamps may not change for a write made right after
+MTIME_SLACK_NS = 1_000_000_000
+
+# Shared catalogs look for changes by other processes at most this often
+REFRESH_INTERVAL = 1.0
+
+
+class Catalog:
+    """Name, size, modification time and SHA-256 of every DOT in a directory.
+
+    The directory is indexed once, then kept current by the save path
+    calling update(), so listing never touches the disk. A snapshot written
+    on shutdown lets the next start skip the scan when the directory has
+    not changed since; otherwise the directory is scanned again but only
+    files whose size or modification time changed are hashed.
+
+    A shared catalog is one of several in different processes writing to the
+    same directory. It rescans, at most every REFRESH_INTERVAL seconds, when
+    the directory's modification time shows another process changed it.
+    """
+
+    def __init__(self, directory, snapshot_path=None, shared=False):
+        """Initialize a Catalog; call load() to index the directory.
+
+        Args:
+            directory (str): The storage directory
+            snapshot_path (str): Snapshot file, <dir>/.catalog/snapshot.json
+                if omitted
+            shared (bool): Other processes also save to the directory
+        """
+        self.directory = directory
+        self.snapshot_path = snapshot_path or os.path.join(
+            directory, ".catalog", "snapshot.json")
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.names = []
+        self._dir_mtime_ns = None
+        self._checked = 0.0
+        self._listeners = []
+
+    def __len__(self):
+        """Get the number of indexed DOTs."""
+        return len(self.entries)
+
+    def load(self):
+        """Index the directory, from the snapshot if it is still current.
+
+        Returns:
+            bool: True if the snapshot was used without a scan
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # Created up front, as adding it later changes the directory mtime
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        snapshot, dir_mtime_ns = self._read_snapshot()
+        current = _mtime_ns(self.directory)
+        if dir_mtime_ns is not None and dir_mtime_ns == current:
+            self._replace(snapshot, current)
+            return True
+        self._scan(snapshot)
+        return False
+
+    def refresh(self):
+        """Rescan the directory if it changed since it was last indexed.
+
+        Returns:
+            bool: True if the directory was scanned
+        """
+        self._checked = time.monotonic()
+        if _mtime_ns(self.directory) == self._dir_mtime_ns:
+            return False
+        with self.lock:
+            previous = dict(self.entries)
+        self._scan(previous)
+        return True
+
+    def add_listener(self, callback):
+        """Have a function called with the name of every DOT updated.
+
+        Args:
+            callback (callable): Called after update() records a DOT
+        """
+        self._listeners.append(callback)
+
+    def update(self, name, hexdigest=None):
+        """Record a DOT that was just saved.
+
+        Args:
+            name (str): Name of the DOT
+            hexdigest (str): SHA-256 of its content, hashed from the file if
+                omitted
+
+        Returns:
+            CatalogEntry: The new entry, or None if the file is missing
+        """
+        path = os.path.join(self.directory, f"{name}.dot")
+        try:
+            st = os.stat(path)
+            if hexdigest is None:
+                hexdigest = _hash_file(path)
+        except OSError as e:
+            log.error("Error indexing DOT %s: %s", name, e)
+            return None
+        entry = CatalogEntry(name, st.st_size, st.st_mtime_ns, hexdigest)
+        with self.lock:
+            if name not in self.entries:
+                bisect.insort(self.names, name)
+            self.entries[name] = entry
+        for callback in self._listeners:
+            callback(name)
+        return entry
+
+    def get(self, name):
+        """Look up one DOT.
+
+        Args:
+            name (str): Name of the DOT
+
+        Returns:
+            CatalogEntry: The entry, or None if the DOT is unknown
+        """
+        self._maybe_refresh()
+        with self.lock:
+            return self.entries.get(name)
+
+    def list(self, prefix="", after=None, limit=None):
+        """List DOTs in name order.
+
+        Args:
+            prefix (str): Only names starting with this
+            after (str): Only names after this one, to continue from the
+                last name of the previous page
+            limit (int): Maximum number of entries, None for all
+
+        Returns:
+            list: CatalogEntry objects
+        """
+        self._maybe_refresh()
+        with self.lock:
+            if after is not None and after >= prefix:
+                start = bisect.bisect_right(self.names, after)
+            else:
+                start = bisect.bisect_left(self.names, prefix)
+            result = []
+            for name in self.names[start:start + limit if limit else None]:
+                if not name.startswith(prefix):
+                    break
+                result.append(self.entries[name])
+            return result
+
+    def save_snapshot(self):
+        """Persist the index so the next load can skip scanning.
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+            before = _mtime_ns(self.directory)
+            with self.lock:
+                entries = [list(entry) for entry in self.entries.values()]
+            # A save during the copy leaves the snapshot good only for hashes
+            current = before
+            if (_mtime_ns(self.directory) != before
+                    or time.time_ns() - before < MTIME_SLACK_NS):
+                current = None
+            data = {
+                "version": SNAPSHOT_VERSION,
+                "directory_mtime_ns": current,
+                "entries": entries,
+            }
+            FileWriter().write(self.snapshot_path, (json.dumps(data),))
+            return True
+        except Exception as e:
+            log.error("Error saving catalog snapshot: %s", e)
+            return False
+
+    def _maybe_refresh(self):
+        """Pick up other processes' saves to a shared directory."""
+        if self.shared and time.monotonic() - self._checked >= REFRESH_INTERVAL:
+            self.refresh()
+
+    def _read_snapshot(self):
+        """Read the snapshot.
+
+        Returns:
+            tuple: (entries by name, directory mtime it is current for or
+            None); empty if there is no usable snapshot
+        """
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != SNAPSHOT_VERSION:
+                return {}, None
+            entries = {}
+            for fields in data["entries"]:
+                entry = CatalogEntry(*fields)
+                entries[entry.name] = entry
+            return entries, data.get("directory_mtime_ns")
+        except FileNotFoundError:
+            return {}, None
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            log.warning("Ignoring catalog snapshot %s: %s", self.snapshot_path,
+                        e)
+            return {}, None
+
+    def _scan(self, previous):
+        """Index the directory, reusing hashes of unchanged files.
+
+        Args:
+            previous (dict): Known entries by name
+        """
+        dir_mtime_ns = _mtime_ns(self.directory)
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if not item.name.endswith(".dot") or item.name.startswith("."):
+                    continue
+                try:
+                    if not item.is_file():
+                        continue
+                    st = item.stat()
+                    name = item.name[:-4]
+                    old = previous.get(name)
+                    if (old is not None and old.size == st.st_size
+                            and old.mtime_ns == st.st_mtime_ns):
+                        entries[name] = old
+                    else:
+                        entries[name] = CatalogEntry(
+                            name, st.st_size, st.st_mtime_ns,
+                            _hash_file(item.path))
+                except OSError:
+                    # Removed while scanning
+                    continue
+        self._replace(entries, dir_mtime_ns)
+
+    def _replace(self, entries, dir_mtime_ns):
+        """Swap in a new index."""
+        names = sorted(entries)
+        with self.lock:
+            self.entries = entries
+            self.names = names
+            self._dir_mtime_ns = dir_mtime_ns
+        self._checked = time.monotonic()
+
+
+def _mtime_ns(directory):
+    """Get a directory's modification time, None if it is missing."""
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _hash_file(path):
+    """Compute the SHA-256 of a file in hex."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
@@ -0,0 +1,1089 @@
+#!/usr/bin/env python3
+"""Client library for the DOT servers.
+
+DotClient keeps a pool of persistent TCP connections to one or more
+servers and uploads, downloads and lists DOTs over them from any number of
+threads:
+
+    with DotClient("host1:8080,host2:8080", connections=4) as client:
+        results = client.upload_many(glob.glob("graphs/*.dot"))
+
+Each connection is a Pipeline, which keeps up to `window` uploads in
+flight and matches acknowledgments back to them. Uploads go to the least
+loaded connection of the next server in turn, and connections are opened
+as they are needed. A server whose connection fails is retried after an
+exponentially growing, jittered delay, and a health thread drops closed
+connections and reconnects to servers that are down meanwhile. Uploads
+lost with a connection are retried on another one.
+
+Progress is logged at info level and errors at error level (see
+utils.log).
+"""
+
+import os
+import json
+import time
+import random
+import socket
+import itertools
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from . import log
+from .dot import DOT, ContentDigest
+from .codec import CODEC_JSON
+from .delta import MAX_DELTA_RATIO, encode_delta, make_delta
+from .protocol import (FrameReader, Message, receive_message, send_message,
+                       send_tcp, send_tcp_stream, set_nodelay)
+from .writer import FileWriter
+
+# Files larger than this are streamed instead of loaded whole
+STREAM_THRESHOLD = 1024 * 1024
+
+# Default uploads in flight per connection, and connections per server
+WINDOW = 8
+CONNECTIONS = 2
+
+# Default seconds to wait for a reply, and to connect
+TIMEOUT = 30.0
+CONNECT_TIMEOUT = 5.0
+
+# Delay before reconnecting to a failed server: doubles from BACKOFF_MIN up
+# to BACKOFF_MAX seconds with each failure, less up to half as jitter
+BACKOFF_MIN = 0.1
+BACKOFF_MAX = 30.0
+
+# Seconds between health checks of the pool
+HEALTH_INTERVAL = 5.0
+
+# Upload results: acknowledged, already stored, sent as a delta, failed,
+# and lost with the connection before it was acknowledged
+ACKED = "acked"
+SKIPPED = "skipped"
+PATCHED = "patched"
+FAILED = "failed"
+LOST = "lost"
+UPLOADED = (ACKED, SKIPPED, PATCHED)
+
+
+class Pipeline:
+    """Keeps up to `window` uploads in flight on one connection.
+
+    Sends happen on the caller's thread while a background thread drains
+    acknowledgements and matches them back to requests by message ID.
+    Compact acknowledgements are checked against the size and hash of what
+    was sent; echoed DOTs are saved to the storage directory.
+
+    With have_check, each file's hash is offered to the server first and
+    the content is only sent if the server replies that it is missing.
+
+    With delta, the content of every acknowledged upload is kept in
+    <storage_dir>/.base, and a later upload of the same name sends only the
+    changed lines against it (see utils.delta). The full DOT follows if the
+    server no longer has that base.
+
+    With a timeout, an upload the server has not acknowledged within that
+    many seconds of being sent fails, freeing its place in the window; an
+    acknowledgment arriving later is ignored.
+
+    Downloads and listings (request()) share the connection; their replies
+    are handed back to the waiting caller instead of being treated as
+    acknowledgements. Large downloads may arrive as raw file bytes, which
+    are written straight to the storage directory.
+    """
+
+    def __init__(self, sock, storage_dir, window=1, stream_threshold=None,
+                 echo=False, codec=CODEC_JSON, compression=None,
+                 have_check=False, delta=False, timeout=None):
+        """Initialize a Pipeline.
+
+        Args:
+            sock (socket): Connected socket
+            storage_dir (str): Directory to save echoed DOTs in
+            window (int): Maximum number of unacknowledged uploads
+            stream_threshold (int): Files larger than this are streamed
+            echo (bool): Ask the server to echo DOTs instead of sending
+                compact acknowledgements
+            codec (str): Wire codec for uploads (see utils.codec)
+            compression (Compression): How to compress uploads, or None
+            have_check (bool): Ask whether the server already has each
+                file's content before uploading it
+            delta (bool): Send changes against the previous upload of each
+                name instead of the whole file where possible
+            timeout (float): Seconds an upload waits for room in the
+                window, and then for its acknowledgment, None to wait
+                forever
+        """
+        self.sock = sock
+        self.storage_dir = storage_dir
+        self.stream_threshold = stream_threshold
+        self.command = "" if echo else "store"
+        self.codec = codec
+        self.compression = compression
+        self.have_check = have_check
+        self.delta = delta
+        self.timeout = timeout
+        self.base_dir = os.path.join(storage_dir, ".base")
+        self.reader = FrameReader(sock)
+        self.send_lock = threading.Lock()
+        self.deferred = {}
+        self.delta_ids = set()
+        self.bases = {}
+        self.callbacks = {}
+        self.replies = {}
+        self.file_writer = FileWriter()
+        self.slots = threading.BoundedSemaphore(window)
+        self.pending = OrderedDict()
+        # Acknowledgment deadlines in the order they fall due, and uploads
+        # that timed out whose acknowledgment may still arrive
+        self.deadlines = OrderedDict()
+        self.expired = set()
+        self.cond = threading.Condition()
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.closing = False
+        self.acked = 0
+        self.failed = 0
+        self.skipped = 0
+        self.patched = 0
+        self.drainer = threading.Thread(target=self._drain_acks, daemon=True)
+        self.drainer.start()
+        if timeout is not None:
+            threading.Thread(target=self._expire_acks, daemon=True).start()
+
+    def send_file(self, file_path, callback=None):
+        """Upload a file, blocking only while the window is full.
+
+        Args:
+            file_path (str): Path of the DOT file
+            callback (callable): Called once with the upload's result
+                (ACKED, SKIPPED, PATCHED, FAILED or LOST), on the
+                acknowledgment thread once it is known
+
+        Returns:
+            bool: True if the upload was sent
+        """
+        try:
+            streamed = (self.stream_threshold is not None and
+                        os.path.getsize(file_path) > self.stream_threshold)
+        except OSError:
+            streamed = False
+
+        if streamed:
+            dot = DOT.stream(file_path)
+        else:
+            dot = DOT.load(file_path)
+        if not dot:
+            log.error("Error loading: %s", file_path)
+            if callback is not None:
+                callback(FAILED)
+            return False
+
+        if streamed:
+            digest = ContentDigest()
+            if self.have_check:
+                # Hash the file up front and reopen it for the upload
+                for _ in digest.wrap(dot.content):
+                    pass
+                dot = DOT.stream(file_path)
+            else:
+                dot.content = digest.wrap(dot.content)
+        else:
+            digest = dot.digest()
+
+        delta = None
+        if self.delta:
+            full, full_digest = dot, digest
+            if streamed:
+                # A delta needs the whole file, so only load it if there
+                # is a base to compare against
+                full = None
+                if os.path.exists(self._base_path(dot.name)):
+                    full = DOT.load(file_path)
+                    full_digest = full.digest() if full else None
+            if full is not None:
+                delta = self._make_delta(full, full_digest)
+            if delta is not None and streamed:
+                dot, digest, streamed = full, full_digest, False
+
+        return self._send(dot, digest, delta, file_path, streamed, callback)
+
+    def send_dot(self, dot, callback=None):
+        """Upload a DOT held in memory, blocking only while the window is
+        full.
+
+        Args:
+            dot (DOT): The DOT
+            callback (callable): Called once with the upload's result (see
+                send_file)
+
+        Returns:
+            bool: True if the upload was sent
+        """
+        digest = dot.digest()
+        delta = self._make_delta(dot, digest) if self.delta else None
+        return self._send(dot, digest, delta, None, False, callback)
+
+    def _send(self, dot, digest, delta, file_path, streamed, callback):
+        """Register an upload in the window and send its first message.
+
+        Returns:
+            bool: True if it was sent
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            log.error("Timed out waiting to upload '%s'", dot.name)
+            if callback is not None:
+                callback(LOST)
+            return False
+        with self.cond:
+            if self.closed:
+                self.slots.release()
+                log.error("Connection closed")
+                if callback is not None:
+                    callback(LOST)
+                return False
+            msg_id = next(self.ids)
+            self.pending[msg_id] = (dot.name, digest)
+            if callback is not None:
+                self.callbacks[msg_id] = callback
+            if self.have_check or delta is not None:
+                self.deferred[msg_id] = dot
+            if delta is not None:
+                self.delta_ids.add(msg_id)
+            if self.delta:
+                # Large files are copied from disk once acknowledged
+                self.bases[msg_id] = (file_path,
+                                      None if streamed else dot.content)
+
+        if delta is not None:
+            with self.send_lock:
+                sent = send_message(self.sock, Message(
+                    command="delta", name=dot.name, data=delta, id_=msg_id,
+                    size=digest.size, hash_=digest.hexdigest,
+                    codec=self.codec, compression=self.compression))
+        elif self.have_check:
+            with self.send_lock:
+                sent = send_message(self.sock, Message(
+                    command="have", name=dot.name, id_=msg_id,
+                    size=digest.size, hash_=digest.hexdigest,
+                    codec=self.codec))
+        else:
+            sent = self._upload(dot, msg_id)
+        if not sent:
+            self._complete(msg_id, None)
+            return False
+
+        self._arm(msg_id)
+        log.info("Sent '%s'", dot.name)
+        return True
+
+    def _make_delta(self, dot, digest):
+        """Encode a DOT's changes against its last acknowledged upload.
+
+        Returns:
+            str: The delta, or None if there is no base or the delta would
+            not be much smaller than the DOT
+        """
+        path = self._base_path(dot.name)
+        if not os.path.exists(path):
+            return None
+        base = DOT.load(path)
+        if base is None:
+            return None
+        base_digest = base.digest()
+        if base_digest.hexdigest == digest.hexdigest:
+            return None
+        delta = encode_delta(base_digest.hexdigest,
+                             make_delta(base.content, dot.content))
+        if len(delta) >= digest.size * MAX_DELTA_RATIO:
+            return None
+        return delta
+
+    def _base_path(self, name):
+        """Get where the last acknowledged content of a DOT is kept."""
+        return os.path.join(self.base_dir, f"{name}.dot")
+
+    def _keep_base(self, name, path, content=None):
+        """Keep acknowledged content as the base of the next delta.
+
+        Args:
+            name (str): Name of the DOT
+            path (str): The uploaded file
+            content (str): Its content, read from path if None
+        """
+        try:
+            if content is None:
+                dot = DOT.stream(path)
+                if dot is None:
+                    return
+                chunks = dot.content
+            else:
+                chunks = (content,)
+            self.file_writer.write(self._base_path(name), chunks)
+        except OSError as e:
+            log.error("Error keeping base of '%s': %s", name, e)
+
+    def _upload(self, dot, msg_id):
+        """Send a DOT's content.
+
+        Returns:
+            bool: True if it was sent
+        """
+        with self.send_lock:
+            if dot.is_streamed:
+                return send_tcp_stream(self.sock, dot, msg_id=msg_id,
+                                       codec=self.codec,
+                                       compression=self.compression)
+            return send_tcp(self.sock, dot, msg_id, self.command, self.codec,
+                            self.compression)
+
+    def _upload_deferred(self, msg_id):
+        """Upload a DOT the server reported missing."""
+        with self.cond:
+            dot = self.deferred.pop(msg_id, None)
+        if dot is None:
+            return
+        log.info("Uploading '%s'", dot.name)
+        if not self._upload(dot, msg_id):
+            self._complete(msg_id, None)
+        else:
+            self._arm(msg_id)
+
+    def _arm(self, msg_id):
+        """Start the acknowledgment deadline of an upload that was sent."""
+        if self.timeout is None:
+            return
+        with self.cond:
+            # It may already have been acknowledged
+            if msg_id in self.pending:
+                self.deadlines[msg_id] = time.monotonic() + self.timeout
+                self.deadlines.move_to_end(msg_id)
+
+    def _expire_acks(self):
+        """Fail uploads whose acknowledgment is overdue until the connection
+        closes."""
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if self.deadlines:
+                        msg_id, deadline = next(iter(self.deadlines.items()))
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                    else:
+                        # Nothing sent now can fall due sooner
+                        remaining = self.timeout
+                    self.cond.wait(remaining)
+                if self.closed:
+                    return
+                name = self.pending[msg_id][0]
+                self.expired.add(msg_id)
+            log.error("Timed out waiting for acknowledgment of '%s'", name)
+            self._complete(msg_id, False)
+
+    def request(self, msg, timeout=TIMEOUT, receive_raw=None):
+        """Send a request and wait for its reply.
+
+        Args:
+            msg (Message): The request; its ID is assigned here
+            timeout (float): Seconds to wait for the reply
+            receive_raw (callable): Called on the receiving thread with a
+                "raw" reply to consume the bytes that follow it; returns
+                False if the connection broke
+
+        Returns:
+            Message: The reply, or None if none arrived
+        """
+        done = threading.Event()
+        with self.cond:
+            if self.closed:
+                log.error("Connection closed")
+                return None
+            msg.id = next(self.ids)
+            self.replies[msg.id] = [done, None, receive_raw]
+        msg.codec = self.codec
+        with self.send_lock:
+            sent = send_message(self.sock, msg)
+        if sent:
+            done.wait(timeout)
+        with self.cond:
+            reply = self.replies.pop(msg.id)[1]
+        if reply is None:
+            log.error("No reply to '%s'", msg.command)
+        return reply
+
+    def get(self, name, timeout=TIMEOUT):
+        """Download a stored DOT into the storage directory.
+
+        Args:
+            name (str): Name of the DOT
+            timeout (float): Seconds to wait for the reply
+
+        Returns:
+            bool: True if it was downloaded and its hash matched
+        """
+        saved = []
+
+        def receive_raw(reply):
+            """Write raw content to a temporary file, keeping it if the hash
+            matches."""
+            digest = ContentDigest()
+            pending = self.file_writer.create(self.storage_dir)
+            if not self.reader.copy_to(pending.file, reply.size, digest):
+                self.file_writer.abort(pending)
+                return False
+            if digest.hexdigest != reply.hash:
+                self.file_writer.abort(pending)
+                log.error("Hash mismatch for '%s'", name)
+            else:
+                self.file_writer.commit(
+                    pending, os.path.join(self.storage_dir, f"{name}.dot"))
+                log.info("Downloaded '%s' (%d bytes)", name, digest.size)
+                saved.append(True)
+            return True
+
+        reply = self.request(Message(command="get", name=name, data="raw"),
+                             timeout, receive_raw)
+        if reply is not None and reply.command == "raw":
+            return bool(saved)
+        return save_download(reply, name, self.storage_dir)
+
+    def list(self, prefix="", page_size=100, timeout=TIMEOUT):
+        """List every stored DOT whose name starts with a prefix.
+
+        Args:
+            prefix (str): Name prefix
+            page_size (int): Entries requested at a time
+            timeout (float): Seconds to wait for each page
+
+        Returns:
+            list: Dicts with name, size, mtime and hash, or None on error
+        """
+        entries = []
+        after = None
+        while True:
+            reply = self.request(Message(command="list", name=prefix,
+                                         data=after, size=page_size), timeout)
+            page = parse_listing(reply)
+            if page is None:
+                return None
+            entries += page
+            if len(page) < page_size:
+                return entries
+            after = page[-1]["name"]
+
+    def stats(self, timeout=TIMEOUT):
+        """Fetch the server's metrics.
+
+        Args:
+            timeout (float): Seconds to wait for the reply
+
+        Returns:
+            dict: Counters and stage timings, or None on error
+        """
+        reply = self.request(Message(command="stats"), timeout)
+        if reply is None or reply.command != "stats":
+            log.error("No stats")
+            return None
+        try:
+            return json.loads(reply.data or "{}")
+        except ValueError:
+            log.error("Invalid stats reply")
+            return None
+
+    def profile(self, seconds=0, memory=False, timeout=TIMEOUT):
+        """Ask the server to profile itself.
+
+        Args:
+            seconds (int): How long, 0 for the server's default
+            memory (bool): Trace allocations too
+            timeout (float): Seconds to wait for the reply
+
+        Returns:
+            dict: Whether it started and the files it will write, or None
+            on error
+        """
+        reply = self.request(Message(command="profile", size=seconds,
+                                     data="memory" if memory else None),
+                             timeout)
+        if reply is None or reply.command != "profile":
+            log.error("No profile reply")
+            return None
+        try:
+            return json.loads(reply.data or "{}")
+        except ValueError:
+            log.error("Invalid profile reply")
+            return None
+
+    def wait(self, timeout=None):
+        """Block until every in-flight upload has been acknowledged or has
+        failed.
+
+        Args:
+            timeout (float): Most seconds to wait, None to wait forever
+
+        Returns:
+            bool: True if no upload is left in flight
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.pending and not self.closed:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                self.cond.wait(remaining)
+            return not self.pending
+
+    def close(self):
+        """Close the connection, failing uploads still in flight as LOST."""
+        self.closing = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _complete(self, msg_id, ok):
+        """Retire a request and free its window slot.
+
+        Args:
+            msg_id (int): The upload's message ID
+            ok (bool): True if acknowledged, False if it failed, None if it
+                could not be sent
+        """
+        with self.cond:
+            base = self.bases.pop(msg_id, None)
+            name = self.pending.get(msg_id, (None,))[0]
+        if ok and base is not None:
+            # Kept before wait() can return, so the next upload finds it
+            self._keep_base(name, *base)
+        with self.cond:
+            if msg_id not in self.pending:
+                return
+            del self.pending[msg_id]
+            self.deadlines.pop(msg_id, None)
+            callback = self.callbacks.pop(msg_id, None)
+            result = ACKED
+            if self.deferred.pop(msg_id, None) is not None and ok:
+                # Acknowledged without uploading the whole DOT
+                if msg_id in self.delta_ids:
+                    self.patched += 1
+                    result = PATCHED
+                else:
+                    self.skipped += 1
+                    result = SKIPPED
+            self.delta_ids.discard(msg_id)
+            if not ok:
+                self.failed += 1
+                result = LOST if ok is None else FAILED
+            else:
+                self.acked += 1
+            self.cond.notify_all()
+        self.slots.release()
+        if callback is not None:
+            callback(result)
+
+    def _drain_acks(self):
+        """Receive acknowledgements until the connection closes."""
+        while True:
+            msg = receive_message(self.sock, self.reader)
+            if msg is None:
+                break
+
+            with self.cond:
+                waiter = self.replies.get(msg.id)
+            if waiter is not None:
+                if msg.command == "raw" and not (waiter[2] and waiter[2](msg)):
+                    # The raw bytes were not consumed; the stream is lost
+                    waiter[0].set()
+                    break
+                waiter[1] = msg
+                waiter[0].set()
+                continue
+
+            with self.cond:
+                if msg.id in self.expired:
+                    # Too late, the upload already failed
+                    self.expired.discard(msg.id)
+                    continue
+                msg_id = msg.id
+                # Servers that do not echo IDs still answer in order
+                if msg_id not in self.pending and self.pending:
+                    msg_id = next(iter(self.pending))
+                name, digest = self.pending.get(msg_id, (msg.name, None))
+
+            if msg.command == "missing":
+                # Upload off this thread so acknowledgements keep draining
+                threading.Thread(target=self._upload_deferred,
+                                 args=(msg_id,), daemon=True).start()
+                continue
+
+            if msg.command == "invalid":
+                log.error("Server rejected '%s': %s", name, msg.data)
+                self._complete(msg_id, False)
+                continue
+
+            if msg.is_ack:
+                ok = (digest is not None and msg.size == digest.size and
+                      msg.hash == digest.hexdigest)
+                if ok:
+                    log.info("Acknowledged '%s' (%d bytes)", msg.name,
+                             msg.size)
+                else:
+                    log.error("Acknowledgment mismatch for '%s'", name)
+                self._complete(msg_id, ok)
+                continue
+
+            if not msg.dot:
+                log.error("No acknowledgment")
+                self._complete(msg_id, False)
+                continue
+
+            msg.dot.save(self.storage_dir)
+            log.info("Saved '%s' locally", msg.dot.name)
+            self._complete(msg_id, True)
+
+        if not self.closing:
+            log.info("Server closed the connection")
+        with self.cond:
+            self.closed = True
+            self.failed += len(self.pending)
+            callbacks = list(self.callbacks.values())
+            for _ in self.pending:
+                self.slots.release()
+            self.pending.clear()
+            self.deadlines.clear()
+            self.expired.clear()
+            self.callbacks.clear()
+            self.deferred.clear()
+            self.bases.clear()
+            for waiter in self.replies.values():
+                waiter[0].set()
+            self.cond.notify_all()
+        for callback in callbacks:
+            callback(LOST)
+
+
+class _Server:
+    """The pooled connections to one server and its reconnect state."""
+
+    def __init__(self, address, size):
+        """Initialize a _Server.
+
+        Args:
+            address (tuple): The server's (host, port)
+            size (int): Most connections to keep open
+        """
+        self.address = address
+        self.size = size
+        self.pipelines = []
+        self.failures = 0
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def pick(self, client):
+        """Get the least loaded connection, opening another while all are
+        busy and the pool is not full.
+
+        Args:
+            client (DotClient): The pool's owner, which opens connections
+
+        Returns:
+            Pipeline: The connection, or None if the server is unreachable
+        """
+        with self.lock:
+            self._prune()
+            best = min(self.pipelines, key=lambda p: len(p.pending),
+                       default=None)
+            if best is not None and (not best.pending or
+                                     len(self.pipelines) >= self.size):
+                return best
+            if time.monotonic() < self.retry_at:
+                return best
+            pipeline = self._connect(client)
+            return pipeline or best
+
+    def check(self, client):
+        """Drop closed connections and reconnect if due.
+
+        Args:
+            client (DotClient): The pool's owner, which opens connections
+        """
+        with self.lock:
+            self._prune()
+            if not self.pipelines and self.failures and \
+                    time.monotonic() >= self.retry_at:
+                if self._connect(client) is not None:
+                    log.info("Reconnected to %s", self)
+
+    def close(self):
+        """Close every connection."""
+        with self.lock:
+            for pipeline in self.pipelines:
+                pipeline.close()
+            self.pipelines = []
+
+    def _prune(self):
+        """Forget connections whose server closed them; the lock is held."""
+        for pipeline in self.pipelines:
+            if pipeline.closed:
+                pipeline.close()
+        self.pipelines = [p for p in self.pipelines if not p.closed]
+
+    def _connect(self, client):
+        """Open a connection, backing off on failure; the lock is held.
+
+        Returns:
+            Pipeline: The new connection, or None if it failed
+        """
+        pipeline = client.connect(self.address)
+        if pipeline is None:
+            self.failures += 1
+            delay = min(BACKOFF_MIN * 2 ** (self.failures - 1), BACKOFF_MAX)
+            self.retry_at = time.monotonic() + delay * random.uniform(0.5, 1)
+            return None
+        self.failures = 0
+        self.pipelines.append(pipeline)
+        return pipeline
+
+
+class DotClient:
+    """Uploads and downloads DOTs over pooled connections to DOT servers.
+
+    Safe to use from many threads at once. Results of uploads are counted
+    in `results` by kind (ACKED, SKIPPED, PATCHED, FAILED, LOST).
+    """
+
+    def __init__(self, servers, storage_dir="client_storage",
+                 connections=CONNECTIONS, window=WINDOW, timeout=TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, retries=1,
+                 stream_threshold=STREAM_THRESHOLD, echo=False,
+                 codec=CODEC_JSON, compression=None, have_check=False,
+                 delta=False, nodelay=False, health_interval=HEALTH_INTERVAL):
+        """Initialize a DotClient. Connections are opened when needed.
+
+        Args:
+            servers: "host:port", several separated by commas, or a list of
+                "host:port" strings or (host, port) tuples
+            storage_dir (str): Directory downloads and echoed DOTs are
+                saved in
+            connections (int): Most connections per server
+            window (int): Most unacknowledged uploads per connection
+            timeout (float): Seconds to wait for a reply or for room to
+                send an upload
+            connect_timeout (float): Seconds to wait for a connection
+            retries (int): Times an upload lost with its connection is sent
+                again
+            stream_threshold (int): Files larger than this are streamed
+            echo (bool): Ask servers to echo DOTs instead of sending compact
+                acknowledgments
+            codec (str): Wire codec (see utils.codec)
+            compression (Compression): How to compress uploads, or None
+            have_check (bool): Skip uploading content the server already
+                has
+            delta (bool): Send changes against the previous upload of each
+                name where possible
+            nodelay (bool): Set TCP_NODELAY on connections
+            health_interval (float): Seconds between health checks, 0 for
+                none
+        """
+        self.storage_dir = storage_dir
+        self.window = max(window, 1)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.stream_threshold = stream_threshold
+        self.echo = echo
+        self.codec = codec
+        self.compression = compression
+        self.have_check = have_check
+        self.delta = delta
+        self.nodelay = nodelay
+        self.servers = [_Server(address, max(connections, 1))
+                        for address in parse_servers(servers)]
+        if not self.servers:
+            raise ValueError("No servers given")
+        self.results = Counter()
+        self.closed = False
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(storage_dir, exist_ok=True)
+        if health_interval > 0:
+            threading.Thread(target=self._check_health,
+                             args=(health_interval,), daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self, address):
+        """Open a connection to a server.
+
+        Args:
+            address (tuple): The server's (host, port)
+
+        Returns:
+            Pipeline: The connection, or None if it could not be opened
+        """
+        try:
+            sock = socket.create_connection(address, self.connect_timeout)
+        except OSError as e:
+            log.error("Error connecting to %s:%s: %s", address[0],
+                      address[1], e)
+            return None
+        sock.settimeout(None)
+        # Lets the kernel notice a server that vanished while idle
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.nodelay:
+            set_nodelay(sock)
+        return Pipeline(sock, self.storage_dir, self.window,
+                        self.stream_threshold, self.echo, self.codec,
+                        self.compression, self.have_check, self.delta,
+                        self.timeout)
+
+    def check(self):
+        """Connect to every server that has no open connection.
+
+        Returns:
+            int: Number of servers with an open connection
+        """
+        return sum(server.pick(self) is not None for server in self.servers)
+
+    def pipeline(self):
+        """Get a connection, from the next reachable server in turn.
+
+        Returns:
+            Pipeline: The connection, or None if no server is reachable
+        """
+        return self._pick()[1]
+
+    def _pick(self, avoid=None):
+        """Get a connection, trying the server to avoid last.
+
+        Returns:
+            tuple: The server and the connection, or (None, None) if no
+            server is reachable
+        """
+        start = next(self._next)
+        servers = [self.servers[(start + i) % len(self.servers)]
+                   for i in range(len(self.servers))]
+        if avoid is not None:
+            servers.sort(key=lambda server: server is avoid)
+        for server in servers:
+            pipeline = server.pick(self)
+            if pipeline is not None:
+                return server, pipeline
+        log.error("No server reachable")
+        return None, None
+
+    def submit(self, item):
+        """Start uploading a DOT without waiting for its acknowledgment.
+
+        Blocks only while the chosen connection's window is full.
+
+        Args:
+            item: Path of a DOT file, or a DOT
+
+        Returns:
+            Future: Resolves to the upload's result (see Pipeline.send_file)
+        """
+        future = Future()
+        self._submit(item, future, self.retries)
+        return future
+
+    def _submit(self, item, future, retries, avoid=None):
+        """Send an upload, sending it again if it is lost.
+
+        A lost upload is sent to another server if there is one, since the
+        other connections to its server are likely failing too.
+        """
+        def done(result):
+            if result == LOST and retries > 0 and not self.closed:
+                # Off the acknowledgment thread, which may be closing
+                threading.Thread(target=self._submit,
+                                 args=(item, future, retries - 1, server),
+                                 daemon=True).start()
+                return
+            with self._lock:
+                self.results[result] += 1
+            future.set_result(result)
+
+        server, pipeline = self._pick(avoid)
+        if pipeline is None:
+            done(FAILED)
+        elif isinstance(item, DOT):
+            pipeline.send_dot(item, done)
+        else:
+            pipeline.send_file(item, done)
+
+    def upload(self, item, timeout=None):
+        """Upload a DOT and wait for its acknowledgment.
+
+        Args:
+            item: Path of a DOT file, or a DOT
+            timeout (float): Seconds to wait, the client's timeout if None
+
+        Returns:
+            bool: True if the server stored it
+        """
+        return self.upload_many([item], timeout)[0]
+
+    def upload_many(self, items, timeout=None):
+        """Upload DOTs over all connections and wait for them.
+
+        Args:
+            items (iterable): Paths of DOT files, or DOTs
+            timeout (float): Seconds to wait for the last acknowledgment
+                after the last upload is sent, the client's timeout if None
+
+        Returns:
+            list: True for each item the server stored, in order
+        """
+        futures = [self.submit(item) for item in items]
+        deadline = time.monotonic() + (timeout or self.timeout)
+        results = []
+        for future in futures:
+            try:
+                result = future.result(max(deadline - time.monotonic(), 0))
+            except FutureTimeout:
+                log.error("Timed out waiting for acknowledgment")
+                result = None
+            results.append(result in UPLOADED)
+        return results
+
+    def get(self, name):
+        """Download a stored DOT into the storage directory.
+
+        Args:
+            name (str): Name of the DOT
+
+        Returns:
+            bool: True if it was downloaded and its hash matched
+        """
+        pipeline = self.pipeline()
+        return pipeline is not None and pipeline.get(name, self.timeout)
+
+    def list(self, prefix="", page_size=100):
+        """List the stored DOTs whose name starts with a prefix.
+
+        Args:
+            prefix (str): Name prefix
+            page_size (int): Entries requested at a time
+
+        Returns:
+            list: Dicts with name, size, mtime and hash, or None on error
+        """
+        pipeline = self.pipeline()
+        if pipeline is None:
+            return None
+        return pipeline.list(prefix, page_size, self.timeout)
+
+    def stats(self):
+        """Fetch the metrics of the next server.
+
+        Returns:
+            dict: Counters and stage timings, or None on error
+        """
+        pipeline = self.pipeline()
+        return pipeline.stats(self.timeout) if pipeline else None
+
+    def profile(self, seconds=0, memory=False):
+        """Ask the next server to profile itself.
+
+        Args:
+            seconds (int): How long, 0 for the server's default
+            memory (bool): Trace allocations too
+
+        Returns:
+            dict: Whether it started and the files it will write, or None
+            on error
+        """
+        pipeline = self.pipeline()
+        if pipeline is None:
+            return None
+        return pipeline.profile(seconds, memory, self.timeout)
+
+    def close(self):
+        """Close every connection; uploads still in flight are lost."""
+        self.closed = True
+        self._stop.set()
+        for server in self.servers:
+            server.close()
+
+    def _check_health(self, interval):
+        """Prune and reconnect the pool every `interval` seconds."""
+        while not self._stop.wait(interval):
+            for server in self.servers:
+                server.check(self)
+
+
+def parse_servers(servers):
+    """Parse server addresses.
+
+    Args:
+        servers: "host:port", several separated by commas, or a list of
+            "host:port" strings or (host, port) tuples
+
+    Returns:
+        list: (host, port) tuples
+    """
+    if isinstance(servers, str):
+        servers = [s for s in servers.split(",") if s.strip()]
+    addresses = []
+    for server in servers:
+        if isinstance(server, str):
+            host, port = server.strip().rsplit(":", 1)
+            server = (host.strip("[]"), int(port))
+        addresses.append(tuple(server))
+    return addresses
+
+
+def save_download(reply, name, storage_dir):
+    """Save a DOT returned by a "get" request after checking its hash.
+
+    Args:
+        reply (Message): The server's reply, or None
+        name (str): Name of the requested DOT
+        storage_dir (str): Directory to save it in
+
+    Returns:
+        bool: True if it was saved
+    """
+    if reply is None:
+        return False
+    if reply.command == "missing" or not reply.dot:
+        log.error("Server has no DOT '%s'", name)
+        return False
+    digest = reply.dot.digest()
+    if reply.hash is not None and digest.hexdigest != reply.hash:
+        log.error("Hash mismatch for '%s'", name)
+        return False
+    reply.dot.save(storage_dir)
+    log.info("Downloaded '%s' (%d bytes)", name, digest.size)
+    return True
+
+
+def parse_listing(reply):
+    """Get the entries of a "list" reply.
+
+    Args:
+        reply (Message): The server's reply, or None
+
+    Returns:
+        list: Dicts with name, size, mtime and hash, or None on error
+    """
+    if reply is None:
+        return None
+    try:
+        return json.loads(reply.data or "[]")
+    except ValueError:
+        log.error("Invalid listing")
+        return None
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Wire codecs for message payloads.
+
+A payload is either a legacy JSON object, which always starts with "{", or
+an envelope that starts with the VERSION byte followed by a flags byte. The
+flags say how the rest of the payload is encoded, so old JSON peers and the
+Go implementation keep working while newer peers opt in per message.
+
+The binary body is a fixed header (type code, command code, field bits)
+followed by the present fields in a fixed order. Strings are raw UTF-8 with
+a 4-byte length, so DOT content needs no escaping on either end.
+
+Either body may be compressed (see utils.compression). The algorithm is
+stored in the flags, and a compressed body that used a preset dictionary is
+preceded by the dictionary's 4-byte ID.
+"""
+
+import json
+import struct
+from .compression import MAX_DECOMPRESSED_SIZE, decompress, for_reply
+
+# First byte of an envelope; JSON payloads start with "{" (0x7B)
+VERSION = 0xD1
+
+# Envelope flags: body codec, compression algorithm code, preset dictionary
+FLAG_BINARY = 0x01
+FLAG_COMPRESSION = 0x06
+FLAG_DICT = 0x08
+_COMPRESSION_SHIFT = 1
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+CODECS = (CODEC_JSON, CODEC_BINARY)
+
+# Well-known message types and commands get one-byte codes; anything else
+# is sent as a string after the header
+TYPES = ("data", "stream", "ack")
+# Append only: codes are positions in these tuples
+COMMANDS = ("", "store", "acknowledge", "begin", "chunk", "end", "have",
+            "missing", "get", "list", "raw", "delta", "invalid",
+            "stats", "profile")
+_CUSTOM = 0xFF
+_TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+_COMMAND_CODES = {name: code for code, name in enumerate(COMMANDS)}
+
+# Field bits, in the order the fields follow the header
+_F_TYPE = 0x01
+_F_COMMAND = 0x02
+_F_NAME = 0x04
+_F_DOT = 0x08
+_F_DATA = 0x10
+_F_ID = 0x20
+_F_SIZE = 0x40
+_F_HASH = 0x80
+
+# version, flags
+_ENVELOPE = struct.Struct("!BB")
+_DICT_ID = struct.Struct("!I")
+
+# type code, command code, field bits
+_HEADER = struct.Struct("!BBB")
+_LENGTH = struct.Struct("!I")
+_ID = struct.Struct("!q")
+_SIZE = struct.Struct("!Q")
+
+
+def _put(parts, text):
+    """Append a length-prefixed UTF-8 string."""
+    data = text.encode("utf-8")
+    parts.append(_LENGTH.pack(len(data)))
+    parts.append(data)
+
+
+def _encode_binary(data):
+    """Encode a message dictionary as a binary body.
+
+    Returns:
+        list: The body as a list of buffers
+    """
+    type_ = data.get("type", "data")
+    command = data.get("command", "")
+    type_code = _TYPE_CODES.get(type_, _CUSTOM)
+    command_code = _COMMAND_CODES.get(command, _CUSTOM)
+    fields = 0
+    parts = [b""]
+
+    if type_code == _CUSTOM:
+        fields |= _F_TYPE
+        _put(parts, type_)
+    if command_code == _CUSTOM:
+        fields |= _F_COMMAND
+        _put(parts, command)
+    if data.get("name"):
+        fields |= _F_NAME
+        _put(parts, data["name"])
+    dot = data.get("dot")
+    if dot:
+        fields |= _F_DOT
+        _put(parts, dot["name"])
+        _put(parts, dot["content"])
+    if data.get("data") is not None:
+        fields |= _F_DATA
+        _put(parts, data["data"])
+    if data.get("id") is not None:
+        fields |= _F_ID
+        parts.append(_ID.pack(data["id"]))
+    if data.get("size") is not None:
+        fields |= _F_SIZE
+        parts.append(_SIZE.pack(data["size"]))
+    if data.get("hash") is not None:
+        fields |= _F_HASH
+        digest = bytes.fromhex(data["hash"])
+        parts.append(bytes((len(digest),)))
+        parts.append(digest)
+
+    parts[0] = _HEADER.pack(type_code, command_code, fields)
+    return parts
+
+
+def _decode_binary(view, offset):
+    """Decode a binary body into a message dictionary.
+
+    Args:
+        view (memoryview): The payload
+        offset (int): Where the body starts
+
+    Raises:
+        ValueError: If the payload is truncated or malformed
+    """
+    if len(view) < offset + _HEADER.size:
+        raise ValueError("Truncated binary header")
+    type_code, command_code, fields = _HEADER.unpack_from(view, offset)
+    offset += _HEADER.size
+
+    def take():
+        nonlocal offset
+        if offset + 4 > len(view):
+            raise ValueError("Truncated binary field")
+        (length,) = _LENGTH.unpack_from(view, offset)
+        start = offset + 4
+        offset = start + length
+        if offset > len(view):
+            raise ValueError("Truncated binary field")
+        return str(view[start:offset], "utf-8")
+
+    type_ = take() if fields & _F_TYPE else None
+    command = take() if fields & _F_COMMAND else None
+    try:
+        if type_ is None:
+            type_ = TYPES[type_code]
+        if command is None:
+            command = COMMANDS[command_code]
+    except IndexError:
+        raise ValueError("Unknown message type or command code")
+
+    result = {"type": type_, "command": command,
+              "name": take() if fields & _F_NAME else ""}
+    if fields & _F_DOT:
+        name = take()
+        result["dot"] = {"name": name, "content": take()}
+    if fields & _F_DATA:
+        result["data"] = take()
+    try:
+        if fields & _F_ID:
+            (result["id"],) = _ID.unpack_from(view, offset)
+            offset += _ID.size
+        if fields & _F_SIZE:
+            (result["size"],) = _SIZE.unpack_from(view, offset)
+            offset += _SIZE.size
+        if fields & _F_HASH:
+            length = view[offset]
+            result["hash"] = bytes(view[offset + 1:offset + 1 + length]).hex()
+            offset += 1 + length
+    except (struct.error, IndexError):
+        raise ValueError("Truncated binary field")
+    if offset > len(view):
+        raise ValueError("Truncated binary field")
+    return result
+
+
+def encode(data, codec=CODEC_JSON, compression=None):
+    """Serialize a message dictionary.
+
+    Args:
+        data (dict): The message, as returned by Message.to_dict
+        codec (str): CODEC_JSON or CODEC_BINARY
+        compression (Compression): How to compress the body, or None
+
+    Returns:
+        bytes: The payload
+    """
+    flags = 0
+    if codec == CODEC_BINARY:
+        flags = FLAG_BINARY
+        parts = _encode_binary(data)
+        body = None
+    else:
+        body = json.dumps(data).encode("utf-8")
+
+    if compression is not None:
+        if body is None:
+            body = b"".join(parts)
+        packed = compression.compress(body)
+        if packed is not None:
+            flags |= compression.code << _COMPRESSION_SHIFT
+            if compression.dict_id is None:
+                return b"".join((_ENVELOPE.pack(VERSION, flags), packed))
+            flags |= FLAG_DICT
+            return b"".join((_ENVELOPE.pack(VERSION, flags),
+                             _DICT_ID.pack(compression.dict_id), packed))
+
+    if not flags:
+        # Plain JSON, as understood by every peer
+        return body
+    if body is not None:
+        return b"".join((_ENVELOPE.pack(VERSION, flags), body))
+    parts.insert(0, _ENVELOPE.pack(VERSION, flags))
+    return b"".join(parts)
+
+
+def decode(payload, max_size=MAX_DECOMPRESSED_SIZE):
+    """Deserialize a payload produced by encode, or by a legacy JSON peer.
+
+    Args:
+        payload (bytes): The payload
+        max_size (int): Largest decompressed body accepted
+
+    Returns:
+        tuple: (dict, codec, compression) with the message dictionary, the
+        codec it was encoded with and the Compression to mirror in a reply
+        (None if it was not compressed)
+
+    Raises:
+        ValueError: If the payload cannot be decoded
+    """
+    if not len(payload) or payload[0] != VERSION:
+        return json.loads(str(payload, "utf-8")), CODEC_JSON, None
+
+    if len(payload) < _ENVELOPE.size:
+        raise ValueError("Truncated envelope")
+    view = memoryview(payload)
+    flags = view[1]
+    if flags & ~(FLAG_BINARY | FLAG_COMPRESSION | FLAG_DICT):
+        raise ValueError("Unsupported envelope flags")
+    offset = _ENVELOPE.size
+    codec = CODEC_BINARY if flags & FLAG_BINARY else CODEC_JSON
+    compression = None
+
+    code = (flags & FLAG_COMPRESSION) >> _COMPRESSION_SHIFT
+    if code:
+        dict_id = None
+        if flags & FLAG_DICT:
+            if len(view) < offset + _DICT_ID.size:
+                raise ValueError("Truncated envelope")
+            (dict_id,) = _DICT_ID.unpack_from(view, offset)
+            offset += _DICT_ID.size
+        view = memoryview(decompress(code, view[offset:], dict_id, max_size))
+        offset = 0
+        compression = for_reply(code, dict_id)
+    elif flags & FLAG_DICT:
+        raise ValueError("Unsupported envelope flags")
+
+    if codec == CODEC_BINARY:
+        return _decode_binary(view, offset), codec, compression
+    return json.loads(str(view[offset:], "utf-8")), codec, compression
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""Payload compression for the wire codecs.
+
+DOT source is highly repetitive, so bodies above a size threshold are
+compressed with one of the stdlib codecs. The algorithm is recorded in the
+envelope flags (see utils.codec). zlib can additionally use a preset
+dictionary, identified on the wire by its Adler-32, which helps small graphs
+that are too short to build up much history of their own.
+
+Run as a script to build a dictionary from sample DOT files:
+
+    python utils/compression.py -o dot.zdict ../samples/*.dot
+"""
+
+import bz2
+import lzma
+import zlib
+import argparse
+from collections import Counter
+
+try:
+    from . import log
+except ImportError:
+    # Run as a script to build a dictionary
+    import log
+
+ALGORITHMS = ("zlib", "lzma", "bz2")
+
+# Bodies smaller than this are sent uncompressed
+DEFAULT_THRESHOLD = 256
+
+# zlib only looks back 32 KiB, so larger dictionaries are wasted
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+# Refuse to inflate a payload beyond this many bytes
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+# Preset dictionaries known to this process, by Adler-32
+_dictionaries = {}
+
+# Compression settings used for replies, by (algorithm code, dictionary ID)
+_reply_settings = {}
+
+
+def register_dictionary(zdict):
+    """Make a preset dictionary available for decompression.
+
+    Args:
+        zdict (bytes): The dictionary
+
+    Returns:
+        int: The dictionary ID used on the wire
+    """
+    dict_id = zlib.adler32(zdict)
+    _dictionaries[dict_id] = zdict
+    return dict_id
+
+
+def load_dictionary(path):
+    """Read and register a dictionary file.
+
+    Args:
+        path (str): Path of a dictionary built by train_dictionary
+
+    Returns:
+        bytes: The dictionary, or None on error
+    """
+    try:
+        with open(path, "rb") as f:
+            zdict = f.read()
+    except OSError as e:
+        log.error("Error loading dictionary %s: %s", path, e)
+        return None
+    register_dictionary(zdict)
+    return zdict
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE):
+    """Build a zlib preset dictionary from sample DOT sources.
+
+    Lines that recur across the samples (edge statements, attribute lists,
+    graph headers) are packed into the dictionary, the most common ones
+    last because zlib encodes nearer matches more cheaply.
+
+    Args:
+        samples (list): DOT sources as str
+        size (int): Maximum dictionary size in bytes
+
+    Returns:
+        bytes: The dictionary
+    """
+    lines = Counter()
+    for sample in samples:
+        for line in sample.splitlines(keepends=True):
+            if line.strip():
+                lines[line.encode("utf-8")] += 1
+
+    chosen = []
+    total = 0
+    for line, _ in lines.most_common():
+        if total + len(line) > size:
+            break
+        chosen.append(line)
+        total += len(line)
+    return b"".join(reversed(chosen))
+
+
+class Compression:
+    """How to compress payload bodies."""
+
+    def __init__(self, algorithm="zlib", level=None,
+                 threshold=DEFAULT_THRESHOLD, zdict=None):
+        """Initialize a Compression.
+
+        Args:
+            algorithm (str): One of ALGORITHMS
+            level (int): Compression level (zlib and bz2: 1-9, lzma: 0-9);
+                None for the codec's default
+            threshold (int): Bodies smaller than this are not compressed
+            zdict (bytes): Preset dictionary, zlib only
+
+        Raises:
+            ValueError: For an unknown algorithm or a dictionary with a
+                codec other than zlib
+        """
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown compression algorithm: {algorithm}")
+        if zdict is not None and algorithm != "zlib":
+            raise ValueError("Preset dictionaries need zlib")
+        self.algorithm = algorithm
+        self.code = ALGORITHMS.index(algorithm) + 1
+        self.level = level
+        self.threshold = threshold
+        self.zdict = zdict
+        self.dict_id = register_dictionary(zdict) if zdict else None
+
+    def compress(self, body):
+        """Compress a body if it is large enough and compression pays off.
+
+        Args:
+            body (bytes): The encoded body
+
+        Returns:
+            bytes: The compressed body, or None to send it as is
+        """
+        if len(body) < self.threshold:
+            return None
+        if self.algorithm == "zlib":
+            level = -1 if self.level is None else self.level
+            if self.zdict:
+                compressor = zlib.compressobj(level, zdict=self.zdict)
+            else:
+                compressor = zlib.compressobj(level)
+            data = compressor.compress(body) + compressor.flush()
+        elif self.algorithm == "lzma":
+            data = lzma.compress(body, check=lzma.CHECK_NONE,
+                                 preset=6 if self.level is None else self.level)
+        else:
+            data = bz2.compress(body, 9 if self.level is None else self.level)
+        return data if len(data) < len(body) else None
+
+
+def decompress(code, data, dict_id=None, max_size=MAX_DECOMPRESSED_SIZE):
+    """Inflate a body compressed by Compression.compress.
+
+    Args:
+        code (int): Algorithm code from the envelope flags
+        data (bytes): The compressed body
+        dict_id (int): ID of the preset dictionary, if one was used
+        max_size (int): Largest body accepted
+
+    Returns:
+        bytes: The body
+
+    Raises:
+        ValueError: If the data is corrupt, too large or needs an unknown
+            dictionary
+    """
+    if dict_id is not None and dict_id not in _dictionaries:
+        raise ValueError(f"Unknown compression dictionary {dict_id:08x}")
+    try:
+        if code == 1:
+            if dict_id is not None:
+                decompressor = zlib.decompressobj(zdict=_dictionaries[dict_id])
+            else:
+                decompressor = zlib.decompressobj()
+        elif code == 2:
+            decompressor = lzma.LZMADecompressor()
+        elif code == 3:
+            decompressor = bz2.BZ2Decompressor()
+        else:
+            raise ValueError(f"Unknown compression code {code}")
+        body = decompressor.decompress(data, max_size + 1)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise ValueError(f"Corrupt compressed payload: {e}")
+    if len(body) > max_size:
+        raise ValueError("Decompressed payload too large")
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed payload")
+    return body
+
+
+def for_reply(code, dict_id=None):
+    """Get settings that mirror a request's compression in the reply.
+
+    Args:
+        code (int): Algorithm code from the request's envelope
+        dict_id (int): Preset dictionary the request used, if any
+
+    Returns:
+        Compression: Shared settings for the reply
+    """
+    key = (code, dict_id)
+    compression = _reply_settings.get(key)
+    if compression is None:
+        zdict = _dictionaries.get(dict_id) if dict_id is not None else None
+        compression = Compression(ALGORITHMS[code - 1], zdict=zdict)
+        _reply_settings[key] = compression
+    return compression
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a zlib preset dictionary from sample DOT files")
+    parser.add_argument("samples", nargs="+", help="Sample .dot files")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Dictionary file to write")
+    parser.add_argument("-s", "--size", type=int, default=MAX_DICTIONARY_SIZE,
+                        help=f"Maximum dictionary size in bytes "
+                             f"(default: {MAX_DICTIONARY_SIZE})")
+    args = parser.parse_args()
+
+    samples = []
+    for path in args.samples:
+        with open(path, "r", encoding="utf-8") as f:
+            samples.append(f.read())
+
+    zdict = train_dictionary(samples, args.size)
+    with open(args.output, "wb") as f:
+        f.write(zdict)
+    print(f"Wrote {len(zdict)} byte dictionary {zlib.adler32(zdict):08x} "
+          f"to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
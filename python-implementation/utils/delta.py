@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Line-level deltas between versions of a DOT.
+
+A client that knows which content the server holds for a name can send a
+"delta" request instead of the whole DOT: name is the DOT, size and hash
+describe the new content, and data is a JSON object with the hash of the
+base content and a list of edit operations over its lines:
+
+- a positive int n copies the next n lines of the base
+- a negative int -n skips the next n lines of the base
+- a string is inserted as is
+
+DOT files hold one statement (usually one edge) per line, so a small edit
+to a graph is a small delta. The server replies as to an upload if it
+could rebuild the content, or with a "missing" ack, asking for the full
+DOT, if it does not hold the base or the result does not match the hash.
+"""
+
+import json
+from difflib import SequenceMatcher
+from . import log
+from .cache import answer_get
+from .dot import DOT
+from .protocol import Message
+
+# Deltas at least this fraction of the full content are not worth sending
+MAX_DELTA_RATIO = 0.5
+
+
+def make_delta(base, content):
+    """Compute the edit operations turning one content into another.
+
+    Args:
+        base (str): Content the server holds
+        content (str): New content
+
+    Returns:
+        list: The operations (see module docstring)
+    """
+    old = base.splitlines(keepends=True)
+    new = content.splitlines(keepends=True)
+    ops = []
+    matcher = SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append("".join(new[j1:j2]))
+    return ops
+
+
+def apply_delta(base, ops):
+    """Rebuild content from a base and edit operations.
+
+    Args:
+        base (str): The base content
+        ops (list): Operations from make_delta
+
+    Returns:
+        str: The new content
+
+    Raises:
+        ValueError: If the operations do not fit the base
+    """
+    lines = base.splitlines(keepends=True)
+    out = []
+    pos = 0
+    for op in ops:
+        if isinstance(op, str):
+            out.append(op)
+        elif isinstance(op, int) and not isinstance(op, bool) and op:
+            end = pos + abs(op)
+            if end > len(lines):
+                raise ValueError("Delta runs past the end of the base")
+            if op > 0:
+                out.extend(lines[pos:end])
+            pos = end
+        else:
+            raise ValueError(f"Invalid delta operation: {op!r}")
+    if pos != len(lines):
+        raise ValueError("Delta does not cover the whole base")
+    return "".join(out)
+
+
+def encode_delta(base_hexdigest, ops):
+    """Serialize a delta for the data field of a "delta" request.
+
+    Args:
+        base_hexdigest (str): SHA-256 of the base content in hex
+        ops (list): Operations from make_delta
+
+    Returns:
+        str: The JSON text
+    """
+    return json.dumps({"base": base_hexdigest, "ops": ops},
+                      separators=(",", ":"))
+
+
+def resolve_delta(msg, directory, catalog, cache=None):
+    """Rebuild the DOT a "delta" request describes.
+
+    Args:
+        msg (Message): The request
+        directory (str): The storage directory
+        catalog (Catalog): Index of the stored DOTs
+        cache (DotCache): Cache to read the base from, or None
+
+    Returns:
+        DOT: The new DOT, None if the base is not stored, or False if the
+        delta cannot be applied or the result does not have the requested
+        size and hash
+    """
+    try:
+        delta = json.loads(msg.data or "")
+        base = answer_get(Message(command="get", name=msg.name), directory,
+                          catalog, cache)
+        if base.dot is None or delta["base"] != base.hash:
+            return None
+        dot = DOT(msg.name, apply_delta(base.dot.content, delta["ops"]))
+    except (ValueError, KeyError, TypeError) as e:
+        log.error("Error applying delta for %s: %s", msg.name, e)
+        return False
+    digest = dot.digest()
+    if (digest.size, digest.hexdigest) != (msg.size, msg.hash):
+        log.error("Delta for %s does not match its hash", msg.name)
+        return False
+    return dot
@@ -3,7 +3,16 @@
 
 import os
 import json
+import hashlib
 from pathlib import Path
+from . import log
+from .writer import FileWriter
+
+# Size of the pieces a streamed DOT's content is read and sent in
+CHUNK_SIZE = 256 * 1024
+
+# Writer used by DOT.save when none is given
+_default_writer = FileWriter()
 
 
 class DOT:
@@ -14,32 +23,73 @@ class DOT:
 
         Args:
             name (str): The name of the DOT file (without extension)
-            content (str): The content of the DOT file
+            content (str or iterable): The content of the DOT file, or an
+                iterable of content pieces for a streamed DOT
         """
         self.name = name
         self.content = content
 
-    def save(self, directory):
+    def save(self, directory, writer=None):
         """Save the DOT to a file in the specified directory.
 
+        The file is written under a temporary name and renamed into place,
+        so readers never see a partial file. Streamed content is written
+        piece by piece as it is produced.
+
         Args:
             directory (str): The directory to save the DOT file in
+            writer (FileWriter): Writer deciding durability; atomic writes
+                without syncing if omitted
 
         Returns:
             bool: True if successful, False otherwise
         """
+        writer = writer or _default_writer
         try:
-            # Create directory if it doesn't exist
-            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory, f"{self.name}.dot")
+            if isinstance(self.content, str):
+                writer.write(filename, (self.content,))
+            else:
+                writer.write(filename, self.content)
+            return True
+        except Exception as e:
+            log.error("Error saving DOT file: %s", e)
+            return False
 
+    async def save_async(self, directory, writer=None):
+        """Save a DOT without blocking the event loop on disk syncs.
+
+        Args:
+            directory (str): The directory to save the DOT file in
+            writer (FileWriter): Writer deciding durability
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        writer = writer or _default_writer
+        try:
             filename = os.path.join(directory, f"{self.name}.dot")
-            with open(filename, "w") as f:
-                f.write(self.content)
+            pending = writer.create(directory, f"{self.name}.dot")
+            try:
+                if isinstance(self.content, str):
+                    pending.write(self.content)
+                else:
+                    async for chunk in self.content:
+                        pending.write(chunk)
+            except BaseException:
+                writer.abort(pending)
+                raise
+            await writer.commit_async(pending, filename)
             return True
         except Exception as e:
-            print(f"Error saving DOT file: {e}")
+            log.error("Error saving DOT file: %s", e)
             return False
 
+    @property
+    def is_streamed(self):
+        """bool: Whether the content is an iterable of pieces, not a str."""
+        return not isinstance(self.content, str)
+
     @classmethod
     def load(cls, path):
         """Load a DOT file from disk.
@@ -58,9 +108,41 @@ class DOT:
             name = os.path.splitext(os.path.basename(path))[0]
             return cls(name, content)
         except Exception as e:
-            print(f"Error loading DOT file: {e}")
+            log.error("Error loading DOT file: %s", e)
             return None
 
+    @classmethod
+    def stream(cls, path, chunk_size=CHUNK_SIZE):
+        """Open a DOT file for streaming without reading it into memory.
+
+        Args:
+            path (str): The path to the DOT file
+            chunk_size (int): Number of characters per content piece
+
+        Returns:
+            DOT: A DOT whose content yields the file in pieces, None on error
+        """
+        try:
+            f = open(path, "r")
+        except Exception as e:
+            log.error("Error loading DOT file: %s", e)
+            return None
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        return cls(name, _read_chunks(f, chunk_size))
+
+    def digest(self):
+        """Compute the size and hash of the content.
+
+        Only valid for str content; see ContentDigest for streamed DOTs.
+
+        Returns:
+            ContentDigest: Byte count and SHA-256 of the UTF-8 content
+        """
+        digest = ContentDigest()
+        digest.update(self.content)
+        return digest
+
     def to_dict(self):
         """Convert the DOT object to a dictionary.
 
@@ -87,6 +169,59 @@ class DOT:
         return cls(data["name"], data["content"])
 
 
+class ContentDigest:
+    """Running byte count and SHA-256 hash of DOT content."""
+
+    def __init__(self):
+        """Initialize an empty digest."""
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def update(self, text):
+        """Add a piece of content.
+
+        Args:
+            text (str or bytes): Content piece; str is hashed as UTF-8
+        """
+        data = text.encode("utf-8") if isinstance(text, str) else text
+        self.size += len(data)
+        self._hash.update(data)
+
+    def wrap(self, chunks):
+        """Yield chunks unchanged while adding them to the digest.
+
+        Args:
+            chunks (iterable): Content pieces
+
+        Yields:
+            str: The same pieces
+        """
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    async def wrap_async(self, chunks):
+        """Async variant of wrap for async iterables."""
+        async for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    @property
+    def hexdigest(self):
+        """str: The SHA-256 of the content seen so far, in hex."""
+        return self._hash.hexdigest()
+
+
+def _read_chunks(f, chunk_size):
+    """Yield a file's content in pieces, closing it when exhausted."""
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
 def list_dots(directory):
     """List all DOT files in the specified directory.
 
@@ -107,5 +242,5 @@ def list_dots(directory):
                 dot_files.append(file)
         return dot_files
     except Exception as e:
-        print(f"Error listing DOT files: {e}")
+        log.error("Error listing DOT files: %s", e)
         return [] 
\ No newline at end of file
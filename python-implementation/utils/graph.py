@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+"""Incremental DOT parser building a compact graph model.
+
+DotParser is fed content piece by piece, as a streamed DOT arrives, and
+keeps only the text of an unfinished token between pieces. Statements are
+parsed by a state machine rather than recursion, so parsing can stop at
+any token and resume with the next piece.
+
+Only the structure needed to validate and query a graph is kept: node
+names are interned to integer IDs and edges are two arrays of IDs.
+Attributes are checked for syntax but not stored.
+
+Servers started with --validate parse every upload before acknowledging
+it and answer invalid DOTs with an "invalid" ack, whose data is the
+syntax error, instead of saving them.
+"""
+
+import re
+from array import array
+from . import log
+from .protocol import Message
+
+# Token kinds; punctuation tokens are their own kind
+ID = "id"
+KEYWORD = "keyword"
+EDGEOP = "edgeop"
+
+KEYWORDS = frozenset(("strict", "graph", "digraph", "node", "edge",
+                      "subgraph"))
+
+# A token with the whitespace and comments before it; "other" is anything
+# the pattern cannot handle alone, "end" the end of the text
+_TOKEN = re.compile(r"""
+    (?:[ \t\r\n\f]+|//[^\n]*|/\*.*?\*/|\#[^\n]*)*
+    (?:
+        (?P<id>[A-Za-z_\x80-\U0010ffff][A-Za-z_0-9\x80-\U0010ffff]*)
+      | (?P<num>-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?))
+      | (?P<str>(?P<part>"(?:[^"\\]|\\.)*")
+                (?:[ \t\r\n]*\+[ \t\r\n]*"(?:[^"\\]|\\.)*")*)
+      | (?P<edgeop>->|--)
+      | (?P<punct>[{}\[\];,=:+])
+      | (?P<other>.)
+      | (?P<end>\Z)
+    )
+""", re.VERBOSE | re.DOTALL)
+
+# Whole edge and node statements in their most common form: simple IDs,
+# edge operators and at most one attribute list, parsed in one match
+_FAST_ID = (r'(?:[A-Za-z_][A-Za-z_0-9]*(?![A-Za-z_0-9\x80-\U0010ffff])'
+            r'|"[^"\\\n]*"|[0-9]+(?![A-Za-z_0-9.\x80-\U0010ffff]))')
+_FAST_STMT = r"""
+    [ \t\r\n]*
+    (?P<ids>{id}(?:[ \t\r\n]*{op}[ \t\r\n]*{id})*)
+    (?:[ \t\r\n]*(?P<attrs>\[[^\[\]"\\\n]*(?:"[^"\\\n]*"[^\[\]"\\\n]*)*\]))?
+    (?:[ \t\r\n]*;|(?=[ \t\r\n]*[A-Za-z_0-9"{{}}<]))
+"""
+_FAST_DIGRAPH = re.compile(_FAST_STMT.format(id=_FAST_ID, op="->"), re.VERBOSE)
+_FAST_GRAPH = re.compile(_FAST_STMT.format(id=_FAST_ID, op="--"), re.VERBOSE)
+_FAST_NAME = re.compile(_FAST_ID)
+_FAST_ATTRS = re.compile(
+    r"(?:[ \t\r\n]*{id}[ \t\r\n]*=[ \t\r\n]*{id}[ \t\r\n]*[,;]?)*[ \t\r\n]*"
+    .format(id=_FAST_ID))
+
+# What may follow a quoted string that a later piece could extend with +
+_STR_TAIL = re.compile(
+    r'[ \t\r\n]*(?:\+[ \t\r\n]*(?:"(?:[^"\\]|\\.)*\\?)?)?\Z', re.DOTALL)
+
+# One quoted part of a string, possibly joined to others with +
+_STR_PART = re.compile(r'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
+# Parser states
+(_HEADER, _STRICT, _GRAPH_ID, _BODY, _STMT, _STMT_ID, _GRAPH_ATTR,
+ _OPERAND, _PORT, _PORT_ID, _COMPASS, _EDGE_RHS, _SUBGRAPH, _SUBGRAPH_OPEN,
+ _ATTR_STMT, _ATTR_LIST, _ATTR_KEY, _ATTR_VALUE, _AFTER_ATTRS,
+ _DONE) = range(20)
+
+
+class DotSyntaxError(ValueError):
+    """Raised when DOT content is not a valid graph."""
+
+    def __init__(self, message, line=None):
+        """Initialize a DotSyntaxError.
+
+        Args:
+            message (str): What is wrong
+            line (int): 1-based line of the offending token, if known
+        """
+        self.line = line
+        super().__init__(f"line {line}: {message}" if line else message)
+
+
+class Graph:
+    """Nodes and edges of a parsed DOT graph."""
+
+    __slots__ = ("name", "directed", "strict", "nodes", "ids", "sources",
+                 "targets", "subgraphs")
+
+    def __init__(self, name="", directed=True, strict=False):
+        """Initialize an empty Graph.
+
+        Args:
+            name (str): The graph's ID, empty if anonymous
+            directed (bool): Whether it is a digraph
+            strict (bool): Whether it was declared strict
+        """
+        self.name = name
+        self.directed = directed
+        self.strict = strict
+        self.nodes = []
+        self.ids = {}
+        self.sources = array("I")
+        self.targets = array("I")
+        self.subgraphs = 0
+
+    def __repr__(self):
+        """Summarize the graph."""
+        kind = "digraph" if self.directed else "graph"
+        return (f"<Graph {kind} {self.name!r}: {len(self.nodes)} nodes, "
+                f"{len(self.sources)} edges>")
+
+    @property
+    def node_count(self):
+        """int: Number of distinct nodes."""
+        return len(self.nodes)
+
+    @property
+    def edge_count(self):
+        """int: Number of edges, counting repeated ones."""
+        return len(self.sources)
+
+    def add_node(self, name):
+        """Get a node's ID, adding the node if it is new.
+
+        Args:
+            name (str): The node's name
+
+        Returns:
+            int: The node's ID
+        """
+        node = self.ids.get(name)
+        if node is None:
+            node = self.ids[name] = len(self.nodes)
+            self.nodes.append(name)
+        return node
+
+    def add_edge(self, source, target):
+        """Add an edge between two node IDs.
+
+        Args:
+            source (int): ID of the tail node
+            target (int): ID of the head node
+        """
+        self.sources.append(source)
+        self.targets.append(target)
+
+    def edges(self):
+        """Iterate over the edges by node name.
+
+        Yields:
+            tuple: (source name, target name)
+        """
+        nodes = self.nodes
+        for source, target in zip(self.sources, self.targets):
+            yield nodes[source], nodes[target]
+
+    def neighbors(self, name):
+        """Get the nodes an edge leads to from a node.
+
+        For undirected graphs, edges lead both ways.
+
+        Args:
+            name (str): The node's name
+
+        Returns:
+            list: Names of the neighbors, in edge order
+        """
+        node = self.ids.get(name)
+        if node is None:
+            return []
+        nodes = self.nodes
+        result = [nodes[t] for s, t in zip(self.sources, self.targets)
+                  if s == node]
+        if not self.directed:
+            result.extend(nodes[s] for s, t in zip(self.sources, self.targets)
+                          if t == node and s != node)
+        return result
+
+    def summary(self):
+        """Get the counts reported to clients.
+
+        Returns:
+            dict: Node, edge and subgraph counts
+        """
+        return {"nodes": len(self.nodes), "edges": len(self.sources),
+                "subgraphs": self.subgraphs}
+
+
+class DotParser:
+    """Parses DOT content fed in pieces of any size.
+
+    Example:
+        parser = DotParser()
+        for piece in pieces:
+            parser.feed(piece)
+        graph = parser.close()
+    """
+
+    __slots__ = ("graph", "_buffer", "_line", "_final", "_state", "_frames",
+                 "_pending", "_operand", "_tail", "_edge", "error")
+
+    def __init__(self):
+        """Initialize a DotParser."""
+        self.graph = Graph()
+        self._buffer = ""
+        # Lines in the text already consumed from the buffer
+        self._line = 1
+        self._final = False
+        self._state = _HEADER
+        # Open braces; for subgraphs: [nodes, outer tail, outer edge flag]
+        self._frames = []
+        self._pending = None
+        self._operand = None
+        self._tail = None
+        self._edge = False
+        # The syntax error wrap() raised, if any
+        self.error = None
+
+    def feed(self, text):
+        """Parse a piece of content.
+
+        Args:
+            text (str): The next piece
+
+        Raises:
+            DotSyntaxError: If the content so far is not valid DOT
+        """
+        buffer = self._buffer + text if self._buffer else text
+        self._buffer = ""
+        self._tokens(buffer)
+
+    def close(self):
+        """Finish parsing.
+
+        Returns:
+            Graph: The parsed graph
+
+        Raises:
+            DotSyntaxError: If the content is not a complete, valid graph
+        """
+        self._final = True
+        buffer, self._buffer = self._buffer, ""
+        self._tokens(buffer)
+        if self._state != _DONE:
+            raise DotSyntaxError("Unexpected end of content", self._line)
+        return self.graph
+
+    def wrap(self, chunks):
+        """Yield content pieces unchanged while parsing them.
+
+        A syntax error is raised once the pieces are exhausted, so a stream
+        is always read to its end.
+
+        Args:
+            chunks (iterable): Content pieces
+
+        Yields:
+            str: The same pieces
+
+        Raises:
+            DotSyntaxError: If the content is not a valid graph
+        """
+        error = None
+        for chunk in chunks:
+            if error is None:
+                try:
+                    self.feed(chunk)
+                except DotSyntaxError as e:
+                    error = e
+            yield chunk
+        self._finish(error)
+
+    async def wrap_async(self, chunks):
+        """Async variant of wrap for async iterables."""
+        error = None
+        async for chunk in chunks:
+            if error is None:
+                try:
+                    self.feed(chunk)
+                except DotSyntaxError as e:
+                    error = e
+            yield chunk
+        self._finish(error)
+
+    def _finish(self, error):
+        """End a wrapped stream, raising its first syntax error."""
+        if error is None:
+            try:
+                self.close()
+                return
+            except DotSyntaxError as e:
+                error = e
+        self.error = error
+        raise error
+
+    def _tokens(self, buffer):
+        """Tokenize and parse a buffer, keeping an unfinished token."""
+        match = _TOKEN.match
+        token = self._token
+        final = self._final
+        end = len(buffer)
+        pos = 0
+        try:
+            while True:
+                if self._state == _STMT:
+                    fast = (_FAST_DIGRAPH if self.graph.directed
+                            else _FAST_GRAPH).match(buffer, pos)
+                    if fast is not None and self._fast(buffer, fast):
+                        pos = fast.end()
+                        continue
+                m = match(buffer, pos)
+                stop = m.end()
+                if stop == end and not final:
+                    # May continue in the next piece
+                    pos = m.start()
+                    break
+                kind = m.lastgroup
+                if kind == "id":
+                    value = m.group(kind)
+                    lowered = value.lower()
+                    if lowered in KEYWORDS:
+                        token(KEYWORD, lowered)
+                    else:
+                        token(ID, value)
+                elif kind == "punct":
+                    value = m.group(kind)
+                    token(value, value)
+                elif kind == "str":
+                    if not final and _STR_TAIL.match(buffer, stop):
+                        # A later piece may add "+ ..."
+                        pos = m.start()
+                        break
+                    if m.end("part") == stop:
+                        text = buffer[m.start(kind) + 1:stop - 1]
+                    else:
+                        text = "".join(_STR_PART.findall(m.group(kind)))
+                    if "\\" in text:
+                        text = (text.replace('\\"', '"')
+                                .replace("\\\n", "").replace("\\\r\n", ""))
+                    token(ID, text)
+                elif kind == "edgeop":
+                    token(EDGEOP, m.group(kind))
+                elif kind == "num":
+                    token(ID, m.group(kind))
+                elif kind == "other":
+                    pos = m.start(kind)
+                    stop = self._special(buffer, pos)
+                    if stop is None:
+                        break
+                else:
+                    pos = stop
+                    break
+                pos = stop
+        except DotSyntaxError as e:
+            if e.line is None:
+                e.line = self._line + buffer.count("\n", 0, pos)
+                e.args = (f"line {e.line}: {e.args[0]}",)
+            raise
+        self._line += buffer.count("\n", 0, pos)
+        self._buffer = buffer[pos:]
+
+    def _fast(self, buffer, fast):
+        """Apply a statement matched by the fast pattern.
+
+        Returns:
+            bool: False if it needs the full state machine after all
+        """
+        attrs = fast.start("attrs")
+        if attrs >= 0 and not _FAST_ATTRS.fullmatch(buffer, attrs + 1,
+                                                    fast.end("attrs") - 1):
+            return False
+        names = _FAST_NAME.findall(buffer, fast.start("ids"), fast.end("ids"))
+        for name in names:
+            if name[0] != '"' and name.lower() in KEYWORDS:
+                return False
+        add_node = self.graph.add_node
+        nodes = [add_node(name[1:-1] if name[0] == '"' else name)
+                 for name in names]
+        if len(nodes) > 1:
+            self.graph.sources.extend(nodes[:-1])
+            self.graph.targets.extend(nodes[1:])
+        frame = self._frames[-1]
+        if frame is not None:
+            frame[0].extend(nodes)
+        return True
+
+    def _special(self, buffer, pos):
+        """Handle text the token pattern does not match.
+
+        Returns:
+            int: Position after an HTML string, or None to wait for more
+            content
+
+        Raises:
+            DotSyntaxError: If the text is not valid DOT
+        """
+        char = buffer[pos]
+        if char == "<":
+            depth = 0
+            for i in range(pos, len(buffer)):
+                c = buffer[i]
+                if c == "<":
+                    depth += 1
+                elif c == ">":
+                    depth -= 1
+                    if not depth:
+                        self._token(ID, buffer[pos + 1:i])
+                        return i + 1
+            if not self._final:
+                return None
+            raise DotSyntaxError("Unterminated HTML string")
+        if not self._final and (
+                char == '"' or (char == "/" and buffer.startswith("/*", pos))
+                or (char in "/-." and len(buffer) - pos < 3)):
+            # A string, comment, number or edge operator cut short
+            return None
+        if char == '"':
+            raise DotSyntaxError("Unterminated string")
+        if char == "/":
+            raise DotSyntaxError("Unterminated comment")
+        raise DotSyntaxError(f"Unexpected character {char!r}")
+
+    def _token(self, kind, value):
+        """Advance the state machine by one token."""
+        state = self._state
+        while True:
+            if state == _STMT:
+                if kind == ID:
+                    self._pending = value
+                    state = _STMT_ID
+                elif kind == ";":
+                    pass
+                elif kind == "}":
+                    state = self._close_brace()
+                elif kind == "{":
+                    self._open_subgraph()
+                elif kind == KEYWORD:
+                    if value == "subgraph":
+                        state = _SUBGRAPH
+                    elif value in ("graph", "node", "edge"):
+                        state = _ATTR_STMT
+                    else:
+                        raise DotSyntaxError(f"Unexpected '{value}'")
+                else:
+                    raise DotSyntaxError(f"Unexpected '{value}'")
+            elif state == _STMT_ID:
+                if kind == "=":
+                    state = _GRAPH_ATTR
+                else:
+                    self._add_operand([self.graph.add_node(self._pending)])
+                    state = _OPERAND
+                    continue
+            elif state == _OPERAND:
+                if kind == EDGEOP:
+                    if (value == "->") != self.graph.directed:
+                        raise DotSyntaxError(
+                            f"'{value}' in a "
+                            f"{'digraph' if self.graph.directed else 'graph'}")
+                    self._edge = True
+                    state = _EDGE_RHS
+                elif kind == ":" and len(self._operand) == 1:
+                    state = _PORT
+                elif kind == "[":
+                    state = _ATTR_LIST
+                else:
+                    self._end_statement()
+                    state = _STMT
+                    continue
+            elif state == _EDGE_RHS:
+                if kind == ID:
+                    self._add_operand([self.graph.add_node(value)])
+                    state = _OPERAND
+                elif kind == "{":
+                    self._open_subgraph()
+                    state = _STMT
+                elif kind == KEYWORD and value == "subgraph":
+                    state = _SUBGRAPH
+                else:
+                    raise DotSyntaxError(f"Expected a node after edge "
+                                         f"operator, got '{value}'")
+            elif state == _ATTR_LIST:
+                if kind == "]":
+                    state = _AFTER_ATTRS
+                elif kind == ID:
+                    state = _ATTR_KEY
+                elif kind not in (",", ";"):
+                    raise DotSyntaxError(f"Unexpected '{value}' in "
+                                         f"attribute list")
+            elif state == _ATTR_KEY:
+                if kind != "=":
+                    raise DotSyntaxError("Expected '=' after attribute name")
+                state = _ATTR_VALUE
+            elif state == _ATTR_VALUE:
+                if kind != ID:
+                    raise DotSyntaxError(f"Expected attribute value, got "
+                                         f"'{value}'")
+                state = _ATTR_LIST
+            elif state == _AFTER_ATTRS:
+                if kind == "[":
+                    state = _ATTR_LIST
+                else:
+                    self._end_statement()
+                    state = _STMT
+                    continue
+            elif state == _ATTR_STMT:
+                if kind != "[":
+                    raise DotSyntaxError("Expected '[' after attribute "
+                                         "statement keyword")
+                state = _ATTR_LIST
+            elif state == _GRAPH_ATTR:
+                if kind != ID:
+                    raise DotSyntaxError(f"Expected a value after '=', got "
+                                         f"'{value}'")
+                state = _STMT
+            elif state == _PORT:
+                if kind != ID:
+                    raise DotSyntaxError("Expected a port after ':'")
+                state = _PORT_ID
+            elif state == _PORT_ID:
+                if kind == ":":
+                    state = _COMPASS
+                else:
+                    state = _OPERAND
+                    continue
+            elif state == _COMPASS:
+                if kind != ID:
+                    raise DotSyntaxError("Expected a compass point after ':'")
+                state = _OPERAND
+            elif state == _SUBGRAPH:
+                if kind == ID:
+                    state = _SUBGRAPH_OPEN
+                elif kind == "{":
+                    self._open_subgraph()
+                    state = _STMT
+                else:
+                    raise DotSyntaxError("Expected '{' after 'subgraph'")
+            elif state == _SUBGRAPH_OPEN:
+                if kind != "{":
+                    raise DotSyntaxError("Expected '{' after subgraph name")
+                self._open_subgraph()
+                state = _STMT
+            elif state == _HEADER:
+                if kind == KEYWORD and value == "strict":
+                    self.graph.strict = True
+                    state = _STRICT
+                elif kind == KEYWORD and value in ("graph", "digraph"):
+                    self.graph.directed = value == "digraph"
+                    state = _GRAPH_ID
+                else:
+                    raise DotSyntaxError("Expected 'graph' or 'digraph'")
+            elif state == _STRICT:
+                if kind != KEYWORD or value not in ("graph", "digraph"):
+                    raise DotSyntaxError("Expected 'graph' or 'digraph'")
+                self.graph.directed = value == "digraph"
+                state = _GRAPH_ID
+            elif state == _GRAPH_ID:
+                if kind == ID:
+                    self.graph.name = value
+                    state = _BODY
+                elif kind == "{":
+                    self._frames.append(None)
+                    state = _STMT
+                else:
+                    raise DotSyntaxError("Expected '{' to open the graph")
+            elif state == _BODY:
+                if kind != "{":
+                    raise DotSyntaxError("Expected '{' to open the graph")
+                self._frames.append(None)
+                state = _STMT
+            else:
+                raise DotSyntaxError(f"Unexpected '{value}' after the graph")
+            break
+        self._state = state
+
+    def _add_operand(self, nodes):
+        """Complete an edge operand, adding edges from the previous one."""
+        if self._edge:
+            add_edge = self.graph.add_edge
+            for source in self._tail:
+                for target in nodes:
+                    add_edge(source, target)
+            self._edge = False
+        frame = self._frames[-1]
+        if frame is not None:
+            frame[0].extend(nodes)
+        self._operand = self._tail = nodes
+
+    def _end_statement(self):
+        """Forget the edge chain of the statement that just ended."""
+        self._operand = self._tail = None
+        self._edge = False
+
+    def _open_subgraph(self):
+        """Enter a subgraph body, saving the enclosing statement."""
+        self.graph.subgraphs += 1
+        self._frames.append([[], self._tail, self._edge])
+        self._tail = None
+        self._edge = False
+
+    def _close_brace(self):
+        """Leave a subgraph or the graph body.
+
+        Returns:
+            int: The next state
+        """
+        frame = self._frames.pop()
+        if frame is None:
+            return _DONE
+        nodes, self._tail, self._edge = frame
+        # Also adds the nodes to the enclosing subgraph
+        self._add_operand(nodes)
+        return _OPERAND
+
+
+def parse(content):
+    """Parse a complete DOT document.
+
+    Args:
+        content (str or iterable): The content, or its pieces
+
+    Returns:
+        Graph: The parsed graph
+
+    Raises:
+        DotSyntaxError: If the content is not a valid graph
+    """
+    parser = DotParser()
+    if isinstance(content, str):
+        parser.feed(content)
+    else:
+        for piece in content:
+            parser.feed(piece)
+    return parser.close()
+
+
+def check_dot(dot):
+    """Validate a DOT with str content.
+
+    Args:
+        dot (DOT): The DOT
+
+    Returns:
+        DotSyntaxError: What is wrong with it, or None if it is a valid graph
+    """
+    try:
+        parse(dot.content)
+    except DotSyntaxError as e:
+        return e
+    return None
+
+
+def answer_invalid(msg, error):
+    """Reject an upload that is not a valid graph.
+
+    Args:
+        msg (Message): The upload request
+        error (DotSyntaxError): What is wrong with its DOT
+
+    Returns:
+        Message: The "invalid" ack
+    """
+    name = msg.dot.name if msg.dot else msg.name
+    log.info("Rejected invalid DOT %s: %s", name, error)
+    return Message("ack", "invalid", name, data=str(error), id_=msg.id,
+                   codec=msg.codec, compression=msg.compression)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Leveled, rate-limited logging for the servers.
+
+Messages below the current level are dropped before they are formatted, so
+per-message logging costs a comparison when it is off. Each message kind
+(its format string) may be printed at most `rate` times per second; the
+rest are counted and summarized once the next one is printed.
+
+Example:
+    log.info("Received DOT '%s' from %s", dot.name, address)
+"""
+
+import time
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+# Default messages of one kind printed per second, 0 for no limit
+RATE_LIMIT = 100
+
+_level = INFO
+_rate = RATE_LIMIT
+_lock = threading.Lock()
+# Format string -> [second it counts for, printed in it, suppressed]
+_windows = {}
+
+
+def configure(level="info", rate=RATE_LIMIT):
+    """Set the level and rate limit.
+
+    Args:
+        level (str): One of LEVELS; less severe messages are dropped
+        rate (int): Messages of one kind printed per second, 0 for no limit
+    """
+    global _level, _rate
+    _level = LEVELS[level]
+    _rate = rate
+    with _lock:
+        _windows.clear()
+
+
+def enabled(level):
+    """Check whether messages of a level are printed.
+
+    Args:
+        level (int): DEBUG, INFO, WARNING or ERROR
+
+    Returns:
+        bool: True if they are
+    """
+    return level >= _level
+
+
+def log(level, message, *args):
+    """Print a message if its level is enabled and its kind is not over
+    the rate limit.
+
+    Args:
+        level (int): DEBUG, INFO, WARNING or ERROR
+        message (str): %-style format string, also identifying the kind
+        *args: Values for the format string
+    """
+    if level < _level:
+        return
+    suppressed = 0
+    if _rate:
+        second = int(time.monotonic())
+        with _lock:
+            window = _windows.get(message)
+            if window is None:
+                window = _windows[message] = [second, 0, 0]
+            if window[0] != second:
+                suppressed = window[2]
+                window[:] = [second, 0, 0]
+            if window[1] >= _rate:
+                window[2] += 1
+                return
+            window[1] += 1
+    if suppressed:
+        print(f"({suppressed} similar messages suppressed)")
+    print(message % args if args else message)
+
+
+def debug(message, *args):
+    """Log at DEBUG level (see log)."""
+    log(DEBUG, message, *args)
+
+
+def info(message, *args):
+    """Log at INFO level (see log)."""
+    log(INFO, message, *args)
+
+
+def warning(message, *args):
+    """Log at WARNING level (see log)."""
+    log(WARNING, message, *args)
+
+
+def error(message, *args):
+    """Log at ERROR level (see log)."""
+    log(ERROR, message, *args)
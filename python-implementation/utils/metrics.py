@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Server counters and per-stage latency histograms.
+
+A Metrics object counts requests by command, connections and bytes in and
+out, and keeps a histogram of the time spent in each stage of handling an
+upload:
+
+- read: reading a frame, from its size header to its last byte
+- decode: decoding the frame into a Message
+- validate: parsing the DOT (servers started with --validate)
+- save: writing the DOT to storage
+- ack: encoding and sending the reply
+
+Servers answer a "stats" request with snapshot() as JSON in the reply's
+data, and can serve render() in the Prometheus text format over HTTP (see
+serve). Other components, such as the writer pool and the cache, add
+their stats() as gauges with add_source.
+"""
+
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import log
+from .protocol import Message
+
+STAGES = ("read", "decode", "validate", "save", "ack")
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts of observed durations in the fixed BUCKETS."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        """Initialize an empty Histogram."""
+        # One count per bucket, plus one for longer durations
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        """Add a duration; the caller holds the owner's lock."""
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of its bucket.
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            float: Seconds, None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Counters and stage histograms of one server process."""
+
+    def __init__(self):
+        """Initialize a Metrics object with everything at zero."""
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.connections = 0
+        self.active = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self._sources = []
+
+    def request(self, command):
+        """Count a request.
+
+        Args:
+            command (str): Its command; legacy uploads have none
+        """
+        command = command or "upload"
+        with self.lock:
+            self.requests[command] = self.requests.get(command, 0) + 1
+
+    def observe(self, stage, seconds):
+        """Record the time a stage took.
+
+        Args:
+            stage (str): One of STAGES
+            seconds (float): The duration
+        """
+        with self.lock:
+            self.stages[stage].observe(seconds)
+
+    def received(self, size):
+        """Count bytes read from clients."""
+        with self.lock:
+            self.bytes_in += size
+
+    def sent(self, size):
+        """Count bytes sent to clients."""
+        with self.lock:
+            self.bytes_out += size
+
+    def error(self):
+        """Count a request that failed."""
+        with self.lock:
+            self.errors += 1
+
+    def connected(self):
+        """Count a new connection."""
+        with self.lock:
+            self.connections += 1
+            self.active += 1
+
+    def disconnected(self):
+        """Count a closed connection."""
+        with self.lock:
+            self.active -= 1
+
+    def add_source(self, prefix, stats):
+        """Export another component's statistics as gauges.
+
+        Args:
+            prefix (str): Name prefix of its gauges, such as "writer"
+            stats (callable): Returns a dict of numbers, like
+                WritePool.stats
+        """
+        self._sources.append((prefix, stats))
+
+    def snapshot(self):
+        """Get all metrics.
+
+        Returns:
+            dict: Counters, stage histograms with count, total and estimated
+            p50/p99 in milliseconds, and the sources' stats by prefix
+        """
+        with self.lock:
+            data = {
+                "uptime": time.time() - self.started,
+                "requests": dict(self.requests),
+                "connections": self.connections,
+                "active_connections": self.active,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "errors": self.errors,
+                "stages": {},
+            }
+            for stage, hist in self.stages.items():
+                if hist.count:
+                    data["stages"][stage] = {
+                        "count": hist.count,
+                        "total_ms": hist.sum * 1000,
+                        "p50_ms": hist.quantile(0.5) * 1000,
+                        "p99_ms": hist.quantile(0.99) * 1000,
+                    }
+        for prefix, stats in self._sources:
+            data[prefix] = stats()
+        return data
+
+    def render(self):
+        """Format all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics page
+        """
+        lines = []
+
+        def metric(name, kind, help_, samples):
+            lines.append(f"# HELP dot_{name} {help_}")
+            lines.append(f"# TYPE dot_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"dot_{name}{labels} {value}")
+
+        with self.lock:
+            metric("requests_total", "counter", "Requests received",
+                   [(f'{{command="{command}"}}', n)
+                    for command, n in sorted(self.requests.items())])
+            metric("connections_total", "counter", "Connections accepted",
+                   [("", self.connections)])
+            metric("connections_active", "gauge", "Open connections",
+                   [("", self.active)])
+            metric("received_bytes_total", "counter",
+                   "Bytes read from clients", [("", self.bytes_in)])
+            metric("sent_bytes_total", "counter", "Bytes sent to clients",
+                   [("", self.bytes_out)])
+            metric("errors_total", "counter", "Requests that failed",
+                   [("", self.errors)])
+            samples = []
+            for stage, hist in self.stages.items():
+                cumulative = 0
+                for bound, n in zip(BUCKETS, hist.counts):
+                    cumulative += n
+                    samples.append((f'_bucket{{stage="{stage}",le="{bound}"}}',
+                                    cumulative))
+                samples.append((f'_bucket{{stage="{stage}",le="+Inf"}}',
+                                hist.count))
+                samples.append((f'_sum{{stage="{stage}"}}', hist.sum))
+                samples.append((f'_count{{stage="{stage}"}}', hist.count))
+            metric("stage_seconds", "histogram",
+                   "Time spent in each stage of handling a request", samples)
+        for prefix, stats in self._sources:
+            for key, value in stats().items():
+                metric(f"{prefix}_{key}", "gauge", f"{prefix} {key}",
+                       [("", value)])
+        return "\n".join(lines) + "\n"
+
+    def format_stats(self):
+        """Summarize the metrics on one line.
+
+        Returns:
+            str: The summary
+        """
+        s = self.snapshot()
+        stages = " ".join(
+            f"{stage}={v['p50_ms']:g}/{v['p99_ms']:g}ms"
+            for stage, v in s["stages"].items())
+        return (f"requests={sum(s['requests'].values())} "
+                f"errors={s['errors']} active={s['active_connections']} "
+                f"in={s['bytes_in']} out={s['bytes_out']} "
+                f"p50/p99 {stages}")
+
+    def report(self, interval, label="Metrics"):
+        """Log format_stats() every `interval` seconds from a daemon thread.
+
+        Args:
+            interval (float): Seconds between reports
+            label (str): Prefix of each report
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                log.info("%s: %s", label, self.format_stats())
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serve render() at /metrics over HTTP from a daemon thread.
+
+        Args:
+            port (int): Port to listen on
+            host (str): Address to listen on
+
+        Returns:
+            ThreadingHTTPServer: The HTTP server, or None if it could not
+            listen
+        """
+        try:
+            server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            log.error("Error serving metrics on port %s: %s", port, e)
+            return None
+        server.daemon_threads = True
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics with the server's metrics."""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keep scrapes out of the server's output."""
+
+
+def timed(metrics, stage, fn, *args):
+    """Call a function, recording its duration as a stage.
+
+    Args:
+        metrics (Metrics): Where to record it, or None to just call fn
+        stage (str): One of STAGES
+        fn (callable): The function
+        *args: Its arguments
+
+    Returns:
+        The function's result
+    """
+    if metrics is None:
+        return fn(*args)
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        metrics.observe(stage, time.perf_counter() - start)
+
+
+def answer_stats(msg, metrics):
+    """Answer a "stats" request.
+
+    Args:
+        msg (Message): The request
+        metrics (Metrics): The server's metrics
+
+    Returns:
+        Message: The reply, with snapshot() as JSON in its data
+    """
+    return Message("ack", "stats", data=json.dumps(metrics.snapshot()),
+                   id_=msg.id, codec=msg.codec, compression=msg.compression)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""On-demand sampling profiler for live servers.
+
+A Profiler does nothing until it is started, by a signal (see
+install_signals) or a "profile" request. It then samples the stack of
+every thread for a number of seconds from a daemon thread, and writes:
+
+- <base>.folded: one line per distinct stack, "frame;frame;... count",
+  root first, as read by flamegraph.pl, speedscope and inferno
+- <base>.txt: the functions with the most samples, by thread and overall
+
+Samples are taken by wall clock, so time a thread spends blocked on a
+socket, a lock or the disk is counted like time on the CPU. With the
+asyncio engine, the event loop thread's stacks show where it does not
+yield.
+
+A memory profile also traces allocations with tracemalloc for the same
+seconds, which slows the server down while it runs. Of the snapshots taken
+during the run, the one with the most memory traced is kept. The report
+lists the lines that allocated the most of it, and the snapshot is saved as
+<base>.tracemalloc for tracemalloc.Snapshot.load. Snapshots are only
+analyzed once tracing has stopped.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import signal
+import threading
+import traceback
+import tracemalloc
+from collections import Counter
+from . import log
+from .protocol import Message
+
+# Default seconds to profile for, and the longest allowed
+PROFILE_SECONDS = 10
+MAX_SECONDS = 600
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.01
+
+# Seconds between tracemalloc snapshots, and frames kept per allocation
+SNAPSHOT_INTERVAL = 0.5
+MEMORY_FRAMES = 10
+
+# Lines in each table of the report
+TOP = 25
+
+_THREAD_NUMBER = re.compile(r"-\d+")
+
+
+class Profiler:
+    """Samples all threads on request and writes the results to a directory."""
+
+    def __init__(self, directory, seconds=PROFILE_SECONDS,
+                 interval=SAMPLE_INTERVAL):
+        """Initialize a Profiler.
+
+        Args:
+            directory (str): Where profiles are written
+            seconds (float): Default length of a profile
+            interval (float): Seconds between samples
+        """
+        self.directory = directory
+        self.seconds = seconds
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self, seconds=None, memory=False):
+        """Start profiling in the background unless a profile is running.
+
+        Args:
+            seconds (float): How long to sample, the default if None
+            memory (bool): Trace allocations too
+
+        Returns:
+            list: Paths of the files that will be written, or None if a
+            profile is already running
+        """
+        seconds = min(seconds or self.seconds, MAX_SECONDS)
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.directory,
+                            f"profile-{os.getpid()}-{stamp}")
+        files = [base + ".folded", base + ".txt"]
+        if memory:
+            files.append(base + ".tracemalloc")
+        log.info("Profiling %sstacks for %gs into %s.*",
+                 "memory and " if memory else "", seconds, base)
+        threading.Thread(target=self._run, args=(base, seconds, memory),
+                         daemon=True).start()
+        return files
+
+    def _run(self, base, seconds, memory):
+        """Take a profile and write it; runs on its own thread."""
+        try:
+            stacks, samples, largest = self._sample(seconds, memory)
+            os.makedirs(self.directory, exist_ok=True)
+            with open(base + ".folded", "w") as f:
+                for (thread, stack), n in stacks.most_common():
+                    frames = [thread] + [_label(code) for code in
+                                         reversed(stack)]
+                    f.write(f"{';'.join(frames)} {n}\n")
+            with open(base + ".txt", "w") as f:
+                f.write(self._report(stacks, samples, seconds))
+                if largest is not None:
+                    f.write(_memory_report(*largest))
+                    largest[0].dump(base + ".tracemalloc")
+            log.info("Profile written to %s.*", base)
+        except Exception:
+            log.error("Error profiling:\n%s", traceback.format_exc().rstrip())
+        finally:
+            self._running = False
+
+    def _sample(self, seconds, memory):
+        """Sample every other thread's stack until the time is up.
+
+        Returns:
+            tuple: (Counter of (thread, stack) samples, number of sampling
+            rounds, and without memory None, else a tuple of the snapshot
+            with the most memory traced, the bytes traced in it and the
+            peak bytes traced)
+        """
+        stacks = Counter()
+        names = {}
+        me = threading.get_ident()
+        samples = 0
+        largest = None
+        if memory:
+            tracemalloc.start(MEMORY_FRAMES)
+        try:
+            now = time.monotonic()
+            deadline = now + seconds
+            next_snapshot = now
+            while now < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    if ident not in names:
+                        names = _thread_names()
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    stacks[names.get(ident, "thread"), tuple(stack)] += 1
+                samples += 1
+                if memory and now >= next_snapshot:
+                    # Taking a snapshot is cheap, analyzing it is not
+                    traced = tracemalloc.get_traced_memory()[0]
+                    if largest is None or traced > largest[1]:
+                        largest = (tracemalloc.take_snapshot(), traced)
+                    next_snapshot = now + SNAPSHOT_INTERVAL
+                time.sleep(self.interval)
+                now = time.monotonic()
+            if memory:
+                largest += (tracemalloc.get_traced_memory()[1],)
+        finally:
+            if memory:
+                tracemalloc.stop()
+        return stacks, samples, largest
+
+    def _report(self, stacks, samples, seconds):
+        """Format the top functions of a profile.
+
+        Returns:
+            str: The report
+        """
+        total = sum(stacks.values()) or 1
+        threads = Counter()
+        own = Counter()
+        inclusive = Counter()
+        for (thread, stack), n in stacks.items():
+            threads[thread] += n
+            if stack:
+                own[stack[0]] += n
+            for code in set(stack):
+                inclusive[code] += n
+
+        lines = [f"Profile of process {os.getpid()}: {seconds:g}s, "
+                 f"{samples} samples of every thread "
+                 f"{self.interval * 1000:g}ms apart",
+                 "Wall-clock samples: time blocked on sockets, locks and "
+                 "disk is counted too.",
+                 "",
+                 "Samples by thread:"]
+        for thread, n in threads.most_common(TOP):
+            lines.append(f"  {n / total:7.1%}  {thread}")
+        lines += ["", "Top functions by own samples:",
+                  f"  {'own':>7}  {'total':>7}  function"]
+        for code, n in own.most_common(TOP):
+            lines.append(f"  {n / total:7.1%}  {inclusive[code] / total:7.1%}"
+                         f"  {_label(code)}")
+        lines += ["", "Top functions including callees:",
+                  f"  {'total':>7}  function"]
+        for code, n in inclusive.most_common(TOP):
+            lines.append(f"  {n / total:7.1%}  {_label(code)}")
+        return "\n".join(lines) + "\n"
+
+
+def _label(code):
+    """Name a code object as "function (dir/file.py:line)"."""
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({_short(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _short(path):
+    """Shorten a source path to its last directory and file name."""
+    return "/".join(path.replace(os.sep, "/").rsplit("/", 2)[-2:])
+
+
+def _thread_names():
+    """Map thread idents to names without their numbers, so that the
+    threads of one kind are grouped together."""
+    return {thread.ident: _THREAD_NUMBER.sub("", thread.name)
+            for thread in threading.enumerate()}
+
+
+def _memory_report(snapshot, traced, peak):
+    """Format the lines holding the most memory in a snapshot.
+
+    Allocations of the profiler and tracemalloc themselves are left out.
+
+    Args:
+        snapshot (tracemalloc.Snapshot): The snapshot
+        traced (int): Bytes traced when it was taken
+        peak (int): Peak bytes traced during the profile
+
+    Returns:
+        str: The report section
+    """
+    own = (__file__, tracemalloc.__file__)
+    lines = ["", f"Allocations: peak {peak / 1024:.1f} KiB traced, "
+                 f"{traced / 1024:.1f} KiB in the largest snapshot",
+             "Lines holding the most memory in it:",
+             f"  {'KiB':>10}  {'blocks':>7}  line"]
+    shown = 0
+    for stat in snapshot.statistics("lineno"):
+        frame = stat.traceback[0]
+        if frame.filename in own:
+            continue
+        lines.append(f"  {stat.size / 1024:10.1f}  {stat.count:7}  "
+                     f"{_short(frame.filename)}:{frame.lineno}")
+        shown += 1
+        if shown == TOP:
+            break
+    return "\n".join(lines) + "\n"
+
+
+def install_signals(profiler):
+    """Profile stacks on SIGUSR1, and allocations too on SIGUSR2.
+
+    Must be called from the main thread.
+
+    Args:
+        profiler (Profiler): The profiler to start
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        log.warning("No SIGUSR1 on this platform, profile with the profile "
+                    "command")
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start())
+    signal.signal(signal.SIGUSR2,
+                  lambda signum, frame: profiler.start(memory=True))
+
+
+def answer_profile(msg, profiler):
+    """Answer a "profile" request.
+
+    The request's size is the number of seconds to profile for, 0 for the
+    default, and its data is "memory" to trace allocations too.
+
+    Args:
+        msg (Message): The request
+        profiler (Profiler): The server's profiler, None if disabled
+
+    Returns:
+        Message: The reply, with the files to be written as JSON in its data
+    """
+    if profiler is None:
+        result = {"started": False, "error": "profiling is disabled"}
+    else:
+        files = profiler.start(msg.size or None, msg.data == "memory")
+        if files is None:
+            result = {"started": False, "error": "a profile is running"}
+        else:
+            result = {"started": True, "files": files}
+    return Message("ack", "profile", data=json.dumps(result), id_=msg.id,
+                   codec=msg.codec, compression=msg.compression)
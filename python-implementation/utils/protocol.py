@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
 """Protocol for sending and receiving DOT files over TCP/UDP."""
 
-import json
+import asyncio
+import os
+import random
 import socket
 import struct
-from .dot import DOT
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from . import log
+from .dot import DOT, CHUNK_SIZE
+from .codec import CODEC_JSON, decode, encode
 
 # Maximum buffer size for UDP
 MAX_BUFFER_SIZE = 65535
 
+# Default maximum frame size for TCP
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# UDP fragment header: magic, kind, message ID, fragment index, fragment count
+FRAGMENT_MAGIC = b"DF"
+FRAGMENT_HEADER = struct.Struct("!2sBxIHH")
+FRAGMENT_DATA = 0
+FRAGMENT_STATUS = 1
+
+# Fragment payload size that fits a typical 1500-byte MTU
+FRAGMENT_SIZE = 1200
+
+# Receive buffer requested for sockets that take fragment bursts
+FRAGMENT_RCVBUF = 4 * 1024 * 1024
+
+# Non-blocking flag for draining a socket without toggling its mode
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Buffer size for copying raw file content off a socket
+RAW_CHUNK_SIZE = 256 * 1024
+
+# Maximum number of buffers passed to a single sendmsg call
+try:
+    _IOV_MAX = max(os.sysconf("SC_IOV_MAX"), 16)
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+
 
 class Message:
     """A message in the protocol."""
 
-    def __init__(self, type_="data", command="", name="", dot=None):
+    def __init__(self, type_="data", command="", name="", dot=None, data=None,
+                 id_=None, size=None, hash_=None, codec=CODEC_JSON,
+                 compression=None):
         """Initialize a Message object.
 
         Args:
@@ -21,11 +58,26 @@ class Message:
             command (str): Command to execute
             name (str): Name of the DOT file
             dot (DOT): The DOT object
+            data (str): Piece of DOT content carried by a stream chunk, or
+                the cursor and result of a list request (see utils.cache)
+            id_ (int): Request ID, echoed back in the matching reply
+            size (int): Content size in bytes, carried by acknowledgements
+            hash_ (str): Content SHA-256 in hex, carried by acknowledgements
+            codec (str): Wire codec the message is encoded with (see
+                utils.codec); not itself sent
+            compression (Compression): How the message body is compressed
+                (see utils.compression), or None
         """
         self.type = type_
         self.command = command
         self.name = name
         self.dot = dot
+        self.data = data
+        self.id = id_
+        self.size = size
+        self.hash = hash_
+        self.codec = codec
+        self.compression = compression
 
     def to_dict(self):
         """Convert the Message to a dictionary.
@@ -40,6 +92,14 @@ class Message:
         }
         if self.dot:
             result["dot"] = self.dot.to_dict()
+        if self.data is not None:
+            result["data"] = self.data
+        if self.id is not None:
+            result["id"] = self.id
+        if self.size is not None:
+            result["size"] = self.size
+        if self.hash is not None:
+            result["hash"] = self.hash
         return result
 
     @classmethod
@@ -56,173 +116,1188 @@ class Message:
             type_=data.get("type", "data"),
             command=data.get("command", ""),
             name=data.get("name", ""),
+            data=data.get("data"),
+            id_=data.get("id"),
+            size=data.get("size"),
+            hash_=data.get("hash"),
         )
         if "dot" in data and data["dot"]:
             msg.dot = DOT.from_dict(data["dot"])
         return msg
 
+    def encode(self):
+        """Serialize the Message with its codec.
+
+        Returns:
+            bytes: The payload
+        """
+        return encode(self.to_dict(), self.codec, self.compression)
+
+    @classmethod
+    def decode(cls, payload):
+        """Deserialize a payload in any supported codec.
+
+        Args:
+            payload (bytes): The payload
+
+        Returns:
+            Message: The message, with codec and compression set to the ones
+            it arrived with
+
+        Raises:
+            ValueError: If the payload cannot be decoded
+        """
+        data, codec, compression = decode(payload)
+        msg = cls.from_dict(data)
+        msg.codec = codec
+        msg.compression = compression
+        return msg
+
+    @property
+    def is_ack(self):
+        """bool: Whether this is a compact acknowledgement."""
+        return self.type == "ack" and self.command == "acknowledge"
+
+    @classmethod
+    def ack(cls, name, digest, msg_id=None, codec=CODEC_JSON,
+            compression=None):
+        """Create a compact acknowledgement for a saved DOT.
+
+        Args:
+            name (str): Name of the saved DOT
+            digest (ContentDigest): Size and hash of the saved content
+            msg_id (int): ID of the request being acknowledged
+            codec (str): Codec of the request being acknowledged
+            compression (Compression): Compression of the request being
+                acknowledged
+
+        Returns:
+            Message: The acknowledgement
+        """
+        return cls("ack", "acknowledge", name, id_=msg_id,
+                   size=digest.size, hash_=digest.hexdigest, codec=codec,
+                   compression=compression)
+
+
+def set_nodelay(sock, enabled=True):
+    """Enable or disable Nagle's algorithm on a TCP socket.
+
+    Args:
+        sock (socket): The TCP socket
+        enabled (bool): True to set TCP_NODELAY (disable Nagle)
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if enabled else 0)
+
+
+def _frame(msg):
+    """Encode a Message as a length header and payload.
+
+    Args:
+        msg (Message): The message to encode
+
+    Returns:
+        list: [header, payload] buffers
+    """
+    data = msg.encode()
+    return [struct.pack("!I", len(data)), data]
+
+
+def _sendmsg_all(sock, buffers):
+    """Write all buffers with as few gathered writes as possible.
+
+    Args:
+        sock (socket): The socket to send over
+        buffers (list): Bytes-like objects to send in order
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        sent = sock.sendmsg(views[:_IOV_MAX])
+        # Drop fully written buffers and trim a partially written one
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send_message(sock, msg, metrics=None):
+    """Send a Message over a TCP connection.
+
+    The size header and payload go out in a single gathered write.
+
+    Args:
+        sock (socket): The socket to send over
+        msg (Message): The message to send
+        metrics (Metrics): Counts the bytes sent, if given
 
-def send_tcp(sock, dot):
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        buffers = _frame(msg)
+    except Exception as e:
+        log.error("Error preparing message: %s", e)
+        if log.enabled(log.DEBUG):
+            log.debug("%s", traceback.format_exc().rstrip())
+        return False
+
+    try:
+        _sendmsg_all(sock, buffers)
+    except Exception as e:
+        log.error("Error sending data: %s", e)
+        return False
+    if metrics is not None:
+        metrics.sent(len(buffers[0]) + len(buffers[1]))
+    return True
+
+
+def send_tcp(sock, dot, msg_id=None, command="", codec=CODEC_JSON,
+             compression=None):
     """Send a DOT over a TCP connection.
 
     Args:
         sock (socket): The socket to send over
         dot (DOT): The DOT object to send
+        msg_id (int): Optional request ID for the message
+        command (str): Message command; "store" asks the server for a
+            compact acknowledgement instead of an echo of the DOT
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    return send_message(sock, Message(command=command, dot=dot, id_=msg_id,
+                                      codec=codec, compression=compression))
+
+
+def _content_chunks(content, chunk_size):
+    """Split DOT content into stream chunks.
+
+    Args:
+        content (str or iterable): Full content or an iterable of pieces
+        chunk_size (int): Chunk size used when content is a str
+
+    Returns:
+        iterable: The content pieces
+    """
+    if isinstance(content, str):
+        return (content[i:i + chunk_size]
+                for i in range(0, len(content), chunk_size))
+    return content
+
+
+def send_tcp_stream(sock, dot, chunk_size=CHUNK_SIZE, msg_id=None,
+                    codec=CODEC_JSON, compression=None):
+    """Send a DOT over a TCP connection as a sequence of frames.
+
+    The content is sent as a "stream" begin message, one chunk message per
+    piece and an end message, so neither side needs it fully in memory.
+
+    Args:
+        sock (socket): The socket to send over
+        dot (DOT): The DOT to send; its content may be a str or an iterable
+            of str pieces (see DOT.stream)
+        chunk_size (int): Chunk size used when the content is a str
+        msg_id (int): Optional request ID, carried by the begin message
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
 
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        # Create message
-        msg = Message(dot=dot)
-        data = json.dumps(msg.to_dict()).encode("utf-8")
+        _sendmsg_all(sock, _frame(
+            Message("stream", "begin", dot.name, id_=msg_id, codec=codec)))
+        for chunk in _content_chunks(dot.content, chunk_size):
+            _sendmsg_all(sock, _frame(
+                Message("stream", "chunk", dot.name, data=chunk, codec=codec,
+                        compression=compression)))
+        _sendmsg_all(sock, _frame(
+            Message("stream", "end", dot.name, codec=codec)))
+        return True
+    except Exception as e:
+        log.error("Error sending stream: %s", e)
+        return False
 
-        # Send size header (4 bytes)
-        size = len(data)
-        size_bytes = struct.pack("!I", size)
-        
-        try:
-            sock.sendall(size_bytes)
-        except Exception as e:
-            print(f"Error sending size header: {e}")
-            return False
 
-        # Send data
-        try:
-            sock.sendall(data)
-        except Exception as e:
-            print(f"Error sending data: {e}")
-            return False
-            
+def send_tcp_batch(sock, dots, codec=CODEC_JSON, compression=None):
+    """Send several DOTs over a TCP connection in one gathered write.
+
+    Each DOT is framed exactly as by send_tcp, so the peer sees ordinary
+    back-to-back messages.
+
+    Args:
+        sock (socket): The socket to send over
+        dots (list): The DOT objects to send
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        buffers = []
+        for dot in dots:
+            buffers.extend(_frame(Message(dot=dot, codec=codec,
+                                          compression=compression)))
+    except Exception as e:
+        log.error("Error preparing message: %s", e)
+        return False
+
+    try:
+        _sendmsg_all(sock, buffers)
         return True
     except Exception as e:
-        print(f"Error preparing message: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("Error sending data: %s", e)
         return False
 
 
-def receive_tcp(sock):
-    """Receive a DOT over a TCP connection.
+def send_tcp_file(sock, header, file, size):
+    """Send a message followed by the raw bytes of an open file.
+
+    The file is handed to socket.sendfile, so on platforms with sendfile(2)
+    its content goes from the page cache to the socket without passing
+    through Python. The peer reads `size` bytes after the header frame
+    (see FrameReader.copy_to).
 
     Args:
-        sock (socket): The socket to receive from
+        sock (socket): The socket to send over
+        header (Message): Message announcing the content, sent framed
+        file (file): The file, opened in binary mode
+        size (int): Number of bytes to send from the start of the file
 
     Returns:
-        DOT: The received DOT object, or None on error
+        bool: True if successful, False otherwise
     """
     try:
+        _sendmsg_all(sock, _frame(header))
+        if size and sock.sendfile(file, 0, size) != size:
+            raise ConnectionError("File shrank while sending")
+        return True
+    except Exception as e:
+        log.error("Error sending file: %s", e)
+        return False
+
+
+class FrameReader:
+    """Reads length-prefixed frames from a TCP socket.
+
+    The reader owns a reusable buffer that is filled in place with
+    ``recv_into``, so receiving a frame costs no per-chunk allocations. Keep
+    one reader per connection; the view returned by read_frame is only valid
+    until the next call.
+    """
+
+    def __init__(self, sock, buffer_size=4096):
+        """Initialize a FrameReader.
+
+        Args:
+            sock (socket): The socket to read from
+            buffer_size (int): Initial size of the payload buffer
+        """
+        self.sock = sock
+        self._header = bytearray(4)
+        self._header_view = memoryview(self._header)
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # True while blocked waiting for the first byte of the next frame
+        self.waiting = False
+        # perf_counter() when the last frame's size header was complete
+        self.header_time = 0.0
+
+    def _fill(self, view):
+        """Fill a view completely from the socket.
+
+        Args:
+            view (memoryview): The region to fill
+
+        Returns:
+            int: Number of bytes read, less than len(view) if the peer closed
+        """
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                break
+            received += n
+        return received
+
+    def read_frame(self, max_size=MAX_FRAME_SIZE):
+        """Read one frame.
+
+        Args:
+            max_size (int): Largest payload accepted
+
+        Returns:
+            memoryview: The frame payload, or None on error
+        """
         # Read size header (4 bytes)
         try:
-            size_bytes = sock.recv(4)
-            if not size_bytes:
-                print("Connection closed by peer - no data received")
-                return None
-            if len(size_bytes) < 4:
-                print(f"Incomplete size header received: {len(size_bytes)} bytes")
-                return None
+            self.waiting = True
+            try:
+                n = self.sock.recv_into(self._header_view)
+            finally:
+                self.waiting = False
+            if 0 < n < 4:
+                n += self._fill(self._header_view[n:])
         except ConnectionResetError:
-            print("Connection reset while reading size header")
+            log.info("Connection reset while reading size header")
             return None
         except Exception as e:
-            print(f"Error reading size header: {e}")
+            log.error("Error reading size header: %s", e)
             return None
+        if n == 0:
+            log.debug("Connection closed by peer - no data received")
+            return None
+        if n < 4:
+            log.warning("Incomplete size header received: %d bytes", n)
+            return None
+        self.header_time = time.perf_counter()
+
+        size = struct.unpack("!I", self._header)[0]
+        log.debug("Message size: %d bytes", size)
 
-        # Unpack size
-        size = struct.unpack("!I", size_bytes)[0]
-        print(f"Message size: {size} bytes")
-        
-        if size > MAX_BUFFER_SIZE:
-            print(f"Message too large: {size} bytes")
+        if size > max_size:
+            log.warning("Message too large: %d bytes", size)
             return None
         elif size == 0:
-            print("Empty message received")
+            log.warning("Empty message received")
             return None
 
+        if size > len(self._buffer):
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
         # Read data
-        data = b""
-        remaining = size
+        payload = self._view[:size]
         try:
-            while remaining > 0:
-                chunk = sock.recv(min(remaining, 4096))
-                if not chunk:
-                    print("Connection closed while reading data")
-                    return None
-                data += chunk
-                remaining -= len(chunk)
+            if self._fill(payload) < size:
+                log.warning("Connection closed while reading data")
+                return None
         except Exception as e:
-            print(f"Error reading data: {e}")
+            log.error("Error reading data: %s", e)
             return None
+        return payload
 
-        # Parse message
+    def copy_to(self, file, size, digest=None):
+        """Copy raw bytes that follow a frame straight into a file.
+
+        Args:
+            file (file): Destination, opened in binary mode
+            size (int): Number of bytes to copy
+            digest (ContentDigest): Digest to add the bytes to, or None
+
+        Returns:
+            bool: True if all bytes were copied
+        """
+        if len(self._buffer) < RAW_CHUNK_SIZE:
+            self._buffer = bytearray(RAW_CHUNK_SIZE)
+            self._view = memoryview(self._buffer)
+        remaining = size
         try:
-            msg_dict = json.loads(data.decode("utf-8"))
-            msg = Message.from_dict(msg_dict)
-            if not msg.dot:
-                print("Message does not contain a DOT object")
-                return None
-            return msg.dot
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}")
-            print(f"Raw data: {data[:100]}...")
-            return None
+            while remaining:
+                view = self._view[:min(remaining, len(self._view))]
+                if self._fill(view) < len(view):
+                    log.error("Connection closed while reading file content")
+                    return False
+                if digest is not None:
+                    digest.update(view)
+                file.write(view)
+                remaining -= len(view)
         except Exception as e:
-            print(f"Error processing message: {e}")
+            log.error("Error reading file content: %s", e)
+            return False
+        return True
+
+
+def receive_message(sock, reader=None, max_size=MAX_FRAME_SIZE, metrics=None):
+    """Receive a Message over a TCP connection.
+
+    The start of a streamed DOT is returned as a "stream" message whose dot
+    reads the remaining chunks off the socket (see receive_tcp). A "raw"
+    message is followed by `size` bytes of file content, which the caller
+    must consume with reader.copy_to before receiving again.
+
+    Args:
+        sock (socket): The socket to receive from
+        reader (FrameReader): Reader owning the connection's receive buffer;
+            a temporary one is used if omitted
+        max_size (int): Largest frame accepted
+        metrics (Metrics): Records the read and decode stages and the bytes
+            received, if given
+
+    Returns:
+        Message: The received message, or None on error
+    """
+    if reader is None:
+        reader = FrameReader(sock)
+    data = reader.read_frame(max_size)
+    if data is None:
+        return None
+    if metrics is not None:
+        start = time.perf_counter()
+        metrics.observe("read", start - reader.header_time)
+        metrics.received(len(data) + 4)
+
+    # Parse message
+    try:
+        msg = Message.decode(data)
+        if msg.type == "stream" and msg.command == "begin":
+            msg.dot = DOT(msg.name, _receive_chunks(sock, reader, max_size,
+                                                    metrics))
+        if metrics is not None:
+            metrics.observe("decode", time.perf_counter() - start)
+        return msg
+    except ValueError as e:
+        log.error("Error decoding message: %s", e)
+        log.debug("Raw data: %s...", bytes(data[:100]))
+        return None
+    except Exception as e:
+        log.error("Error processing message: %s", e)
+        return None
+
+
+def _receive_chunks(sock, reader, max_size, metrics=None):
+    """Yield the chunks of a stream until its end message.
+
+    Raises:
+        ConnectionError: If the stream is interrupted
+    """
+    while True:
+        msg = receive_message(sock, reader, max_size, metrics)
+        if msg is None or msg.type != "stream":
+            raise ConnectionError("Stream interrupted")
+        if msg.command == "end":
+            return
+        yield msg.data or ""
+
+
+def receive_tcp(sock, reader=None, max_size=MAX_FRAME_SIZE):
+    """Receive a DOT over a TCP connection.
+
+    For a streamed DOT the returned object's content is an iterator that
+    reads the remaining chunks off the socket; it must be consumed (e.g. by
+    DOT.save) before the next receive on the same connection.
+
+    Args:
+        sock (socket): The socket to receive from
+        reader (FrameReader): Reader owning the connection's receive buffer;
+            a temporary one is used if omitted
+        max_size (int): Largest frame accepted
+
+    Returns:
+        DOT: The received DOT object, or None on error
+    """
+    try:
+        if reader is None:
+            reader = FrameReader(sock)
+        msg = receive_message(sock, reader, max_size)
+        if msg is None:
             return None
-            
+
+        if not msg.dot:
+            log.error("Message does not contain a DOT object")
+            return None
+        return msg.dot
+    except Exception as e:
+        log.error("Unexpected error receiving DOT: %s", e)
+        if log.enabled(log.DEBUG):
+            log.debug("%s", traceback.format_exc().rstrip())
+        return None
+
+
+async def send_message_async(writer, msg, metrics=None):
+    """Send a Message over an asyncio stream.
+
+    Args:
+        writer (asyncio.StreamWriter): The stream to send over
+        msg (Message): The message to send
+        metrics (Metrics): Counts the bytes sent, if given
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        buffers = _frame(msg)
+        writer.writelines(buffers)
+        await writer.drain()
+    except Exception as e:
+        log.error("Error sending data: %s", e)
+        return False
+    if metrics is not None:
+        metrics.sent(len(buffers[0]) + len(buffers[1]))
+    return True
+
+
+async def send_tcp_async(writer, dot, msg_id=None, codec=CODEC_JSON,
+                         compression=None):
+    """Send a DOT over an asyncio stream.
+
+    Uses the same 4-byte length framing as send_tcp.
+
+    Args:
+        writer (asyncio.StreamWriter): The stream to send over
+        dot (DOT): The DOT object to send
+        msg_id (int): Optional request ID for the message
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    return await send_message_async(writer, Message(
+        dot=dot, id_=msg_id, codec=codec, compression=compression))
+
+
+async def send_tcp_file_async(writer, header, file, size):
+    """Send a message followed by the raw bytes of an open file.
+
+    Uses loop.sendfile, which falls back to reading the file in pieces
+    where the transport cannot use sendfile(2) (e.g. TLS).
+
+    Args:
+        writer (asyncio.StreamWriter): The stream to send over
+        header (Message): Message announcing the content, sent framed
+        file (file): The file, opened in binary mode
+        size (int): Number of bytes to send from the start of the file
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        writer.writelines(_frame(header))
+        await writer.drain()
+        if size:
+            loop = asyncio.get_running_loop()
+            sent = await loop.sendfile(writer.transport, file, 0, size)
+            if sent != size:
+                raise ConnectionError("File shrank while sending")
+        return True
+    except Exception as e:
+        log.error("Error sending file: %s", e)
+        return False
+
+
+async def send_tcp_stream_async(writer, dot, chunk_size=CHUNK_SIZE,
+                                msg_id=None, codec=CODEC_JSON,
+                                compression=None):
+    """Send a DOT over an asyncio stream as a sequence of frames.
+
+    Args:
+        writer (asyncio.StreamWriter): The stream to send over
+        dot (DOT): The DOT to send; its content may be a str or an iterable
+            of str pieces
+        chunk_size (int): Chunk size used when the content is a str
+        msg_id (int): Optional request ID, carried by the begin message
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        writer.writelines(_frame(
+            Message("stream", "begin", dot.name, id_=msg_id, codec=codec)))
+        for chunk in _content_chunks(dot.content, chunk_size):
+            writer.writelines(_frame(
+                Message("stream", "chunk", dot.name, data=chunk, codec=codec,
+                        compression=compression)))
+            await writer.drain()
+        writer.writelines(_frame(
+            Message("stream", "end", dot.name, codec=codec)))
+        await writer.drain()
+        return True
+    except Exception as e:
+        log.error("Error sending stream: %s", e)
+        return False
+
+
+async def receive_message_async(reader, max_size=MAX_FRAME_SIZE,
+                                metrics=None):
+    """Receive a Message over an asyncio stream.
+
+    Args:
+        reader (asyncio.StreamReader): The stream to receive from
+        max_size (int): Largest frame accepted
+        metrics (Metrics): Records the read and decode stages and the bytes
+            received, if given
+
+    Returns:
+        Message: The received message, or None on error
+    """
+    try:
+        size_bytes = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            log.warning("Incomplete size header received: %d bytes",
+                        len(e.partial))
+        else:
+            log.debug("Connection closed by peer - no data received")
+        return None
+    except ConnectionResetError:
+        log.info("Connection reset while reading size header")
+        return None
+    if metrics is not None:
+        header_time = time.perf_counter()
+
+    size = struct.unpack("!I", size_bytes)[0]
+
+    if size > max_size:
+        log.warning("Message too large: %d bytes", size)
+        return None
+    elif size == 0:
+        log.warning("Empty message received")
+        return None
+
+    try:
+        data = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        log.warning("Connection closed while reading data")
+        return None
+    if metrics is not None:
+        start = time.perf_counter()
+        metrics.observe("read", start - header_time)
+        metrics.received(size + 4)
+
+    try:
+        msg = Message.decode(data)
+        if msg.type == "stream" and msg.command == "begin":
+            msg.dot = DOT(msg.name, _receive_chunks_async(reader, max_size,
+                                                          metrics))
+        if metrics is not None:
+            metrics.observe("decode", time.perf_counter() - start)
+        return msg
+    except ValueError as e:
+        log.error("Error decoding message: %s", e)
+        return None
     except Exception as e:
-        print(f"Unexpected error receiving DOT: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("Error processing message: %s", e)
         return None
 
 
-def send_udp(sock, address, dot):
+async def _receive_chunks_async(reader, max_size, metrics=None):
+    """Yield the chunks of a stream until its end message.
+
+    Raises:
+        ConnectionError: If the stream is interrupted
+    """
+    while True:
+        msg = await receive_message_async(reader, max_size, metrics)
+        if msg is None or msg.type != "stream":
+            raise ConnectionError("Stream interrupted")
+        if msg.command == "end":
+            return
+        yield msg.data or ""
+
+
+async def receive_tcp_async(reader, max_size=MAX_FRAME_SIZE):
+    """Receive a DOT over an asyncio stream.
+
+    For a streamed DOT the returned object's content is an async iterator
+    over the remaining chunks; consume it with DOT.save_async.
+
+    Args:
+        reader (asyncio.StreamReader): The stream to receive from
+        max_size (int): Largest frame accepted
+
+    Returns:
+        DOT: The received DOT object, or None on error
+    """
+    msg = await receive_message_async(reader, max_size)
+    if msg is None:
+        return None
+
+    if not msg.dot:
+        log.error("Message does not contain a DOT object")
+        return None
+    return msg.dot
+
+
+def send_udp(sock, address, dot, command="", codec=CODEC_JSON,
+             compression=None):
     """Send a DOT over a UDP connection.
 
     Args:
         sock (socket): The socket to send over
         address (tuple): The (host, port) to send to
         dot (DOT): The DOT object to send
+        command (str): Message command (see send_tcp)
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
 
     Returns:
         bool: True if successful, False otherwise
     """
     try:
         # Create message
-        msg = Message(dot=dot)
-        data = json.dumps(msg.to_dict()).encode("utf-8")
+        msg = Message(command=command, dot=dot, codec=codec,
+                      compression=compression)
+        data = msg.encode()
 
         if len(data) > MAX_BUFFER_SIZE:
-            print(f"Message too large for UDP: {len(data)} bytes")
+            log.error("Message too large for UDP: %d bytes", len(data))
             return False
 
         # Send data
         sock.sendto(data, address)
         return True
     except Exception as e:
-        print(f"Error sending DOT: {e}")
+        log.error("Error sending DOT: %s", e)
         return False
 
 
-def receive_udp(sock, buffer_size=MAX_BUFFER_SIZE):
-    """Receive a DOT over a UDP connection.
+def receive_udp_message(sock, buffer_size=MAX_BUFFER_SIZE):
+    """Receive a Message over a UDP connection.
 
     Args:
         sock (socket): The socket to receive from
         buffer_size (int): Maximum buffer size
 
     Returns:
-        tuple: (DOT, address) tuple, or (None, address) on error
+        tuple: (Message, address) tuple, or (None, None) on error
     """
     try:
         # Receive data
         data, address = sock.recvfrom(buffer_size)
 
         # Parse message
-        msg_dict = json.loads(data.decode("utf-8"))
-        msg = Message.from_dict(msg_dict)
-        return msg.dot, address
+        return Message.decode(data), address
     except Exception as e:
-        print(f"Error receiving DOT: {e}")
-        return None, None 
\ No newline at end of file
+        log.error("Error receiving message: %s", e)
+        return None, None
+
+
+def receive_udp_batch(sock, views):
+    """Receive a batch of datagrams into preallocated buffers.
+
+    Blocks for the first datagram, then drains whatever else is already
+    queued without blocking, up to one datagram per buffer.
+
+    Args:
+        sock (socket): The UDP socket
+        views (list): Writable memoryviews, each large enough for a datagram
+
+    Returns:
+        list: (memoryview, address) pairs; each view is only valid until its
+        buffer is reused by the next batch
+    """
+    n, address = sock.recvfrom_into(views[0])
+    batch = [(views[0][:n], address)]
+    if not _MSG_DONTWAIT:
+        return batch
+    for view in views[1:]:
+        try:
+            n, address = sock.recvfrom_into(view, 0, _MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            break
+        batch.append((view[:n], address))
+    return batch
+
+
+def receive_udp(sock, buffer_size=MAX_BUFFER_SIZE):
+    """Receive a DOT over a UDP connection.
+
+    Args:
+        sock (socket): The socket to receive from
+        buffer_size (int): Maximum buffer size
+
+    Returns:
+        tuple: (DOT, address) tuple, or (None, address) on error
+    """
+    msg, address = receive_udp_message(sock, buffer_size)
+    if msg is None:
+        return None, None
+    return msg.dot, address
+
+
+def is_fragment(datagram):
+    """Check whether a datagram belongs to the fragmentation layer.
+
+    Plain datagrams start with "{" or the codec VERSION byte, so the two
+    never collide.
+
+    Args:
+        datagram (bytes): The received datagram
+
+    Returns:
+        bool: True for a fragment or status datagram
+    """
+    return (len(datagram) >= FRAGMENT_HEADER.size and
+            datagram[:2] == FRAGMENT_MAGIC)
+
+
+def fragment_message(data, msg_id, fragment_size=FRAGMENT_SIZE):
+    """Split a serialized message into fragment datagrams.
+
+    Args:
+        data (bytes): The serialized message
+        msg_id (int): Message ID shared by all fragments
+        fragment_size (int): Payload bytes per fragment
+
+    Returns:
+        list: The fragment datagrams, in order
+
+    Raises:
+        ValueError: If the message needs more than 65535 fragments
+    """
+    count = max(1, -(-len(data) // fragment_size))
+    if count > 0xFFFF:
+        raise ValueError(f"Message too large to fragment: {len(data)} bytes")
+
+    view = memoryview(data)
+    return [
+        FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, FRAGMENT_DATA, msg_id, i, count) +
+        view[i * fragment_size:(i + 1) * fragment_size]
+        for i in range(count)
+    ]
+
+
+def _status(msg_id, received):
+    """Build a status datagram with a bitmap of received fragments."""
+    bitmap = bytearray((len(received) + 7) // 8)
+    for i, got in enumerate(received):
+        if got:
+            bitmap[i >> 3] |= 1 << (i & 7)
+    header = FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, FRAGMENT_STATUS, msg_id, 0,
+                                  len(received))
+    return header + bytes(bitmap)
+
+
+def _missing(datagram):
+    """Return the fragment indexes a status datagram reports as missing."""
+    _, _, _, _, count = FRAGMENT_HEADER.unpack_from(datagram)
+    bitmap = datagram[FRAGMENT_HEADER.size:]
+    return [i for i in range(count)
+            if i >> 3 >= len(bitmap) or not bitmap[i >> 3] & (1 << (i & 7))]
+
+
+class _Partial:
+    """Fragments received so far for one message."""
+
+    __slots__ = ("parts", "received", "size", "last_seen")
+
+    def __init__(self, count):
+        self.parts = [None] * count
+        self.received = 0
+        self.size = 0
+        self.last_seen = time.monotonic()
+
+
+class Reassembler:
+    """Reassembles fragmented messages per (address, message ID).
+
+    Memory is bounded by max_bytes across all partial messages (the oldest
+    are dropped first), partials expire after `expiry` seconds without a new
+    fragment, and replies to completed messages are kept for the same time
+    so a sender probing after a lost reply gets it again, or just the reply
+    fragments its status bitmap reports missing.
+
+    Methods are safe to call from several threads, so replies can be
+    recorded by whichever thread finishes handling a message.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, expiry=10.0):
+        """Initialize a Reassembler.
+
+        Args:
+            max_bytes (int): Budget for buffered fragment payloads
+            expiry (float): Seconds before an idle partial message is dropped
+        """
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.partials = OrderedDict()
+        self.completed = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def feed(self, datagram, address):
+        """Process one fragment datagram.
+
+        Args:
+            datagram (bytes): A datagram for which is_fragment() is true
+            address (tuple): The sender's address
+
+        Returns:
+            tuple: (payload, replies) where payload is the reassembled
+            message bytes once complete (else None) and replies is a list of
+            datagrams to send back to the sender
+        """
+        with self.lock:
+            return self._feed(datagram, address)
+
+    def _feed(self, datagram, address):
+        """Process one fragment datagram with the lock held."""
+        self._expire()
+        magic, kind, msg_id, index, count = FRAGMENT_HEADER.unpack_from(datagram)
+        key = (address, msg_id)
+
+        if kind == FRAGMENT_STATUS:
+            reply = self.completed.get(key, (None, []))[1]
+            if len(reply) != count:
+                return None, []
+            return None, [reply[i] for i in _missing(datagram)]
+        if kind != FRAGMENT_DATA or count == 0 or index >= count:
+            return None, []
+
+        if key in self.completed:
+            # The sender is retrying, so our reply went missing
+            return None, self.completed[key][1]
+
+        partial = self.partials.get(key)
+        if partial is None:
+            partial = _Partial(count)
+            self.partials[key] = partial
+        elif len(partial.parts) != count:
+            return None, []
+        self.partials.move_to_end(key)
+        partial.last_seen = time.monotonic()
+
+        chunk = datagram[FRAGMENT_HEADER.size:]
+        duplicate = partial.parts[index] is not None
+        if not duplicate:
+            partial.parts[index] = chunk
+            partial.received += 1
+            partial.size += len(chunk)
+            self.size += len(chunk)
+
+        if partial.received == count:
+            del self.partials[key]
+            self.size -= partial.size
+            self.completed[key] = (time.monotonic(), [])
+            return b"".join(partial.parts), []
+
+        self._enforce_budget(key)
+
+        # Report gaps once the last fragment or a retry shows up
+        if duplicate or index == count - 1:
+            return None, [_status(msg_id, partial.parts)]
+        return None, []
+
+    def status(self, address, msg_id):
+        """Build a status datagram for a partially received message.
+
+        Args:
+            address (tuple): The sender's address
+            msg_id (int): The message ID
+
+        Returns:
+            bytes: The status datagram, or None if nothing is buffered
+        """
+        with self.lock:
+            partial = self.partials.get((address, msg_id))
+            if partial is None:
+                return None
+            return _status(msg_id, partial.parts)
+
+    def set_reply(self, address, msg_id, datagrams):
+        """Remember the reply sent for a completed message.
+
+        Args:
+            address (tuple): The sender's address
+            msg_id (int): The message ID
+            datagrams (list): The reply datagrams
+        """
+        with self.lock:
+            self.completed[(address, msg_id)] = (time.monotonic(), datagrams)
+
+    def forget(self, address, msg_id):
+        """Drop a completed message so a retransmission is processed again.
+
+        Args:
+            address (tuple): The sender's address
+            msg_id (int): The message ID
+        """
+        with self.lock:
+            self.completed.pop((address, msg_id), None)
+
+    def expire(self):
+        """Drop idle partial messages and old completed entries."""
+        with self.lock:
+            self._expire()
+
+    def _expire(self):
+        """Expire entries with the lock held."""
+        cutoff = time.monotonic() - self.expiry
+        while self.partials:
+            key, partial = next(iter(self.partials.items()))
+            if partial.last_seen > cutoff:
+                break
+            del self.partials[key]
+            self.size -= partial.size
+        while self.completed:
+            key, (finished, _) = next(iter(self.completed.items()))
+            if finished > cutoff:
+                break
+            del self.completed[key]
+
+    def _enforce_budget(self, current):
+        """Drop the least recently active partials until within budget."""
+        while self.size > self.max_bytes and self.partials:
+            key, partial = next(iter(self.partials.items()))
+            del self.partials[key]
+            self.size -= partial.size
+            if key == current:
+                log.warning("Dropped oversized message %s from %s", key[1],
+                            key[0])
+                break
+
+
+def grow_receive_buffer(sock, size=FRAGMENT_RCVBUF):
+    """Ask the kernel for a larger socket receive buffer, best effort.
+
+    Bursts of fragments otherwise overflow the default buffer and have to be
+    recovered by retransmission.
+
+    Args:
+        sock (socket): The UDP socket
+        size (int): Requested buffer size in bytes
+    """
+    try:
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except OSError:
+        pass
+
+
+def encode_udp_reply(data, request_id=None, fragment_size=FRAGMENT_SIZE):
+    """Package a serialized reply as one plain datagram or as fragments.
+
+    Replies to fragmented requests are always fragmented under the request's
+    message ID, so the sender can match and reassemble them.
+
+    Args:
+        data (bytes): The serialized reply
+        request_id (int): Fragment message ID of the request, if fragmented
+        fragment_size (int): Payload bytes per fragment
+
+    Returns:
+        list: Datagrams to send
+    """
+    if request_id is None:
+        return [data]
+    return fragment_message(data, request_id, fragment_size)
+
+
+def send_udp_reliable(sock, address, dot, command="", timeout=1.0, retries=5,
+                      fragment_size=FRAGMENT_SIZE, codec=CODEC_JSON,
+                      compression=None):
+    """Send a DOT over UDP and wait for the reply, retransmitting as needed.
+
+    Messages that fit in one fragment go out as a plain datagram, so
+    servers without fragmentation support still understand them. Larger
+    messages are fragmented; the receiver reports gaps with a bitmap and
+    only the missing fragments are sent again. Retries are only used up by
+    timeouts that follow no progress.
+
+    Args:
+        sock (socket): The socket to send over
+        address (tuple): The (host, port) to send to
+        dot (DOT): The DOT object to send
+        command (str): Message command (see send_tcp)
+        timeout (float): Seconds to wait for a response before retrying
+        retries (int): Number of retries after a timeout
+        fragment_size (int): Payload bytes per fragment
+        codec (str): Wire codec (see utils.codec)
+        compression (Compression): How to compress the payload, or None
+
+    Returns:
+        Message: The reply, or None if none arrived
+    """
+    msg = Message(command=command, dot=dot, codec=codec,
+                  compression=compression)
+    return request_udp(sock, address, msg, timeout, retries, fragment_size)
+
+
+def request_udp(sock, address, msg, timeout=1.0, retries=5,
+                fragment_size=FRAGMENT_SIZE, fragment=False):
+    """Send a Message over UDP and wait for the reply (see send_udp_reliable).
+
+    Args:
+        sock (socket): The socket to send over
+        address (tuple): The (host, port) to send to
+        msg (Message): The request
+        timeout (float): Seconds to wait for a response before retrying
+        retries (int): Number of retries after a timeout
+        fragment_size (int): Payload bytes per fragment
+        fragment (bool): Fragment the request even if it fits in one
+            datagram, so that the reply may be fragmented too; needed when
+            the reply can be large, as with "get"
+
+    Returns:
+        Message: The reply, or None if none arrived
+    """
+    try:
+        data = msg.encode()
+        if len(data) <= fragment_size and not fragment:
+            msg_id = None
+            datagrams = [data]
+        else:
+            msg_id = random.getrandbits(32)
+            datagrams = fragment_message(data, msg_id, fragment_size)
+    except Exception as e:
+        log.error("Error preparing message: %s", e)
+        return None
+
+    reassembler = Reassembler()
+    previous_timeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    grow_receive_buffer(sock)
+    try:
+        for datagram in datagrams:
+            sock.sendto(datagram, address)
+
+        attempts = 0
+        missing_count = len(datagrams)
+        while True:
+            try:
+                reply, _ = sock.recvfrom(MAX_BUFFER_SIZE)
+            except socket.timeout:
+                attempts += 1
+                if attempts > retries:
+                    log.error("No response after %d retries", retries)
+                    return None
+                # Report gaps in a partial reply, otherwise resend the last
+                # fragment, which makes the receiver report its gaps
+                status = msg_id is not None and reassembler.status(address,
+                                                                   msg_id)
+                sock.sendto(status or datagrams[-1], address)
+                continue
+
+            if not is_fragment(reply):
+                if msg_id is None:
+                    return Message.decode(reply)
+                continue
+
+            kind, reply_id = reply[2], FRAGMENT_HEADER.unpack_from(reply)[2]
+            if reply_id != msg_id:
+                continue
+            if kind == FRAGMENT_STATUS:
+                missing = _missing(reply)
+                if len(missing) < missing_count:
+                    attempts = 0
+                    missing_count = len(missing)
+                for index in missing:
+                    sock.sendto(datagrams[index], address)
+                # Finish with the last fragment so the receiver reports again
+                if not missing or missing[-1] != len(datagrams) - 1:
+                    sock.sendto(datagrams[-1], address)
+                continue
+
+            buffered = reassembler.size
+            payload, statuses = reassembler.feed(reply, address)
+            if reassembler.size > buffered:
+                attempts = 0
+            for status in statuses:
+                sock.sendto(status, address)
+            if payload is not None:
+                return Message.decode(payload)
+    except Exception as e:
+        log.error("Error sending message: %s", e)
+        return None
+    finally:
+        sock.settimeout(previous_timeout)
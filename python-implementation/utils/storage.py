@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Content-addressed, deduplicating storage for DOTs."""
+
+import os
+import re
+import asyncio
+import threading
+from . import log
+from .dot import ContentDigest
+from .writer import DURABILITY_NONE, FileWriter
+
+_SHA256_HEX = re.compile(r"[0-9a-f]{64}")
+
+
+class ContentStore:
+    """Stores each distinct DOT content once, under its SHA-256.
+
+    Blobs live in <dir>/.blobs/<first two hex digits>/<hash> and are never
+    rewritten. <dir>/.refs/<name> records the hash a name points at, and
+    <dir>/<name>.dot is a hard link to the blob (a copy where links are not
+    supported), so readers of the storage directory see ordinary files.
+
+    Re-uploading a name with unchanged content writes nothing, and content
+    that is already stored under another name only costs a link.
+    """
+
+    def __init__(self, directory, writer=None):
+        """Initialize a ContentStore.
+
+        Args:
+            directory (str): The storage directory
+            writer (FileWriter): Writer deciding durability of blobs, links
+                and refs
+        """
+        self.directory = directory
+        self.writer = writer or FileWriter()
+        self.blobs_dir = os.path.join(directory, ".blobs")
+        self.refs_dir = os.path.join(directory, ".refs")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.deduplicated = 0
+        self.unchanged = 0
+
+    def path(self, name):
+        """Get the path readers use for a DOT.
+
+        Args:
+            name (str): Name of the DOT
+
+        Returns:
+            str: <dir>/<name>.dot
+        """
+        return os.path.join(self.directory, f"{name}.dot")
+
+    def blob_path(self, hexdigest):
+        """Get the path of the blob for a content hash.
+
+        Args:
+            hexdigest (str): SHA-256 of the content in hex
+
+        Returns:
+            str: The blob path
+        """
+        return os.path.join(self.blobs_dir, hexdigest[:2], hexdigest)
+
+    def ref(self, name):
+        """Get the content hash a name currently points at.
+
+        Args:
+            name (str): Name of the DOT
+
+        Returns:
+            str: The hash in hex, or None if the name is unknown
+        """
+        try:
+            with open(os.path.join(self.refs_dir, name), "r") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def has(self, hexdigest, size=None):
+        """Check whether content is already stored.
+
+        Args:
+            hexdigest (str): SHA-256 of the content in hex
+            size (int): Expected size in bytes, checked if given
+
+        Returns:
+            bool: True if the blob exists (with the given size)
+        """
+        # The hash may come from a client, so never let it form a path
+        if not isinstance(hexdigest, str) or not _SHA256_HEX.fullmatch(hexdigest):
+            return False
+        try:
+            st = os.stat(self.blob_path(hexdigest))
+        except OSError:
+            return False
+        return size is None or st.st_size == size
+
+    def save(self, dot):
+        """Store a DOT, writing its content only if it is new.
+
+        Args:
+            dot (DOT): The DOT; its content may be a str or an iterable of
+                pieces, which is consumed
+
+        Returns:
+            ContentDigest: Size and hash of the content, or None on error
+        """
+        try:
+            if not dot.is_streamed:
+                digest = dot.digest()
+                if self._unchanged(dot.name, digest.hexdigest):
+                    return digest
+                pending = None
+                if not self.has(digest.hexdigest):
+                    pending = self.writer.create(self.blobs_dir)
+                    pending.write(dot.content)
+                self._commit(dot.name, digest, pending)
+                return digest
+
+            digest = ContentDigest()
+            pending = self.writer.create(self.blobs_dir)
+            try:
+                for chunk in digest.wrap(dot.content):
+                    pending.write(chunk)
+            except BaseException:
+                self.writer.abort(pending)
+                raise
+            self._commit(dot.name, digest, pending)
+            return digest
+        except Exception as e:
+            log.error("Error storing DOT %s: %s", dot.name, e)
+            return None
+
+    async def save_async(self, dot):
+        """Store a DOT without blocking the event loop on disk syncs.
+
+        Args:
+            dot (DOT): The DOT; its content may be a str or an async
+                iterable of pieces
+
+        Returns:
+            ContentDigest: Size and hash of the content, or None on error
+        """
+        if not dot.is_streamed and self.writer.durability == DURABILITY_NONE:
+            return self.save(dot)
+        loop = asyncio.get_running_loop()
+        if not dot.is_streamed:
+            return await loop.run_in_executor(None, self.save, dot)
+
+        digest = ContentDigest()
+        try:
+            pending = self.writer.create(self.blobs_dir)
+            try:
+                async for chunk in digest.wrap_async(dot.content):
+                    pending.write(chunk)
+            except BaseException:
+                self.writer.abort(pending)
+                raise
+            if self.writer.durability == DURABILITY_NONE:
+                self._commit(dot.name, digest, pending)
+            else:
+                await loop.run_in_executor(None, self._commit, dot.name,
+                                           digest, pending)
+            return digest
+        except Exception as e:
+            log.error("Error storing DOT %s: %s", dot.name, e)
+            return None
+
+    def adopt(self, name, hexdigest, size):
+        """Point a name at content that is already stored.
+
+        Lets a client skip an upload after asking whether the server has
+        its content.
+
+        Args:
+            name (str): Name of the DOT
+            hexdigest (str): SHA-256 of the content in hex
+            size (int): Size of the content in bytes
+
+        Returns:
+            bool: True if the content was present and the name now refers
+            to it
+        """
+        if not self.has(hexdigest, size):
+            return False
+        if self._unchanged(name, hexdigest):
+            return True
+        try:
+            self.writer.link(self.blob_path(hexdigest), self.path(name))
+            self._set_ref(name, hexdigest)
+        except OSError as e:
+            log.error("Error linking DOT %s: %s", name, e)
+            return False
+        with self.lock:
+            self.deduplicated += 1
+        return True
+
+    def _unchanged(self, name, hexdigest):
+        """Check whether a name already points at this content."""
+        if self.ref(name) != hexdigest or not os.path.exists(self.path(name)):
+            return False
+        with self.lock:
+            self.unchanged += 1
+        return True
+
+    def _commit(self, name, digest, pending):
+        """Move new content into place and point the name at it.
+
+        Args:
+            name (str): Name of the DOT
+            digest (ContentDigest): Size and hash of the content
+            pending (PendingFile): Temporary file holding the content, or
+                None if the blob is known to exist
+        """
+        blob = self.blob_path(digest.hexdigest)
+        written = False
+        if pending is not None:
+            if self._unchanged(name, digest.hexdigest):
+                self.writer.abort(pending)
+                return
+            if os.path.exists(blob):
+                self.writer.abort(pending)
+            else:
+                self.writer.commit(pending, blob)
+                written = True
+
+        self.writer.link(blob, self.path(name))
+        self._set_ref(name, digest.hexdigest)
+        with self.lock:
+            if written:
+                self.written += 1
+            else:
+                self.deduplicated += 1
+
+    def _set_ref(self, name, hexdigest):
+        """Atomically record the hash a name points at."""
+        self.writer.write(os.path.join(self.refs_dir, name), (hexdigest,))
+
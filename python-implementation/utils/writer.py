@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""Atomic file writes with selectable durability."""
+
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from . import log
+
+DURABILITY_NONE = "none"
+DURABILITY_FSYNC = "fsync"
+DURABILITY_GROUP = "group"
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_GROUP)
+
+# Default time the group committer waits for a batch to fill
+GROUP_INTERVAL = 0.005
+
+# Default writer pool threads and saves that may wait for one
+WRITE_WORKERS = 4
+WRITE_QUEUE = 64
+
+
+class PendingFile:
+    """A temporary file that becomes visible once committed."""
+
+    def __init__(self, file, tmp_path):
+        """Initialize a PendingFile.
+
+        Args:
+            file (file): The open temporary file, in binary mode
+            tmp_path (str): Path of the temporary file
+        """
+        self.file = file
+        self.tmp_path = tmp_path
+
+    def write(self, text):
+        """Append a piece of content.
+
+        Args:
+            text (str or bytes): Content piece; str is written as UTF-8
+        """
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+        self.file.write(text)
+
+
+class FileWriter:
+    """Writes files through a temporary file and an atomic rename.
+
+    Readers never see a partially written file. How much survives a crash
+    depends on the durability mode:
+
+    - "none": rename only; recent writes may be lost after a power failure
+    - "fsync": each file and its directory are synced before commit returns
+    - "group": commits from concurrent threads are collected for up to
+      `interval` seconds and synced together by a committer thread
+
+    Inside a `batch()` block, group commits made by the calling thread are
+    held back and synced together when the block exits, which suits a
+    single-threaded loop that acknowledges a batch of requests at once.
+    """
+
+    def __init__(self, durability=DURABILITY_NONE, interval=GROUP_INTERVAL):
+        """Initialize a FileWriter.
+
+        Args:
+            durability (str): One of DURABILITY_MODES
+            interval (float): Group commit collection time in seconds
+
+        Raises:
+            ValueError: For an unknown durability mode
+        """
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        self.interval = interval
+        self._dirs = set()
+        self._cond = threading.Condition()
+        self._queue = []
+        self._thread = None
+        self._pid = None
+        self._local = threading.local()
+        self.batches = 0
+        self.synced = 0
+
+    def create(self, directory, name="file"):
+        """Start a new file in a directory.
+
+        Args:
+            directory (str): Directory the file will be committed to
+            name (str): Base name used for the temporary file
+
+        Returns:
+            PendingFile: The temporary file to write to
+        """
+        self._ensure_dir(directory)
+        tmp = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            file = open(tmp, "xb")
+        except FileNotFoundError:
+            # The directory was removed since it was first created
+            self._dirs.discard(directory)
+            self._ensure_dir(directory)
+            file = open(tmp, "xb")
+        return PendingFile(file, tmp)
+
+    def abort(self, pending):
+        """Discard a file that will not be committed.
+
+        Args:
+            pending (PendingFile): The file to discard
+        """
+        try:
+            pending.file.close()
+        finally:
+            _remove(pending.tmp_path)
+
+    def commit(self, pending, path):
+        """Make a pending file visible under its final path.
+
+        Args:
+            pending (PendingFile): The written file
+            path (str): The final path, replaced if it exists
+
+        Raises:
+            OSError: If the file could not be synced or renamed
+        """
+        try:
+            self._ensure_dir(os.path.dirname(path))
+            if self.durability == DURABILITY_NONE:
+                pending.file.close()
+                os.replace(pending.tmp_path, path)
+                return
+            pending.file.flush()
+            if self.durability == DURABILITY_FSYNC:
+                _sync_and_close(pending.file)
+                os.replace(pending.tmp_path, path)
+                _sync_dir(os.path.dirname(path))
+                return
+        except BaseException:
+            self.abort(pending)
+            raise
+        future = self._submit(pending.file, pending.tmp_path, path)
+        if future is not None:
+            future.result()
+
+    async def commit_async(self, pending, path):
+        """Commit without blocking the event loop on disk syncs.
+
+        Args:
+            pending (PendingFile): The written file
+            path (str): The final path
+        """
+        if self.durability == DURABILITY_NONE:
+            self.commit(pending, path)
+        elif self.durability == DURABILITY_FSYNC:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.commit, pending, path)
+        else:
+            try:
+                self._ensure_dir(os.path.dirname(path))
+                pending.file.flush()
+            except BaseException:
+                self.abort(pending)
+                raise
+            future = self._submit(pending.file, pending.tmp_path, path)
+            if future is not None:
+                await asyncio.wrap_future(future)
+
+    def write(self, path, chunks):
+        """Write a whole file atomically.
+
+        Args:
+            path (str): The final path
+            chunks (iterable): Content pieces (str or bytes)
+        """
+        directory, name = os.path.split(path)
+        pending = self.create(directory, name)
+        try:
+            for chunk in chunks:
+                pending.write(chunk)
+        except BaseException:
+            self.abort(pending)
+            raise
+        self.commit(pending, path)
+
+    def link(self, source, path):
+        """Atomically make path a hard link to source, or a copy of it.
+
+        Args:
+            source (str): Existing file
+            path (str): The link to create or replace
+        """
+        directory, name = os.path.split(path)
+        self._ensure_dir(directory)
+        tmp = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        if self.durability == DURABILITY_GROUP:
+            # Linked by the committer, after any pending commit of source
+            future = self._submit(None, tmp, path, source)
+            if future is not None:
+                future.result()
+            return
+
+        _make_link(source, tmp, self.durability == DURABILITY_FSYNC)
+        try:
+            os.replace(tmp, path)
+        except BaseException:
+            _remove(tmp)
+            raise
+        if self.durability == DURABILITY_FSYNC:
+            _sync_dir(directory)
+
+    @contextmanager
+    def batch(self):
+        """Hold back this thread's group commits until the block exits.
+
+        Raises:
+            OSError: On exit, if any file in the batch could not be synced
+                or renamed
+        """
+        if self.durability != DURABILITY_GROUP:
+            yield
+            return
+        self._local.batch = []
+        try:
+            yield
+        finally:
+            batch, self._local.batch = self._local.batch, None
+            self._flush(batch)
+        for entry in batch:
+            error = entry[-1].exception()
+            if error is not None:
+                raise error
+
+    def _ensure_dir(self, directory):
+        """Create a directory once per writer instead of on every write."""
+        if directory not in self._dirs:
+            os.makedirs(directory or ".", exist_ok=True)
+            self._dirs.add(directory)
+
+    def _submit(self, file, tmp, path, source=None):
+        """Queue a group commit.
+
+        Args:
+            file (file): Written temporary file to sync, or None for a link
+            tmp (str): Temporary path renamed to path
+            path (str): Final path
+            source (str): File to link at tmp first, for links
+
+        Returns:
+            Future: Resolved once the file is durable, or None if it was
+            added to this thread's batch
+        """
+        batch = getattr(self._local, "batch", None)
+        future = Future()
+        if batch is not None:
+            batch.append((file, source, tmp, path, future))
+            return None
+        with self._cond:
+            # A forked child does not inherit the committer thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = []
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.append((file, source, tmp, path, future))
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        """Committer thread: sync queued files in batches."""
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            # Let concurrent writers join the batch
+            time.sleep(self.interval)
+            with self._cond:
+                batch, self._queue = self._queue, []
+            self._flush(batch)
+
+    def _flush(self, batch):
+        """Sync, rename and publish a batch of files.
+
+        Every file is synced first, then files are renamed into place and
+        links created in submission order, and each affected directory is
+        synced once.
+        """
+        if not batch:
+            return
+        ready = []
+        for file, source, tmp, path, future in batch:
+            try:
+                if file is not None:
+                    _sync_and_close(file)
+                ready.append((source, tmp, path, future))
+            except Exception as e:
+                _remove(tmp)
+                future.set_exception(e)
+
+        directories = {}
+        for source, tmp, path, future in ready:
+            try:
+                if source is not None:
+                    _make_link(source, tmp, True)
+                os.replace(tmp, path)
+                directories.setdefault(os.path.dirname(path), []).append(future)
+            except Exception as e:
+                _remove(tmp)
+                future.set_exception(e)
+
+        for directory, futures in directories.items():
+            try:
+                _sync_dir(directory)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future in futures:
+                future.set_result(None)
+
+        self.batches += 1
+        self.synced += len(batch)
+
+
+class WritePool:
+    """Runs blocking saves on a fixed set of threads.
+
+    Keeps disk writes off network loops. At most `queue_size` saves wait for
+    a free thread; past that, submit blocks (or refuses, if asked not to
+    block) so a slow disk pushes back on clients instead of buffering their
+    uploads without bound.
+
+    Queue depth and timings are kept for stats().
+    """
+
+    def __init__(self, workers=WRITE_WORKERS, queue_size=WRITE_QUEUE):
+        """Initialize a WritePool.
+
+        Args:
+            workers (int): Writer threads
+            queue_size (int): Saves that may wait for a thread
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix="writer")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.write_time = 0.0
+        self.max_latency = 0.0
+
+    def submit(self, fn, *args, block=True):
+        """Run fn(*args) on a writer thread.
+
+        A save that returns None or False, or raises, counts as failed.
+
+        Args:
+            fn (callable): The save to run
+            *args: Its arguments
+            block (bool): Wait for room in the queue when it is full
+
+        Returns:
+            Future: Resolves to fn's result, or None if the queue was full
+            and block is False
+        """
+        if not self._slots.acquire(blocking=block):
+            with self._lock:
+                self.rejected += 1
+            return None
+        return self._dispatch(fn, args)
+
+    async def run(self, fn, *args):
+        """Run fn(*args) on a writer thread and await its result.
+
+        Waiting for room in a full queue does not block the event loop.
+
+        Args:
+            fn (callable): The save to run
+            *args: Its arguments
+
+        Returns:
+            object: fn's result
+        """
+        if not self._slots.acquire(blocking=False):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._slots.acquire)
+        return await asyncio.wrap_future(self._dispatch(fn, args))
+
+    def stats(self):
+        """Get the pool's metrics.
+
+        Returns:
+            dict: Current and peak queue depth, saves completed, failed and
+            rejected, mean queue wait and write time and the slowest save
+            (submit to finish) in milliseconds
+        """
+        with self._lock:
+            done = max(self.completed, 1)
+            return {
+                "queued": self.queued,
+                "active": self.active,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "wait_ms": self.wait_time / done * 1000,
+                "write_ms": self.write_time / done * 1000,
+                "max_latency_ms": self.max_latency * 1000,
+            }
+
+    def format_stats(self):
+        """Summarize stats() on one line.
+
+        Returns:
+            str: The summary
+        """
+        s = self.stats()
+        return (f"writes={s['completed']} failed={s['failed']} "
+                f"rejected={s['rejected']} queued={s['queued']}/"
+                f"{self.queue_size} max_queued={s['max_queued']} "
+                f"wait={s['wait_ms']:.2f}ms write={s['write_ms']:.2f}ms "
+                f"max={s['max_latency_ms']:.2f}ms")
+
+    def report(self, interval, label="Writer pool"):
+        """Log stats every `interval` seconds from a daemon thread.
+
+        Args:
+            interval (float): Seconds between reports
+            label (str): Prefix of each report
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                log.info("%s: %s", label, self.format_stats())
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def shutdown(self):
+        """Wait for submitted saves to finish and stop the threads."""
+        self._executor.shutdown(wait=True)
+
+    def _dispatch(self, fn, args):
+        """Hand a save to the executor once a slot is held."""
+        submitted = time.monotonic()
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        try:
+            return self._executor.submit(self._run, submitted, fn, args)
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            self._slots.release()
+            raise
+
+    def _run(self, submitted, fn, args):
+        """Writer thread: run one save and record its timings."""
+        started = time.monotonic()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_time += started - submitted
+        ok = False
+        try:
+            result = fn(*args)
+            ok = result is not None and result is not False
+            return result
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.failed += not ok
+                self.write_time += finished - started
+                self.max_latency = max(self.max_latency, finished - submitted)
+            self._slots.release()
+
+
+def _make_link(source, tmp, sync=False):
+    """Hard link source at tmp, copying it where links are not supported.
+
+    Args:
+        source (str): Existing file
+        tmp (str): Path to create
+        sync (bool): Sync a copy to disk
+    """
+    try:
+        os.link(source, tmp)
+        return
+    except OSError:
+        pass
+    try:
+        with open(source, "rb") as src, open(tmp, "xb") as dst:
+            while True:
+                block = src.read(1024 * 1024)
+                if not block:
+                    break
+                dst.write(block)
+            if sync:
+                dst.flush()
+                os.fsync(dst.fileno())
+    except BaseException:
+        _remove(tmp)
+        raise
+
+
+def _sync_and_close(file):
+    """Flush a file to disk and close it."""
+    try:
+        file.flush()
+        os.fsync(file.fileno())
+    finally:
+        file.close()
+
+
+def _sync_dir(directory):
+    """Sync a directory so renames in it survive a crash."""
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on some platforms
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _remove(path):
+    """Delete a file, ignoring errors."""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass